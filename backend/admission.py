@@ -0,0 +1,354 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from itertools import islice
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from prompt_planner import CHARS_PER_TOKEN
+
+# Extracted characters per uploaded byte, by format (text is most of a .txt,
+# little of a zipped DOCX or a PDF with fonts and images)
+TEXT_PER_BYTE = {
+    '.txt': 1.0,
+    '.docx': 0.3,
+    '.doc': 0.3,
+    '.pdf': 0.1,
+}
+
+# Equations are enhanced with LaTeX, which makes longer outputs
+MATH_FACTOR = 1.5
+
+# Prompt instructions and the smallest output, whatever the document
+REQUEST_OVERHEAD = 1000
+
+
+class AdmissionRejected(Exception):
+    """
+    An enhancement request was turned away before any work was done
+
+    status_code is 429 when the client is over its share of the server and
+    503 when the server as a whole is too busy; retry_after is the number of
+    seconds after which a retry is expected to be admitted.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """The admitted cost of one request, held until its work is done"""
+
+    def __init__(self, controller: 'AdmissionController', client: str, cost: float):
+        self.controller = controller
+        self.client = client
+        self.cost = cost
+        self.admitted_at = controller.clock()
+        self.released = False
+
+    def refine(self, text_chars: int, has_math: bool):
+        """Replace the upload-size estimate once the text has been extracted"""
+        self.controller._refine(self, self.controller.estimate(text_chars=text_chars, has_math=has_math))
+
+    def release(self):
+        """Give the cost back (safe to call more than once)"""
+        self.controller._release(self)
+
+
+class _Waiter:
+    def __init__(self, client: str, cost: float):
+        self.client = client
+        self.cost = cost
+        self.future: Future = Future()
+
+
+class AdmissionController:
+    """
+    Cost-based admission control and load shedding for enhancement requests
+
+    Each request is given a cost, the Gemini tokens it is expected to use,
+    estimated from the upload before anything is extracted, and holds it
+    until its work ends. Requests are admitted while the cost in flight fits
+    the budget. Past it they queue, one FIFO per client, and freed budget
+    goes to the clients' queues in turn, so one client's burst can't starve
+    the others. A request is turned away at once, with a Retry-After computed
+    from the rate at which admitted work completes, when its client already
+    holds more than a fair share of the budget (429), or when the queue
+    ahead of it would take longer to drain than a request may wait (503).
+
+    The budget is per process, like the other per-worker limits.
+    """
+
+    # Completed work is measured over this many seconds to estimate the drain rate
+    RATE_WINDOW = 60.0
+
+    # Until work has completed, the budget is assumed to drain in this many seconds
+    DEFAULT_DRAIN_SECONDS = 30.0
+
+    def __init__(
+        self,
+        budget: float = 500000,
+        max_wait: float = 10.0,
+        client_queue: int = 8,
+        metrics=None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Initialize admission control
+
+        Args:
+            budget: Estimated tokens in flight at once (0 admits everything)
+            max_wait: Longest a request may queue for budget, in seconds
+            client_queue: Requests one client may have queued
+            metrics: Metrics counting admission decisions (optional)
+            clock: Monotonic clock (tests)
+        """
+        self.budget = budget
+        self.max_wait = max_wait
+        self.client_queue = client_queue
+        self.metrics = metrics
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self.in_flight = 0.0
+        self._client_cost: Dict[str, float] = {}
+        # client -> its waiters; clients are served in turn, in key order
+        self._queues: 'OrderedDict[str, Deque[_Waiter]]' = OrderedDict()
+        # (time, cost) of work completed within RATE_WINDOW
+        self._completed: Deque[Tuple[float, float]] = deque()
+        self.stats = {
+            'admitted': 0,
+            'queued': 0,
+            'rejected_client': 0,
+            'rejected_busy': 0,
+            'timed_out': 0,
+        }
+
+    @classmethod
+    def from_env(cls, metrics=None) -> 'AdmissionController':
+        """Build admission control from ADMISSION_BUDGET / ADMISSION_MAX_WAIT / ADMISSION_CLIENT_QUEUE"""
+        return cls(
+            budget=float(os.getenv('ADMISSION_BUDGET', 500000)),
+            max_wait=float(os.getenv('ADMISSION_MAX_WAIT', 10)),
+            client_queue=int(os.getenv('ADMISSION_CLIENT_QUEUE', 8)),
+            metrics=metrics
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    @staticmethod
+    def estimate(
+        upload_bytes: int = 0,
+        file_ext: str = '',
+        text_chars: Optional[int] = None,
+        has_math: bool = False
+    ) -> float:
+        """
+        Estimated Gemini tokens (prompt and response) of an enhancement
+
+        Args:
+            upload_bytes: Size of the upload
+            file_ext: Its extension, for how much of it is text
+            text_chars: Length of the extracted text, once known (used instead
+                of the upload size)
+            has_math: Whether the text has mathematical content
+
+        Returns:
+            Cost in tokens
+        """
+        if text_chars is None:
+            text_chars = upload_bytes * TEXT_PER_BYTE.get(file_ext, max(TEXT_PER_BYTE.values()))
+        # The text goes in and about as much comes back
+        tokens = 2 * text_chars / CHARS_PER_TOKEN
+        if has_math:
+            tokens *= MATH_FACTOR
+        return tokens + REQUEST_OVERHEAD
+
+    def _count(self, result: str):
+        self.stats[result] += 1
+        if self.metrics is not None:
+            self.metrics.inc('admission_total', result=result)
+
+    def _observe_wait(self, started: float):
+        if self.metrics is not None:
+            self.metrics.observe('admission_wait_seconds', self.clock() - started)
+
+    # -- accounting (under the lock) -------------------------------------------
+
+    def _fits(self, cost: float) -> bool:
+        # A request bigger than the whole budget runs alone rather than never
+        return self.in_flight + cost <= self.budget or self.in_flight == 0
+
+    def _take(self, client: str, cost: float):
+        self.in_flight += cost
+        self._client_cost[client] = self._client_cost.get(client, 0.0) + cost
+
+    def _drain_rate(self, now: float) -> float:
+        """Tokens of admitted work completed per second, recently"""
+        while self._completed and now - self._completed[0][0] > self.RATE_WINDOW:
+            self._completed.popleft()
+        if len(self._completed) >= 2:
+            # Work completed since the oldest completion in the window
+            span = max(now - self._completed[0][0], 1.0)
+            return (sum(cost for _, cost in self._completed) - self._completed[0][1]) / span
+        return self.budget / self.DEFAULT_DRAIN_SECONDS
+
+    def _retry_after(self, backlog: float, now: float) -> int:
+        """Seconds until backlog tokens of work have drained"""
+        return max(1, math.ceil(backlog / self._drain_rate(now)))
+
+    def _ahead(self, client: str) -> float:
+        """Queued cost admitted before a new request of client, queues being served in turn"""
+        own = self._queues.get(client, ())
+        turns = len(own) + 1
+        return sum(w.cost for w in own) + sum(
+            sum(w.cost for w in islice(queue, turns))
+            for other, queue in self._queues.items() if other != client
+        )
+
+    def _grant_waiting(self):
+        """Admit queued requests that now fit, one client at a time"""
+        while self._queues:
+            client, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            if not self._fits(waiter.cost):
+                return
+            queue.popleft()
+            # The client goes to the back of the rotation
+            del self._queues[client]
+            if queue:
+                self._queues[client] = queue
+            self._take(client, waiter.cost)
+            waiter.future.set_result(AdmissionTicket(self, client, waiter.cost))
+
+    def _enqueue(self, client: str, cost: float) -> _Waiter:
+        """Admit, queue or reject a request; returns its waiter when it must wait"""
+        now = self.clock()
+        if not self._queues and self._fits(cost):
+            self._take(client, cost)
+            waiter = _Waiter(client, cost)
+            waiter.future.set_result(AdmissionTicket(self, client, cost))
+            self._count('admitted')
+            return waiter
+
+        queue = self._queues.get(client)
+        active = set(self._client_cost) | set(self._queues) | {client}
+        share = self.budget / len(active)
+        held = self._client_cost.get(client, 0.0) + sum(w.cost for w in queue or ())
+        # A client's first request is never its fault, however big
+        if len(active) > 1 and held > 0 and (held + cost > share or len(queue or ()) >= self.client_queue):
+            self._count('rejected_client')
+            raise AdmissionRejected(
+                "Too many requests from this client; please retry later",
+                429, self._retry_after(held + cost - share, now)
+            )
+        if len(queue or ()) >= self.client_queue:
+            self._count('rejected_busy')
+            raise AdmissionRejected(
+                "Server is busy. Please try again shortly.",
+                503, self._retry_after(self.in_flight + self._ahead(client) + cost - self.budget, now)
+            )
+
+        backlog = self.in_flight + self._ahead(client) + cost - self.budget
+        wait = backlog / self._drain_rate(now)
+        if wait > self.max_wait:
+            self._count('rejected_busy')
+            raise AdmissionRejected(
+                "Server is busy. Please try again shortly.", 503, self._retry_after(backlog, now)
+            )
+
+        waiter = _Waiter(client, cost)
+        self._queues.setdefault(client, deque()).append(waiter)
+        self._count('queued')
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> Optional[AdmissionTicket]:
+        """Take a waiter that timed out out of its queue; its ticket if it was admitted meanwhile"""
+        with self._lock:
+            if waiter.future.done():
+                return waiter.future.result()
+            queue = self._queues.get(waiter.client)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.client]
+            self._count('timed_out')
+            retry_after = self._retry_after(
+                self.in_flight + self._ahead(waiter.client) + waiter.cost - self.budget, self.clock()
+            )
+            # Those behind it may fit now
+            self._grant_waiting()
+        raise AdmissionRejected("Server is busy. Please try again shortly.", 503, retry_after)
+
+    def _refine(self, ticket: AdmissionTicket, cost: float):
+        with self._lock:
+            if ticket.released:
+                return
+            self._take(ticket.client, cost - ticket.cost)
+            ticket.cost = cost
+            self._grant_waiting()
+
+    def _release(self, ticket: AdmissionTicket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= ticket.cost
+            remaining = self._client_cost.get(ticket.client, 0.0) - ticket.cost
+            if remaining > 1e-6:
+                self._client_cost[ticket.client] = remaining
+            else:
+                self._client_cost.pop(ticket.client, None)
+            self._completed.append((self.clock(), ticket.cost))
+            self._grant_waiting()
+
+    # -- admission ---------------------------------------------------------------
+
+    def admit(self, client: str, cost: float) -> Optional[AdmissionTicket]:
+        """
+        Admit a request, waiting up to max_wait for budget
+
+        Args:
+            client: Identity of the caller, for fair shares
+            cost: Estimated cost, from estimate
+
+        Returns:
+            Ticket to release when the work ends (None when admission
+            control is off)
+
+        Raises:
+            AdmissionRejected: If the request is turned away
+        """
+        if not self.enabled:
+            return None
+        started = self.clock()
+        with self._lock:
+            waiter = self._enqueue(client, cost)
+        try:
+            ticket = waiter.future.result(timeout=self.max_wait)
+        except FutureTimeout:
+            ticket = self._abandon(waiter)
+        self._observe_wait(started)
+        return ticket
+
+    async def admit_async(self, client: str, cost: float) -> Optional[AdmissionTicket]:
+        """admit for the async serving mode: queueing holds no thread"""
+        if not self.enabled:
+            return None
+        started = self.clock()
+        with self._lock:
+            waiter = self._enqueue(client, cost)
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter.future)), self.max_wait)
+        except asyncio.TimeoutError:
+            ticket = self._abandon(waiter)
+        self._observe_wait(started)
+        return ticket
@@ -1,108 +1,369 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Blueprint, Flask, current_app, request, jsonify, send_file, Response, stream_with_context, g
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.local import LocalProxy
 import os
+import json
+import time
+import shutil
 import traceback
+import functools
 from io import BytesIO
 import tempfile
+from typing import Optional
 
-from gemini_client import GeminiClient
-from document_converter import DocumentConverter
-from latex_processor import LaTeXProcessor
+from admission import AdmissionRejected
+from job_queue import JobQueueFull
+from batch_signer import BatchItem
+from upload_spool import SpooledRequest, map_upload, release_upload
+from metrics import RequestTrace, log_json
+from services import MissingConfiguration, Services
 
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+MIMETYPES = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.pdf': 'application/pdf',
+}
 
-# Initialize services
-gemini_client = GeminiClient(api_key=os.getenv('GEMINI_API_KEY'))
-latex_processor = LaTeXProcessor()
-doc_converter = DocumentConverter()
+api = Blueprint('api', __name__)
 
-@app.route('/health', methods=['GET'])
+# Services of the app handling the current request
+services: Services = LocalProxy(lambda: current_app.extensions['services'])
+
+def create_app(app_services: Optional[Services] = None) -> Flask:
+    """
+    Build the Flask application
+    
+    Services are created on first use, so building the app imports neither
+    the Gemini SDK nor the document libraries and works without
+    GEMINI_API_KEY; call warm_up() to load them ahead of time.
+    
+    Args:
+        app_services: Services to use (default: a new Services)
+    """
+    flask_app = Flask(__name__)
+    CORS(flask_app)  # Enable CORS for all routes
+    
+    # Large uploads are spooled to disk and memory-mapped instead of read into memory
+    flask_app.request_class = SpooledRequest
+    flask_app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))
+    
+    flask_app.extensions['services'] = app_services or Services()
+    flask_app.register_blueprint(api)
+    return flask_app
+
+def requires_gemini(view):
+    """Answer 503 instead of failing when the Gemini API key is not configured"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not services.gemini_configured:
+            return gemini_not_configured_response()
+        return view(*args, **kwargs)
+    return wrapper
+
+def gemini_not_configured_response():
+    """503 response of an enhancement endpoint when Gemini is not configured"""
+    return jsonify({'error': 'Document enhancement is not configured on this server (GEMINI_API_KEY is not set)'}), 503
+
+@api.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@api.after_app_request
+def record_request_metrics(response):
+    """Record latency once the server has finished sending the response"""
+    started = g.get('request_started', time.perf_counter())
+    # Bound now: record runs after the request context is gone
+    metrics = services.metrics
+    handed_off = time.perf_counter()
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    status = response.status_code
+    trace = g.get('trace')
+    
+    def record():
+        now = time.perf_counter()
+        metrics.observe('http_request_seconds', now - started, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, status=str(status))
+        if trace is not None:
+            # A generated body (server-sent events) is produced while it is
+            # sent; that time is already in the pipeline stages
+            if response.direct_passthrough or not response.is_streamed:
+                trace.record('response_send', now - handed_off)
+            trace.finish('ok' if status < 400 else 'error')
+        metrics.flush()
+        log_json('http_request', endpoint=endpoint, method=method, status=status,
+                 seconds=round(now - started, 4))
+    
+    if response.direct_passthrough:
+        # send_file bodies are handed to the server as they are (so it can use
+        # sendfile) and werkzeug skips call_on_close for them; hook the body's
+        # own close, which the server calls once the file has been sent
+        body = response.response
+        body_close = getattr(body, 'close', None)
+        
+        def close():
+            try:
+                if body_close is not None:
+                    body_close()
+            finally:
+                record()
+        
+        body.close = close
+    else:
+        response.call_on_close(record)
+    return response
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request, stage, Gemini and cache metrics in the Prometheus text format"""
+    return Response(services.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
         'service': 'LaTeX Document Enhancement API',
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'gemini_configured': services.gemini_configured,
+        'cache': services.result_cache.get_stats()
     })
 
-@app.route('/enhance', methods=['POST'])
+def _too_large_response():
+    limit_mb = current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({'error': f'File is too large. The limit is {limit_mb} MB'}), 413
+
+@api.app_errorhandler(RequestEntityTooLarge)
+def handle_too_large(e):
+    return _too_large_response()
+
+@api.app_errorhandler(MissingConfiguration)
+def handle_missing_configuration(e):
+    return jsonify({'error': str(e)}), e.status_code
+
+def _admission_client():
+    """Who a request counts against for fair shares: X-Client-ID, else the client address"""
+    return request.headers.get('X-Client-ID') or (request.access_route[0] if request.access_route else '')
+
+def admission_rejected_response(e):
+    """429/503 response of a request turned away by admission control, with its Retry-After"""
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status_code
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def read_enhancement_upload(admit: bool = True):
+    """
+    Validate and map an enhancement upload from the current request, and
+    admit it against the cost budget before any work is done
+    
+    The upload's file_content must be given back with release_upload, and
+    its ticket (None when admission control is off) released, once they are
+    no longer needed.
+    
+    Args:
+        admit: Admit the upload here (the async app passes False and
+            awaits admit_async with the upload's client and cost instead)
+    
+    Returns:
+        (upload dict, None) on success or (None, error response) on failure
+    """
+    trace = RequestTrace(services.metrics, request.url_rule.rule)
+    upload_started = time.perf_counter()
+    
+    # Validate file upload (werkzeug rejects bodies over MAX_CONTENT_LENGTH here)
+    try:
+        files = request.files
+    except RequestEntityTooLarge:
+        return None, _too_large_response()
+    
+    if 'file' not in files:
+        return None, (jsonify({'error': 'No file provided'}), 400)
+    
+    file = files['file']
+    if file.filename == '':
+        return None, (jsonify({'error': 'Empty filename'}), 400)
+    
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    if file_ext not in ['.docx', '.pdf', '.txt', '.doc']:
+        return None, (jsonify({'error': 'Unsupported file format. Please use .docx or .pdf'}), 400)
+    
+    # Bytes or an mmap of the spool file; both outlive the request
+    file_content = map_upload(file)
+    trace.record('upload_read', time.perf_counter() - upload_started)
+    
+    client = _admission_client()
+    cost = services.admission.estimate(len(file_content), file_ext)
+    ticket = None
+    if admit:
+        try:
+            ticket = services.admission.admit(client, cost)
+        except AdmissionRejected as e:
+            release_upload(file_content)
+            return None, admission_rejected_response(e)
+    
+    return {
+        'file_content': file_content,
+        'file_ext': file_ext,
+        'base_name': os.path.splitext(file.filename)[0],
+        # Get optional parameters
+        'user_prompt': request.args.get('prompt', request.form.get('prompt', '')),
+        'doc_type': request.args.get('doc_type', request.form.get('doc_type', 'auto')),
+        'trace': trace,
+        'client': client,
+        'cost': cost,
+        'ticket': ticket,
+    }, None
+
+def release_ticket(upload):
+    """Give an upload's admitted cost back once its work has ended"""
+    if upload['ticket'] is not None:
+        upload['ticket'].release()
+
+def _submit_enhancement_job(finish_trace_in_job: bool = False):
+    """
+    Validate an enhancement upload and queue it on the job runner
+    
+    Args:
+        finish_trace_in_job: Record the request's metrics when the job ends
+            (otherwise they are recorded when the response has been sent)
+    
+    Returns:
+        (job_id, None) on success or (None, error response) on failure
+    """
+    upload, error_response = read_enhancement_upload()
+    if error_response:
+        return None, error_response
+    
+    trace = upload['trace']
+    if not finish_trace_in_job:
+        g.trace = trace
+    
+    # Bound now: the job runs outside the request context
+    pipeline = services.pipeline
+    
+    def work(report_stage):
+        try:
+            output_file, output_format = pipeline.run(
+                upload['file_content'],
+                upload['file_ext'],
+                upload['user_prompt'],
+                upload['doc_type'],
+                on_stage=report_stage,
+                trace=trace,
+                ticket=upload['ticket']
+            )
+        except Exception:
+            if finish_trace_in_job:
+                trace.finish('error')
+            raise
+        finally:
+            release_upload(upload['file_content'])
+            release_ticket(upload)
+        if finish_trace_in_job:
+            trace.finish('ok')
+        return output_file, f"enhanced_{upload['base_name']}{output_format}", MIMETYPES[output_format]
+    
+    try:
+        return services.job_runner.submit(work), None
+    except JobQueueFull:
+        release_upload(upload['file_content'])
+        release_ticket(upload)
+        return None, (jsonify({'error': 'Server is busy. Please try again shortly.'}), 503)
+
+def sse(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _job_error_response(job):
+    """Error response for a failed job, matching the synchronous endpoint"""
+    if job['status_code'] and job['status_code'] < 500:
+        return jsonify({'error': job['error']}), job['status_code']
+    return jsonify({
+        'error': job['error'],
+        'details': job['details'] if os.getenv('FLASK_ENV') == 'development' else None
+    }), 500
+
+def job_result_response(job):
+    """Stream a finished job's output file"""
+    return send_file(
+        services.job_runner.store.result_path(job['id']),
+        mimetype=job['mimetype'],
+        as_attachment=True,
+        download_name=job['filename']
+    )
+
+def processing_error_response(e):
+    """Error response for a failed enhancement: the message of client errors, a generic one otherwise"""
+    status_code = getattr(e, 'status_code', 500)
+    if status_code < 500:
+        return jsonify({'error': str(e)}), status_code
+    
+    print(f"Error processing document: {str(e)}")
+    print(traceback.format_exc())
+    return jsonify({
+        'error': 'Failed to process document. Please try again.',
+        'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
+    }), 500
+
+def store_streamed_document(prepared, processed_content, base_name, trace, file_content=None):
+    """
+    Render the text sent by a stream (unless the document is cached) and
+    store it like a finished job's result
+    
+    file_content is the upload, which a DOCX output is patched into.
+    
+    Returns:
+        Job id to download the document from
+    """
+    output_file = services.result_cache.get('document', prepared.document_key)
+    trace.set(document_cache_hit=output_file is not None)
+    if output_file is None:
+        output_file = services.pipeline.render(
+            prepared, processed_content, already_processed=True, trace=trace, file_content=file_content
+        )
+    else:
+        trace.set(bytes_out=len(output_file))
+    
+    return services.job_runner.store_result(
+        output_file,
+        f"enhanced_{base_name}{prepared.output_format}",
+        MIMETYPES[prepared.output_format]
+    )
+
+@api.route('/enhance', methods=['POST'])
+@requires_gemini
 def enhance_document():
     """
     Enhance document with AI and LaTeX support
     
+    Runs the same job as /jobs/enhance and waits for it to finish (for at
+    most JOB_WAIT_TIMEOUT seconds, then answers 202 with the job to poll).
+    
     Expected form data:
     - file: Document file (.docx or .pdf)
     - prompt: (optional) User's enhancement instructions
     - doc_type: (optional) Document type hint
     """
     try:
-        # Validate file upload
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'Empty filename'}), 400
-        
-        # Get optional parameters
-        user_prompt = request.args.get('prompt', request.form.get('prompt', ''))
-        doc_type = request.args.get('doc_type', request.form.get('doc_type', 'auto'))
-        
-        # Save uploaded file temporarily
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext not in ['.docx', '.pdf', '.txt', '.doc']:
-            return jsonify({'error': 'Unsupported file format. Please use .docx or .pdf'}), 400
-        
-        # Read file content
-        file_content = file.read()
+        job_id, error_response = _submit_enhancement_job()
+        if error_response:
+            return error_response
         
-        # Extract text from document
-        extracted_text = doc_converter.extract_text(file_content, file_ext)
+        job = services.job_runner.wait(job_id, timeout=services.job_runner.wait_timeout)
+        if job['status'] in ('queued', 'running'):
+            # Not done before the worker timeout: the client polls the job
+            # instead of this thread waiting on it
+            return jsonify({
+                'job_id': job_id,
+                'status': job['status'],
+                'status_url': f"/jobs/{job_id}",
+                'result_url': f"/jobs/{job_id}/result"
+            }), 202
+        if job['status'] != 'done':
+            return _job_error_response(job)
         
-        if not extracted_text or len(extracted_text.strip()) < 10:
-            return jsonify({'error': 'Could not extract text from document'}), 400
-        
-        # Detect if document contains mathematical/scientific content
-        has_math = latex_processor.detect_mathematical_content(extracted_text)
-        
-        # Build enhancement prompt
-        enhancement_prompt = latex_processor.build_enhancement_prompt(
-            content=extracted_text,
-            user_instructions=user_prompt,
-            doc_type=doc_type,
-            include_latex=has_math
-        )
-        
-        # Use Gemini to enhance the content
-        enhanced_content = gemini_client.enhance_content(enhancement_prompt)
-        
-        # Process LaTeX in the enhanced content
-        processed_content = latex_processor.process_latex_content(enhanced_content)
-        
-        # Convert back to document format
-        output_format = file_ext if file_ext in ['.docx', '.pdf'] else '.docx'
-        output_file = doc_converter.create_document(
-            content=processed_content,
-            original_format=file_ext,
-            output_format=output_format,
-            include_latex=has_math
-        )
-        
-        # Prepare response
-        output_buffer = BytesIO(output_file)
-        output_buffer.seek(0)
-        
-        # Determine output filename
-        base_name = os.path.splitext(file.filename)[0]
-        output_filename = f"enhanced_{base_name}{output_format}"
-        
-        return send_file(
-            output_buffer,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document' if output_format == '.docx' else 'application/pdf',
-            as_attachment=True,
-            download_name=output_filename
-        )
+        return job_result_response(job)
         
     except Exception as e:
         # Log error for debugging (will appear in HuggingFace logs)
@@ -115,7 +376,146 @@ def enhance_document():
             'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
         }), 500
 
-@app.route('/add-signature', methods=['POST'])
+@api.route('/enhance/stream', methods=['POST'])
+@requires_gemini
+def enhance_document_stream():
+    """
+    Enhance document and stream the enhanced text as server-sent events
+    
+    Takes the same form data as /enhance. Events:
+    - text: {"text": ...} LaTeX-processed enhanced text, in order
+    - done: {"token": ..., "download_url": ...} rendered document is ready
+    - error: {"error": ...} processing failed
+    """
+    try:
+        upload, error_response = read_enhancement_upload()
+        if error_response:
+            return error_response
+        
+        trace = g.trace = upload['trace']
+        try:
+            prepared = services.pipeline.prepare(
+                upload['file_content'],
+                upload['file_ext'],
+                upload['user_prompt'],
+                upload['doc_type'],
+                trace=trace,
+                ticket=upload['ticket']
+            )
+        except Exception:
+            release_upload(upload['file_content'])
+            release_ticket(upload)
+            raise
+        if prepared.source is None:
+            # Everything after extraction works on the text; DOCX uploads
+            # are kept until the output is patched into them
+            release_upload(upload['file_content'])
+    except Exception as e:
+        # Problems with the upload itself (EnhancementError, size limits)
+        return processing_error_response(e)
+    
+    def events():
+        try:
+            # Flush headers right away so the client knows work has started
+            yield sse('start', {
+                'stage': 'enhancing',
+                'plan': prepared.plan.to_dict() if prepared.plan else None
+            })
+            
+            processed = []
+            for text in services.pipeline.stream(prepared, trace=trace):
+                processed.append(text)
+                yield sse('text', {'text': text})
+            
+            token = store_streamed_document(
+                prepared, ''.join(processed), upload['base_name'], trace, upload['file_content']
+            )
+            yield sse('done', {'token': token, 'download_url': f"/jobs/{token}/result"})
+            
+        except Exception as e:
+            trace.finish('error')
+            print(f"Error streaming document: {str(e)}")
+            print(traceback.format_exc())
+            yield sse('error', {
+                'error': 'Failed to process document. Please try again.',
+                'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
+            })
+        finally:
+            if prepared.source is not None:
+                release_upload(upload['file_content'])
+            release_ticket(upload)
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Stop reverse proxies from buffering the stream
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@api.route('/jobs/enhance', methods=['POST'])
+@requires_gemini
+def create_enhance_job():
+    """
+    Queue a document enhancement and return immediately
+    
+    Takes the same form data as /enhance. Poll /jobs/<job_id> for progress
+    and download the output from /jobs/<job_id>/result.
+    """
+    try:
+        job_id, error_response = _submit_enhancement_job(finish_trace_in_job=True)
+        if error_response:
+            return error_response
+        
+        return jsonify({
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': f"/jobs/{job_id}",
+            'result_url': f"/jobs/{job_id}/result"
+        }), 202
+        
+    except Exception as e:
+        print(f"Error queueing document: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({
+            'error': 'Failed to queue document. Please try again.',
+            'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
+        }), 500
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report the status and current stage of an enhancement job"""
+    job = services.job_runner.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    response = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+    }
+    if job['status'] == 'failed':
+        response['error'] = job['error']
+    elif job['status'] == 'done':
+        response['result_url'] = f"/jobs/{job['id']}/result"
+    return jsonify(response)
+
+@api.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Download the output document of a finished job"""
+    job = services.job_runner.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'failed':
+        return _job_error_response(job)
+    if job['status'] != 'done':
+        return jsonify({'error': 'Job is not finished yet', 'status': job['status']}), 409
+    
+    return job_result_response(job)
+
+@api.route('/add-signature', methods=['POST'])
 def add_signature():
     """
     Add digital signature to document
@@ -128,10 +528,15 @@ def add_signature():
     """
     try:
         # Validate file upload
-        if 'file' not in request.files:
+        try:
+            files = request.files
+        except RequestEntityTooLarge:
+            return _too_large_response()
+        
+        if 'file' not in files:
             return jsonify({'error': 'No file provided'}), 400
         
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             return jsonify({'error': 'Empty filename'}), 400
             
@@ -143,20 +548,22 @@ def add_signature():
         position = request.form.get('position', 'bottom-right')
         signer_name = request.form.get('signer_name')
         
-        # Read file content
-        file_content = file.read()
+        # Map file content (spooled to disk if large)
+        file_content = map_upload(file)
         
         # Add signature
-        signed_doc = doc_converter.add_signature(
-            file_content=file_content,
-            signature_data=signature_data,
-            position=position,
-            signer_name=signer_name
-        )
+        try:
+            signed_doc = services.doc_converter.add_signature(
+                file_content=file_content,
+                signature_data=signature_data,
+                position=position,
+                signer_name=signer_name
+            )
+        finally:
+            release_upload(file_content)
         
-        # Prepare response
+        # BytesIO shares the bytes object, so the response is streamed without a copy
         output_buffer = BytesIO(signed_doc)
-        output_buffer.seek(0)
         
         base_name = os.path.splitext(file.filename)[0]
         output_filename = f"Signed_{base_name}.docx"
@@ -176,7 +583,94 @@ def add_signature():
             'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
         }), 500
 
-@app.route('/', methods=['GET'])
+@api.route('/add-signature/batch', methods=['POST'])
+def add_signature_batch():
+    """
+    Sign many documents, or one document for many signers, in one request
+    
+    Expected form data:
+    - file / files: One or more document files (.docx)
+    - signature: Base64 signature image used for every item
+    - position: (optional) Position of signature
+    - signer_name: (optional) Name of signer
+    - signers: (optional) JSON list of {"signer_name", "position", "signature"}
+      objects; every file is signed once per entry, and missing fields fall
+      back to the values above
+    
+    Returns a zip archive, streamed as items finish, with one signed file
+    per item and a manifest.json listing the outcome of every item.
+    """
+    workdir = None
+    try:
+        try:
+            files = request.files
+        except RequestEntityTooLarge:
+            return _too_large_response()
+        
+        uploads = [f for f in files.getlist('file') + files.getlist('files') if f.filename]
+        if not uploads:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        default_signer = {
+            'signature': request.form.get('signature'),
+            'position': request.form.get('position', 'bottom-right'),
+            'signer_name': request.form.get('signer_name'),
+        }
+        signers = [{}]
+        if request.form.get('signers'):
+            try:
+                signers = json.loads(request.form['signers'])
+            except ValueError:
+                return jsonify({'error': 'signers must be a JSON list'}), 400
+            if not isinstance(signers, list) or not signers or not all(isinstance(s, dict) for s in signers):
+                return jsonify({'error': 'signers must be a non-empty JSON list of objects'}), 400
+        signers = [{**default_signer, **{k: v for k, v in signer.items() if v}} for signer in signers]
+        
+        if any(not signer['signature'] for signer in signers):
+            return jsonify({'error': 'No signature provided'}), 400
+        
+        if len(uploads) * len(signers) > services.batch_signer.max_items:
+            return jsonify({
+                'error': f'Too many items in one batch. The limit is {services.batch_signer.max_items}'
+            }), 400
+        
+        # Workers read the uploads from disk, so each file is written once
+        # however many signers it has
+        workdir = tempfile.mkdtemp(prefix='verolabz_sign_')
+        items = []
+        for file_index, upload in enumerate(uploads):
+            path = os.path.join(workdir, f"{file_index}.docx")
+            upload.save(path)
+            for signer in signers:
+                items.append(BatchItem(
+                    index=len(items),
+                    path=path,
+                    filename=upload.filename,
+                    signature_data=signer['signature'],
+                    position=signer['position'],
+                    signer_name=signer['signer_name']
+                ))
+        services.batch_signer.output_names(items, many_signers=len(signers) > 1)
+        
+        response = Response(
+            services.batch_signer.stream_zip(items),
+            mimetype='application/zip',
+            headers={'Content-Disposition': 'attachment; filename=signed_documents.zip'}
+        )
+        response.call_on_close(lambda path=workdir: shutil.rmtree(path, ignore_errors=True))
+        return response
+        
+    except Exception as e:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"Error signing batch: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({
+            'error': 'Failed to sign documents',
+            'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
+        }), 500
+
+@api.route('/', methods=['GET'])
 def index():
     """Root endpoint with API information"""
     return jsonify({
@@ -186,6 +680,13 @@ def index():
         'endpoints': {
             '/health': 'Health check',
             '/enhance': 'Enhance document (POST with file)',
+            '/enhance/stream': 'Enhance document, streaming text as server-sent events (POST with file)',
+            '/jobs/enhance': 'Queue document enhancement (POST with file)',
+            '/jobs/<job_id>': 'Enhancement job status',
+            '/jobs/<job_id>/result': 'Download enhanced document',
+            '/add-signature': 'Sign a document (POST with file)',
+            '/add-signature/batch': 'Sign many documents or signers, returned as a zip (POST with files)',
+            '/metrics': 'Prometheus metrics',
         },
         'supported_formats': ['.docx', '.pdf', '.txt'],
         'features': [
@@ -197,10 +698,19 @@ def index():
         ]
     })
 
+app = create_app()
+
+def __getattr__(name):
+    # The services used to be module globals (app.doc_converter and so on)
+    if isinstance(getattr(Services, name, None), property):
+        return getattr(app.extensions['services'], name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == '__main__':
     # Check for API key
     if not os.getenv('GEMINI_API_KEY'):
         print("WARNING: GEMINI_API_KEY environment variable not set!")
+        print("Enhancement endpoints will answer 503 until it is set")
         print("Please set it in HuggingFace Spaces Settings → Repository secrets")
     
     # Run Flask app
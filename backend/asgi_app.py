@@ -0,0 +1,380 @@
+import asyncio
+import contextvars
+import functools
+import os
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from flask import Flask, Response, g
+from werkzeug.wsgi import FileWrapper
+
+from admission import AdmissionRejected
+from app import (
+    MIMETYPES,
+    admission_rejected_response,
+    app as flask_app,
+    gemini_not_configured_response,
+    job_result_response,
+    processing_error_response,
+    read_enhancement_upload,
+    release_ticket,
+    services,
+    sse,
+    store_streamed_document,
+)
+from upload_spool import SPOOL_THRESHOLD, release_upload
+
+# Bytes read per step when the server sends a file through the thread pool
+FILE_CHUNK_SIZE = 256 * 1024
+
+
+class _Disconnected(Exception):
+    """The client went away before the request body was received"""
+
+
+class AsyncApp:
+    """
+    ASGI application serving the Flask app, with async enhancement endpoints
+
+    /enhance and /enhance/stream are served as coroutines: the Gemini calls
+    go through the SDK's async API, so a request waiting on Gemini holds no
+    thread and one process can have hundreds of them in flight. Upload
+    parsing, extraction, rendering and cache I/O run on a thread pool.
+
+    Every other route is the Flask app itself, run on the same pool. The
+    responses of all routes are the ones the Flask app gives under gunicorn.
+
+    Run with an ASGI server, e.g.:
+        uvicorn asgi_app:app --host 0.0.0.0 --port 7860
+    """
+
+    def __init__(self, wsgi_app: Flask, threads: Optional[int] = None):
+        """
+        Initialize application
+
+        Args:
+            wsgi_app: Flask app built by create_app
+            threads: Threads for blocking work and the other routes
+                (ASGI_THREADS, default: CPU count + 4, up to 32)
+        """
+        self.flask_app = wsgi_app
+        self.threads = threads or int(os.getenv('ASGI_THREADS', min(32, (os.cpu_count() or 1) + 4)))
+        self._executor = None
+        self.views = {
+            ('POST', '/enhance'): self.enhance_document,
+            ('POST', '/enhance/stream'): self.enhance_document_stream,
+        }
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Pool for blocking work, created on first use"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+        return self._executor
+
+    def _in_thread(self, fn, *args, **kwargs):
+        """Run fn on the pool, seeing the current request context"""
+        context = contextvars.copy_context()
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, fn, *args, **kwargs)
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        try:
+            environ = await self._environ(scope, receive)
+        except _Disconnected:
+            return
+
+        view = self.views.get((scope['method'], scope['path']))
+        try:
+            if view is None:
+                await self._send_wsgi(lambda start_response: self.flask_app(environ, start_response), send)
+            else:
+                await self._dispatch(view, environ, send)
+        finally:
+            environ['wsgi.input'].close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Import the heavy modules before the first request instead of during it
+                if os.getenv('APP_WARM_UP', '1') != '0':
+                    seconds = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.flask_app.extensions['services'].warm_up
+                    )
+                    print(f"Warm-up took {seconds:.2f}s")
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _environ(self, scope, receive) -> dict:
+        """WSGI environ of an ASGI request, with the body spooled like an upload"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client')
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0] if client else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': lambda file, block_size=FILE_CHUNK_SIZE: FileWrapper(file, max(block_size, FILE_CHUNK_SIZE)),
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            value = value.decode('latin1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+
+        # A body over the limit is not read: werkzeug answers 413 from its length
+        limit = self.flask_app.config.get('MAX_CONTENT_LENGTH')
+        declared = environ.get('CONTENT_LENGTH', '')
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        size = 0
+        if not (limit is not None and declared.isdigit() and int(declared) > limit):
+            more = True
+            while more:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    body.close()
+                    raise _Disconnected()
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    break
+                body.write(chunk)
+                more = message.get('more_body', False)
+            body.seek(0)
+            environ['CONTENT_LENGTH'] = str(size)
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        environ['wsgi.input'] = body
+        return environ
+
+    async def _dispatch(self, view, environ, send):
+        """Handle a request with an async view, the way Flask.wsgi_app handles it with a sync one"""
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        ctx.push()
+        error = None
+        try:
+            try:
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = await view()
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = app.handle_exception(e)
+            await self._send_response(response, environ, send)
+        finally:
+            ctx.pop(error)
+
+    async def _send_response(self, response: Response, environ: dict, send):
+        body = response.response
+        if not hasattr(body, '__aiter__'):
+            await self._send_wsgi(lambda start_response: response(environ, start_response), send)
+            return
+
+        # Generated by a coroutine (server-sent events): sent as it is produced
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': [
+                    (name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in response.get_wsgi_headers(environ).items()
+                ],
+            })
+            async for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await self._in_thread(response.close)
+
+    async def _send_wsgi(self, call, send):
+        """Run a WSGI callable on the pool and send its response"""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers
+            ]
+            return lambda data: None
+
+        def first_chunk():
+            iterable = call(start_response)
+            chunks = iter(iterable)
+            # start_response may be called on the first iteration
+            return iterable, chunks, next(chunks, None)
+
+        iterable, chunks, chunk = await self._in_thread(first_chunk)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers'],
+            })
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+                chunk = await self._in_thread(next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await self._in_thread(close)
+
+    async def _admitted_upload(self):
+        """read_enhancement_upload, queueing for admission without holding a thread"""
+        upload, error_response = await self._in_thread(read_enhancement_upload, admit=False)
+        if error_response:
+            return None, error_response
+        try:
+            upload['ticket'] = await services.admission.admit_async(upload['client'], upload['cost'])
+        except AdmissionRejected as e:
+            release_upload(upload['file_content'])
+            return None, admission_rejected_response(e)
+        return upload, None
+
+    async def enhance_document(self):
+        """/enhance, waiting on Gemini without holding a thread"""
+        if not services.gemini_configured:
+            return gemini_not_configured_response()
+
+        try:
+            upload, error_response = await self._admitted_upload()
+            if error_response:
+                return error_response
+
+            trace = g.trace = upload['trace']
+            try:
+                pipeline = await self._in_thread(lambda: services.pipeline)
+                output_file, output_format = await pipeline.run_async(
+                    upload['file_content'],
+                    upload['file_ext'],
+                    upload['user_prompt'],
+                    upload['doc_type'],
+                    trace=trace,
+                    executor=self.executor,
+                    ticket=upload['ticket']
+                )
+            finally:
+                release_upload(upload['file_content'])
+                release_ticket(upload)
+        except Exception as e:
+            return processing_error_response(e)
+
+        def respond():
+            # Served from the job store, exactly like the synchronous endpoint
+            job_id = services.job_runner.store_result(
+                output_file, f"enhanced_{upload['base_name']}{output_format}", MIMETYPES[output_format]
+            )
+            return job_result_response(services.job_runner.store.get(job_id))
+
+        return await self._in_thread(respond)
+
+    async def enhance_document_stream(self):
+        """/enhance/stream, with the text events produced by a coroutine"""
+        if not services.gemini_configured:
+            return gemini_not_configured_response()
+
+        try:
+            upload, error_response = await self._admitted_upload()
+            if error_response:
+                return error_response
+
+            trace = g.trace = upload['trace']
+            try:
+                pipeline = await self._in_thread(lambda: services.pipeline)
+                prepared = await self._in_thread(
+                    pipeline.prepare,
+                    upload['file_content'],
+                    upload['file_ext'],
+                    upload['user_prompt'],
+                    upload['doc_type'],
+                    trace=trace,
+                    ticket=upload['ticket']
+                )
+            except Exception:
+                release_upload(upload['file_content'])
+                release_ticket(upload)
+                raise
+            if prepared.source is None:
+                # DOCX uploads are kept until the output is patched into them
+                release_upload(upload['file_content'])
+        except Exception as e:
+            return processing_error_response(e)
+
+        async def events():
+            try:
+                yield sse('start', {
+                    'stage': 'enhancing',
+                    'plan': prepared.plan.to_dict() if prepared.plan else None
+                })
+
+                processed = []
+                async for text in pipeline.stream_async(prepared, trace=trace, executor=self.executor):
+                    processed.append(text)
+                    yield sse('text', {'text': text})
+
+                token = await self._in_thread(
+                    store_streamed_document, prepared, ''.join(processed), upload['base_name'], trace,
+                    upload['file_content']
+                )
+                yield sse('done', {'token': token, 'download_url': f"/jobs/{token}/result"})
+
+            except Exception as e:
+                trace.finish('error')
+                print(f"Error streaming document: {str(e)}")
+                print(traceback.format_exc())
+                yield sse('error', {
+                    'error': 'Failed to process document. Please try again.',
+                    'details': str(e) if os.getenv('FLASK_ENV') == 'development' else None
+                })
+            finally:
+                if prepared.source is not None:
+                    release_upload(upload['file_content'])
+                release_ticket(upload)
+
+        return Response(
+            events(),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                # Stop reverse proxies from buffering the stream
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+
+app = AsyncApp(flask_app)
@@ -0,0 +1,212 @@
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+# One converter per worker process, so its signature and template caches
+# are reused by every item the worker signs
+_converter = None
+
+
+def _sign_file(path: str, signature_data: str, position: str, signer_name: Optional[str]) -> bytes:
+    """
+    Sign one DOCX file
+
+    Runs in a worker process: the document is read from a memory-mapped
+    view of the spooled upload, so only the signed output crosses the
+    process boundary.
+    """
+    global _converter
+    if _converter is None:
+        from document_converter import DocumentConverter
+        _converter = DocumentConverter()
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _converter.add_signature(mapped, signature_data, position, signer_name)
+
+
+@dataclass
+class BatchItem:
+    """One document and signer of a batch"""
+    index: int
+    path: str
+    filename: str
+    signature_data: str
+    position: str = 'bottom-right'
+    signer_name: Optional[str] = None
+    output_name: str = ''
+
+
+class _ZipStream:
+    """Write-only sink for ZipFile whose output is drained as it is produced"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class BatchSigner:
+    """
+    Signs many documents, or one document for many signers, in one request
+
+    Items are signed on a process pool with a bounded number in flight, and
+    the signed files are written to a zip archive as each one finishes, so
+    neither the batch nor its output is ever held in memory at once. Items
+    that fail are listed in the archive's manifest.json instead of failing
+    the batch.
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_items: Optional[int] = None):
+        """
+        Initialize signer
+
+        Args:
+            workers: Processes used for signing (SIGN_BATCH_WORKERS, default:
+                CPU count up to 4; 1 signs in the request thread)
+            max_items: Largest accepted batch (SIGN_BATCH_MAX_ITEMS, default: 200)
+        """
+        self.workers = workers or int(os.getenv('SIGN_BATCH_WORKERS', min(4, os.cpu_count() or 1)))
+        self.max_items = max_items or int(os.getenv('SIGN_BATCH_MAX_ITEMS', 200))
+        # Enough queued work to keep every worker busy while a result is sent
+        self.max_in_flight = self.workers * 2
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """Process pool for signing, started on first use"""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    # spawn: forking a threaded gunicorn worker can copy held locks
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+        return self._pool
+
+    def _discard_pool(self, pool: ProcessPoolExecutor):
+        """Drop a pool a worker died in, so the next use starts a fresh one"""
+        with self._pool_lock:
+            # Another thread may have replaced it already
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    @staticmethod
+    def output_names(items: List[BatchItem], many_signers: bool):
+        """Give every item a unique file name in the archive"""
+        used = set()
+        for item in items:
+            base_name = os.path.splitext(os.path.basename(item.filename))[0] or 'document'
+            name = f"Signed_{base_name}"
+            if many_signers and item.signer_name:
+                name += '_' + re.sub(r'[^\w.-]+', '_', item.signer_name).strip('_')
+            candidate = name
+            counter = 2
+            while candidate in used:
+                candidate = f"{name}_{counter}"
+                counter += 1
+            used.add(candidate)
+            item.output_name = candidate + '.docx'
+
+    def results(self, items: List[BatchItem]) -> Iterator[Tuple[BatchItem, Optional[bytes], Optional[str]]]:
+        """
+        Sign items, yielding (item, signed bytes, None) or (item, None, error)
+        in the order they finish
+        """
+        if self.workers <= 1:
+            for item in items:
+                try:
+                    yield item, _sign_file(item.path, item.signature_data, item.position, item.signer_name), None
+                except Exception as e:
+                    yield item, None, str(e)
+            return
+
+        queue = iter(items)
+        pending = {}
+        try:
+            while True:
+                while len(pending) < self.max_in_flight:
+                    item = next(queue, None)
+                    if item is None:
+                        break
+                    pool = self.pool
+                    future = pool.submit(
+                        _sign_file, item.path, item.signature_data, item.position, item.signer_name
+                    )
+                    pending[future] = item, pool
+                if not pending:
+                    return
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, pool = pending.pop(future)
+                    try:
+                        yield item, future.result(), None
+                    except BrokenProcessPool as e:
+                        # A worker died; start a fresh pool for what is left
+                        self._discard_pool(pool)
+                        yield item, None, f"Signing worker failed: {str(e)}"
+                    except Exception as e:
+                        yield item, None, str(e)
+        finally:
+            # The client went away or the batch failed; drop queued work
+            for future in pending:
+                future.cancel()
+
+    def stream_zip(self, items: List[BatchItem]) -> Iterator[bytes]:
+        """
+        Sign items into a zip archive, yielding it piece by piece
+
+        The archive holds one signed file per successful item and a
+        manifest.json with the outcome of every item.
+        """
+        sink = _ZipStream()
+        manifest = []
+        # Signed DOCX files are already compressed
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for item, signed, error in self.results(items):
+                entry = {
+                    'index': item.index,
+                    'file': item.filename,
+                    'signer_name': item.signer_name,
+                    'position': item.position,
+                }
+                if error is None:
+                    archive.writestr(item.output_name, signed)
+                    entry.update(status='ok', output=item.output_name)
+                else:
+                    entry.update(status='failed', error=error)
+                manifest.append(entry)
+                yield sink.drain()
+
+            manifest.sort(key=lambda entry: entry['index'])
+            summary = {
+                'items': len(manifest),
+                'succeeded': sum(1 for entry in manifest if entry['status'] == 'ok'),
+                'failed': sum(1 for entry in manifest if entry['status'] != 'ok'),
+                'results': manifest,
+            }
+            archive.writestr('manifest.json', json.dumps(summary, indent=2),
+                             compress_type=zipfile.ZIP_DEFLATED)
+        yield sink.drain()
@@ -0,0 +1,121 @@
+"""
+Benchmark for admission control of enhancement requests
+
+Simulates one worker whose Gemini throughput (tokens per second) is shared
+by every enhancement in flight. Light clients keep sending small uploads;
+a heavy client sends a burst of large ones at once and retries the ones
+turned away after their Retry-After. Reports, with admission control off
+and on, how long the light clients' requests take, how many responses were
+429/503, and when the heavy client's last upload finished.
+
+Run from the backend folder:
+    python benchmarks/bench_admission.py
+"""
+
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, AdmissionRejected
+
+TOKENS_PER_SECOND = 200000
+HEAVY_UPLOADS = 40
+HEAVY_BYTES = 200 * 1024
+LIGHT_CLIENTS = 5
+LIGHT_BYTES = 8 * 1024
+LIGHT_INTERVAL = 0.25
+DURATION = 6.0
+HEAVY_AFTER = 0.5
+STEP = 0.01
+
+
+class SharedModel:
+    """Processes work at TOKENS_PER_SECOND split evenly over the calls in flight"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def call(self, tokens):
+        with self.lock:
+            self.active += 1
+        done = 0.0
+        while done < tokens:
+            time.sleep(STEP)
+            with self.lock:
+                done += TOKENS_PER_SECOND / self.active * STEP
+        with self.lock:
+            self.active -= 1
+
+
+def run(budget):
+    model = SharedModel()
+    controller = AdmissionController(budget=budget, max_wait=2)
+    latencies = {'heavy': [], 'light': []}
+    rejected = {429: 0, 503: 0}
+    lock = threading.Lock()
+
+    def request(client, kind, size):
+        started = time.perf_counter()
+        cost = controller.estimate(size, '.txt')
+        while True:
+            try:
+                ticket = controller.admit(client, cost)
+                break
+            except AdmissionRejected as e:
+                with lock:
+                    rejected[e.status_code] += 1
+                time.sleep(e.retry_after)
+        try:
+            model.call(cost)
+        finally:
+            if ticket is not None:
+                ticket.release()
+        with lock:
+            latencies[kind].append(time.perf_counter() - started)
+
+    threads = []
+
+    def light(client):
+        end = time.perf_counter() + DURATION
+        while time.perf_counter() < end:
+            thread = threading.Thread(target=request, args=(client, 'light', LIGHT_BYTES))
+            thread.start()
+            threads.append(thread)
+            time.sleep(LIGHT_INTERVAL)
+
+    senders = [threading.Thread(target=light, args=(f"light-{i}",)) for i in range(LIGHT_CLIENTS)]
+    for sender in senders:
+        sender.start()
+    time.sleep(HEAVY_AFTER)
+    heavy = [threading.Thread(target=request, args=('heavy', 'heavy', HEAVY_BYTES)) for _ in range(HEAVY_UPLOADS)]
+    began = time.perf_counter()
+    for thread in heavy:
+        thread.start()
+    for thread in heavy:
+        thread.join()
+    heavy_done = time.perf_counter() - began
+    for sender in senders:
+        sender.join()
+    for thread in threads:
+        thread.join()
+    return latencies, rejected, heavy_done
+
+
+def main():
+    print(f"{'admission':<22}{'light p50 s':>12}{'light p95 s':>12}{'light max s':>12}"
+          f"{'429':>6}{'503':>6}{'heavy burst done s':>20}")
+    for name, budget in (('off', 0), ('budget 400k tokens', 400000)):
+        latencies, rejected, heavy_done = run(budget)
+        light = sorted(latencies['light'])
+        p95 = light[min(len(light) - 1, int(len(light) * 0.95))]
+        print(f"{name:<22}{statistics.median(light):>12.2f}{p95:>12.2f}{light[-1]:>12.2f}"
+              f"{rejected[429]:>6}{rejected[503]:>6}{heavy_done:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Concurrency benchmark: the Flask app on threads vs the ASGI app on one loop
+
+Sends many /enhance requests at once (TXT uploads, fake Gemini model with a
+fixed latency) to one process, served either like a gunicorn gthread
+worker (the Flask app called from THREADS threads) or by asgi_app's
+AsyncApp on one event loop. Reports wall time, request latency (from the
+moment all requests were sent) and the most Gemini calls in flight at once.
+
+Run from the backend folder:
+    python benchmarks/bench_async.py [requests] [gemini latency seconds]
+"""
+
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+os.environ['GEMINI_RPM'] = '0'
+os.environ['ENHANCE_CACHE_MAX_BYTES'] = '0'
+os.environ['APP_WARM_UP'] = '0'
+
+from fake_gemini import FakeModel, make_fake_client
+
+THREADS = 8
+
+
+class CountingModel(FakeModel):
+    """FakeModel that records the most calls in flight at once"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.active = 0
+        self.peak = 0
+
+    def _enter(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def _exit(self):
+        with self._lock:
+            self.active -= 1
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        self._enter()
+        try:
+            return super().generate_content(prompt, generation_config, stream)
+        finally:
+            self._exit()
+
+    async def generate_content_async(self, prompt, generation_config=None, stream=False):
+        self._enter()
+        try:
+            return await super().generate_content_async(prompt, generation_config, stream)
+        finally:
+            self._exit()
+
+
+def multipart(filename, data):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def documents(count):
+    return [f"Report {i}\n\nMeasured E = mc^2 in run {i}.\n".encode() for i in range(count)]
+
+
+def fresh_app(latency):
+    """A new Flask app whose Gemini client uses a CountingModel"""
+    from app import create_app
+    flask_app = create_app()
+    client = make_fake_client(base_latency=latency, latency_per_1k_tokens=0)
+    client.model = CountingModel(base_latency=latency, latency_per_1k_tokens=0)
+    flask_app.extensions['services'].override(gemini_client=client)
+    return flask_app, client.model
+
+
+def run_threads(count, latency):
+    flask_app, model = fresh_app(latency)
+    client = flask_app.test_client()
+
+    def one(data):
+        response = client.post('/enhance', data={'file': (io.BytesIO(data), 'doc.txt')})
+        response.get_data()
+        response.close()
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        results = list(pool.map(one, documents(count)))
+    return time.perf_counter() - start, results, model.peak
+
+
+def run_async(count, latency):
+    from asgi_app import AsyncApp
+    flask_app, model = fresh_app(latency)
+    application = AsyncApp(flask_app)
+
+    async def one(data):
+        body, content_type = multipart('doc.txt', data)
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/enhance', 'query_string': b'',
+            'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+        }
+        received = []
+        status = {}
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+
+        await application(scope, receive, send)
+        return time.perf_counter() - start, status['code']
+
+    async def main():
+        results = await asyncio.gather(*(one(data) for data in documents(count)))
+        return time.perf_counter() - start, results
+
+    start = time.perf_counter()
+    elapsed, results = asyncio.run(main())
+    return elapsed, results, model.peak
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    print(f"{count} concurrent /enhance requests, fake Gemini latency {latency:g}s, {os.cpu_count()} CPU(s)\n")
+    print(f"{'mode':<22}{'wall s':>8}{'req/s':>8}{'p50 s':>8}{'p95 s':>8}{'peak Gemini':>13}  statuses")
+
+    stdout = sys.stdout
+    for name, run in ((f'Flask, {THREADS} threads', run_threads), ('ASGI, one event loop', run_async)):
+        # Keep the pipeline's per-request logging out of the table
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            elapsed, results, peak = run(count, latency)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        latencies = sorted(seconds for seconds, _ in results)
+        statuses = sorted({code for _, code in results})
+        print(f"{name:<22}{elapsed:>8.2f}{count / elapsed:>8.1f}{statistics.median(latencies):>8.2f}"
+              f"{latencies[int(len(latencies) * 0.95) - 1]:>8.2f}{peak:>13}  {statuses}")
+
+
+if __name__ == "__main__":
+    main()
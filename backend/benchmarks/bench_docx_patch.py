@@ -0,0 +1,119 @@
+"""
+Benchmark for writing enhanced text back into uploaded DOCX files
+
+Builds uploads of growing size with styled paragraphs, tables and embedded
+images, edits a fifth of their paragraphs the way an enhancement would, and
+produces the output two ways: rebuilt from the enhanced text (as before
+patching, losing images and styles) and patched into the upload. Also
+times loading and saving the upload with python-docx, the least any
+formatting-preserving edit through python-docx costs. Reports time, output
+size and how many of the upload's zip parts come back unchanged.
+
+Run from the backend folder:
+    python benchmarks/bench_docx_patch.py
+"""
+
+import io
+import os
+import random
+import struct
+import sys
+import time
+import zipfile
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+from docx.shared import Inches
+
+from document_blocks import parse_blocks
+from document_converter import DocumentConverter
+
+WORDS = ("the report shows that regional offices shared their findings before "
+         "planning and agreed to review quarterly targets with each team").split()
+
+
+def png(width, height, seed):
+    """An incompressible RGB PNG, like a photo"""
+    rng = random.Random(seed)
+    rows = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def make_upload(paragraphs, images, seed=0):
+    rng = random.Random(seed)
+    doc = Document()
+    doc.sections[0].header.paragraphs[0].text = "Regional planning report"
+    for i in range(paragraphs):
+        if i % 25 == 0:
+            doc.add_heading(f"Section {i // 25 + 1}", 1)
+        paragraph = doc.add_paragraph(' '.join(rng.choice(WORDS) for _ in range(20)) + ' ')
+        paragraph.add_run(' '.join(rng.choice(WORDS) for _ in range(5))).bold = True
+        if images and i % max(1, paragraphs // images) == 0:
+            doc.add_picture(io.BytesIO(png(300, 200, i)), width=Inches(3))
+        if i % 50 == 10:
+            table = doc.add_table(rows=2, cols=3)
+            for cell in table._cells:
+                cell.text = ' '.join(rng.choice(WORDS) for _ in range(3))
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def enhance(text, seed=0):
+    """Edit one paragraph in five: a word changed and a clause added"""
+    rng = random.Random(seed)
+    paragraphs = text.split('\n\n')
+    for i in range(0, len(paragraphs), 5):
+        words = paragraphs[i].split()
+        if len(words) > 3:
+            words[rng.randrange(len(words))] = 'carefully'
+            paragraphs[i] = ' '.join(words) + ', as planned.'
+    return '\n'.join(paragraphs)
+
+
+def best_time(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def unchanged_parts(original, output):
+    with zipfile.ZipFile(io.BytesIO(original)) as before, zipfile.ZipFile(io.BytesIO(output)) as after:
+        names = set(after.namelist())
+        same = sum(1 for name in before.namelist() if name in names and before.read(name) == after.read(name))
+        return same, len(before.namelist())
+
+
+def main():
+    converter = DocumentConverter(pdf_workers=1)
+    print(f"{'upload':<38}{'rebuild s':>10}{'python-docx s':>15}{'patch s':>9}"
+          f"{'rebuilt KB':>12}{'patched KB':>12}{'parts kept (rebuild/patch)':>28}")
+    for paragraphs, images in ((200, 5), (2000, 20), (5000, 60)):
+        upload = make_upload(paragraphs, images)
+        text, source = converter.extract(upload, '.docx')
+        blocks = parse_blocks(enhance(text))
+
+        rebuild_time, rebuilt = best_time(lambda: converter.docx_renderer.render(blocks))
+        patch_time, patched = best_time(lambda: converter.docx_patcher.patch(upload, source, blocks))
+        python_docx_time, _ = best_time(lambda: Document(io.BytesIO(upload)).save(io.BytesIO()))
+        kept_rebuild, total = unchanged_parts(upload, rebuilt)
+        kept_patch, _ = unchanged_parts(upload, patched)
+
+        name = f"{paragraphs} paragraphs, {images} images ({len(upload) // 1024} KB)"
+        print(f"{name:<38}{rebuild_time:>10.3f}{python_docx_time:>15.3f}{patch_time:>9.3f}"
+              f"{len(rebuilt) // 1024:>12}{len(patched) // 1024:>12}"
+              f"{f'{kept_rebuild}/{total}  {kept_patch}/{total}':>28}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark for DOCX generation in DocumentConverter._create_docx
+
+Compares the block-model renderer against the previous per-line
+add_paragraph/add_heading/add_run implementation, and checks that both
+produce the same word/document.xml.
+
+Run from the backend folder:
+    python benchmarks/bench_docx_render.py
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.shared import Pt
+
+from document_converter import DocumentConverter
+
+
+def legacy_add_latex_paragraph(doc, line):
+    if '$$' in line:
+        equation_match = re.search(r'\$\$(.*?)\$\$', line)
+        if equation_match:
+            equation_text = equation_match.group(1).strip()
+            para = doc.add_paragraph()
+            para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            run = para.add_run(equation_text)
+            run.font.name = 'Cambria Math'
+            run.font.size = Pt(12)
+            run.italic = True
+    else:
+        para = doc.add_paragraph()
+        parts = line.split('$')
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                if part:
+                    para.add_run(part)
+            else:
+                run = para.add_run(part)
+                run.font.name = 'Cambria Math'
+                run.italic = True
+
+
+def legacy_create_docx(content, include_latex=False):
+    """_create_docx as it was before the block-model renderer"""
+    doc = Document()
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Calibri'
+    font.size = Pt(11)
+
+    for line in content.split('\n'):
+        line = line.strip()
+        if not line:
+            doc.add_paragraph()
+            continue
+        if line.isupper() and len(line.split()) <= 10:
+            doc.add_heading(line, level=1)
+        elif line.startswith('# '):
+            heading_text = line.replace('#', '').strip()
+            heading_level = min(len(line) - len(line.lstrip('#')), 3)
+            doc.add_heading(heading_text, level=heading_level)
+        elif include_latex and ('$' in line):
+            legacy_add_latex_paragraph(doc, line)
+        else:
+            para = doc.add_paragraph(line)
+            if line.startswith('- ') or line.startswith('• '):
+                para.style = 'List Bullet'
+                para.text = line[2:].strip()
+            elif re.match(r'^\d+\.', line):
+                para.style = 'List Number'
+                para.text = re.sub(r'^\d+\.\s*', '', line)
+
+    output_buffer = io.BytesIO()
+    doc.save(output_buffer)
+    return output_buffer.getvalue()
+
+
+SAMPLE_LINES = [
+    "# Results & Discussion",
+    "INTRODUCTION",
+    "",
+    "The model converges quickly when the step size is small <see below>.",
+    "- First observation about the data",
+    "• Second observation\twith a tab",
+    "1. Collect the samples",
+    "2.Measure the response",
+    "The energy is $E = mc^2$ and the momentum is $p = mv$ here.",
+    "$$\\int_0^\\infty e^{-x} dx = 1$$",
+    "Empty math $$ markers $ $ inline",
+    "  padded line with trailing spaces  ",
+]
+
+
+def make_content(lines):
+    return "\n".join(SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(lines))
+
+
+def document_xml(docx_bytes):
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as z:
+        return z.read('word/document.xml')
+
+
+def best_time(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    converter = DocumentConverter()
+
+    print(f"{'lines':>8}{'legacy s':>10}{'new s':>9}{'speedup':>9}  identical document.xml")
+    for lines in (1000, 10000, 30000):
+        content = make_content(lines)
+        legacy_time, legacy_docx = best_time(lambda: legacy_create_docx(content, True), repeat=1)
+        new_time, new_docx = best_time(lambda: converter._create_docx(content, True))
+        identical = document_xml(legacy_docx) == document_xml(new_docx)
+        print(f"{lines:>8}{legacy_time:>10.3f}{new_time:>9.3f}{legacy_time / new_time:>8.1f}x  {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of re-enhancing an edited document
+
+Uploads a TXT document, then uploads it again with one paragraph edited and
+with 10% of its paragraphs edited, through EnhancementPipeline.run with a
+fake Gemini model whose latency grows with the output. Each upload is run
+with the section cache (only changed sections are sent) and without it
+(ENHANCE_SECTION_CACHE=0: the whole document is sent again). Reports the
+Gemini calls, estimated prompt tokens and latency of each upload.
+
+Run from the backend folder:
+    python benchmarks/bench_incremental.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['GEMINI_RPM'] = '0'
+os.environ.pop('ENHANCE_CACHE_DB', None)
+
+from corpus import CorpusSpec, make_txt
+from fake_gemini import make_fake_client
+from metrics import RequestTrace
+from services import Services
+
+
+def edited(text, fraction, seed):
+    """The text with a fraction of its paragraphs (at least one) changed"""
+    paragraphs = text.split('\n\n')
+    rng = random.Random(seed)
+    for i in rng.sample(range(len(paragraphs)), max(1, int(len(paragraphs) * fraction))):
+        paragraphs[i] += ' This sentence was added in review.'
+    return '\n\n'.join(paragraphs)
+
+
+def pipeline(section_cache):
+    os.environ['ENHANCE_SECTION_CACHE'] = '1' if section_cache else '0'
+    services = Services()
+    services.override(gemini_client=make_fake_client(base_latency=0.2, latency_per_1k_tokens=0.5))
+    return services
+
+
+def upload(services, text):
+    model = services.gemini_client.model
+    calls = model.calls
+    trace = RequestTrace()
+    start = time.perf_counter()
+    services.pipeline.run(text.encode('utf-8'), '.txt', trace=trace)
+    return {
+        'calls': model.calls - calls,
+        'tokens': trace.fields.get('prompt_tokens', 0),
+        'ms': (time.perf_counter() - start) * 1000,
+        'reused': f"{trace.fields.get('sections_reused', '-')}/{trace.fields.get('sections', '-')}",
+    }
+
+
+def main():
+    print(f"{'document':<10}{'upload':<22}{'section cache':>14}{'sections reused':>17}"
+          f"{'calls':>7}{'prompt tokens':>15}{'ms':>9}")
+    stdout = sys.stdout
+    for name, lines in (('small', 40), ('medium', 300), ('large', 2000)):
+        original = make_txt(CorpusSpec(name, '.txt', lines, seed=7)).decode('utf-8')
+        versions = [
+            ('first upload', original),
+            ('1 paragraph edited', edited(original, 0, seed=1)),
+            ('10% paragraphs edited', edited(original, 0.1, seed=2)),
+        ]
+        for section_cache in (False, True):
+            services = pipeline(section_cache)
+            for label, text in versions:
+                # Keep the pipeline's per-request logging out of the table
+                sys.stdout = open(os.devnull, 'w')
+                try:
+                    result = upload(services, text)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                print(f"{name:<10}{label:<22}{'on' if section_cache else 'off':>14}{result['reused']:>17}"
+                      f"{result['calls']:>7}{result['tokens']:>15}{result['ms']:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Benchmark for LaTeX post-processing of enhanced text
+
+Compares the single-pass scan (LaTeXProcessor.normalize followed by
+parse_blocks on its spans) against the previous chain: four re.sub passes in
+process_latex_content, two finditer passes in extract_latex_equations and
+parse_blocks splitting every line on '$'. Inputs are multi-MB enhanced
+outputs with inline and display equations.
+
+Run from the backend folder:
+    python benchmarks/bench_latex_scan.py
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_blocks import NUMBERED_ITEM, Block, parse_blocks
+from latex_processor import LaTeXProcessor
+
+PROSE = (
+    "The committee reviewed the quarterly report and agreed that the regional "
+    "offices should share their findings before the next planning meeting."
+)
+INLINE = [
+    "The energy follows $E = mc^2$ for every sample, with $m$ in kilograms.",
+    "For the triangle $a^2 + b^2 = c^2$ holds, and $\\sin^2\\theta + \\cos^2\\theta = 1$.",
+    "The mean is $\\bar{x} = \\frac{1}{n}\\sum_i x_i$ and costs \\$5 per run.",
+]
+DISPLAY_MATH = re.compile(r'\$\$(.*?)\$\$')
+
+DISPLAY = [
+    "$$\\int_a^b f(x)\\,dx = F(b) - F(a)$$",
+    "$$\\sigma = \\sqrt{\\frac{1}{n}\\sum_{i=1}^{n} (x_i - \\bar{x})^2}$$",
+    "\\[\n\\nabla \\cdot \\mathbf{E} = \\frac{\\rho}{\\varepsilon_0}\n\\]",
+]
+
+
+def legacy_process(content):
+    """process_latex_content as it was before the single-pass scan"""
+    content = re.sub(r'(\S)\$', r'\1 $', content)
+    content = re.sub(r'\$(\S)', r'$ \1', content)
+    content = re.sub(r'(\S)\$\$', r'\1\n$$', content)
+    content = re.sub(r'\$\$(\S)', r'$$\n\1', content)
+    return content
+
+
+def legacy_equations(content):
+    """extract_latex_equations as it was before the single-pass scan"""
+    equations = []
+    for match in re.finditer(r'\$\$(.*?)\$\$', content, re.DOTALL):
+        equations.append(('display', match.group(1).strip()))
+    for match in re.finditer(r'(?<!\$)\$(?!\$)(.*?)(?<!\$)\$(?!\$)', content):
+        equations.append(('inline', match.group(1).strip()))
+    return equations
+
+
+def legacy_blocks(content, include_latex=True):
+    """parse_blocks as it was before it used the scan's spans"""
+    blocks = []
+    append = blocks.append
+
+    for line in content.split('\n'):
+        line = line.strip()
+
+        if not line:
+            append(Block('empty'))
+            continue
+
+        if line.isupper() and len(line.split()) <= 10:
+            append(Block('heading', line, level=1))
+        elif line.startswith('# '):
+            heading_level = min(len(line) - len(line.lstrip('#')), 3)
+            append(Block('heading', line.replace('#', '').strip(), level=heading_level))
+        elif include_latex and ('$' in line):
+            if '$$' in line:
+                equation_match = DISPLAY_MATH.search(line)
+                if equation_match:
+                    append(Block('display_math', equation_match.group(1).strip()))
+            else:
+                segments = [(i % 2 == 1, part) for i, part in enumerate(line.split('$'))]
+                append(Block('math_paragraph', line, segments=segments))
+        elif line.startswith('- ') or line.startswith('• '):
+            append(Block('bullet', line[2:].strip()))
+        else:
+            numbered = NUMBERED_ITEM.match(line)
+            if numbered:
+                append(Block('number', line[numbered.end():]))
+            else:
+                append(Block('paragraph', line))
+
+    return blocks
+
+
+def legacy(content):
+    processed = legacy_process(content)
+    return legacy_equations(processed), legacy_blocks(processed)
+
+
+def single_pass(content, processor=LaTeXProcessor()):
+    latex = processor.normalize(content)
+    return latex.equations, parse_blocks(latex.text, True, latex.spans)
+
+
+def make_output(size, math_share, seed=0):
+    """Enhanced-looking text of about `size` characters, math_share of its lines with equations"""
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        roll = rng.random()
+        if roll < math_share * 0.7:
+            line = rng.choice(INLINE)
+        elif roll < math_share:
+            line = rng.choice(DISPLAY)
+        else:
+            line = PROSE
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)
+
+
+def best_time(fn, text, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    cases = [
+        ("1 MB, 10% math lines", make_output(1024 * 1024, 0.1)),
+        ("1 MB, math-heavy", make_output(1024 * 1024, 0.8)),
+        ("5 MB, math-heavy", make_output(5 * 1024 * 1024, 0.8)),
+        ("10 MB, math-heavy", make_output(10 * 1024 * 1024, 0.8)),
+    ]
+
+    print(f"{'input':<24}{'legacy s':>10}{'single pass s':>15}{'speedup':>10}"
+          f"{'equations (legacy/new)':>26}")
+    for name, text in cases:
+        legacy_time = best_time(legacy, text)
+        new_time = best_time(single_pass, text)
+        legacy_count = len(legacy(text)[0])
+        new_count = len(single_pass(text)[0])
+        print(f"{name:<24}{legacy_time:>10.3f}{new_time:>15.3f}{legacy_time / new_time:>9.1f}x"
+              f"{f'{legacy_count}/{new_count}':>26}")
+
+
+if __name__ == "__main__":
+    main()
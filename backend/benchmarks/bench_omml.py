@@ -0,0 +1,93 @@
+"""
+Benchmark for native equation (OMML) rendering in DOCX output
+
+Renders math-heavy enhanced outputs, in which the same expressions recur,
+three ways: equations as LaTeX text runs (before OMML), OMML with the
+compiled-equation cache disabled, and OMML with the cache (first document,
+then the same document again).
+
+Run from the backend folder:
+    python benchmarks/bench_omml.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_blocks import parse_blocks
+from docx_renderer import DocxRenderer
+from omml_converter import OmmlConverter
+
+EXPRESSIONS = [
+    "E = mc^2",
+    "\\frac{a+b}{2}",
+    "\\sqrt{x^2 + y^2}",
+    "\\sum_{i=1}^{n} x_i^2",
+    "\\int_a^b f(x)\\,dx = F(b) - F(a)",
+    "\\alpha + \\beta \\leq \\gamma",
+    "\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}",
+    "\\lim_{x \\to 0} \\frac{\\sin x}{x} = 1",
+    "\\sigma = \\sqrt{\\frac{1}{n}\\sum_{i=1}^{n} (x_i - \\bar{x})^2}",
+]
+
+
+def make_output(lines, seed=0):
+    """Enhanced text alternating prose with inline and display equations"""
+    rng = random.Random(seed)
+    out = []
+    for i in range(lines):
+        expression = rng.choice(EXPRESSIONS)
+        if i % 3 == 0:
+            out.append(f"$${expression}$$")
+        else:
+            out.append(f"Here ${rng.choice(['x', 'n', 'k'])}$ is given by ${expression}$ in each case.")
+    return '\n'.join(out)
+
+
+class TextRunRenderer(DocxRenderer):
+    """Equations as LaTeX text in Cambria Math, as before OMML"""
+
+    def __init__(self):
+        super().__init__(OmmlConverter(cache_size=0))
+        self.omml_converter.convert = lambda latex: None
+
+
+def best_time(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'document':<24}{'text runs s':>12}{'OMML, no cache s':>18}"
+          f"{'OMML cold s':>13}{'OMML warm s':>13}{'hit rate':>10}")
+    for lines in (1000, 10000, 30000):
+        blocks = parse_blocks(make_output(lines), include_latex=True)
+        equations = sum(1 if b.kind == 'display_math' else sum(m for m, _ in b.segments) for b in blocks)
+
+        text_runs = best_time(lambda: TextRunRenderer().render(blocks))
+        uncached = best_time(lambda: DocxRenderer(OmmlConverter(cache_size=0)).render(blocks))
+
+        def cold():
+            renderer = DocxRenderer(OmmlConverter())
+            renderer.render(blocks)
+            return renderer
+
+        cold_time = best_time(cold)
+        renderer = cold()
+        warm_time = best_time(lambda: renderer.render(blocks))
+        stats = renderer.omml_converter.stats
+        hit_rate = stats['hits'] / (stats['hits'] + stats['misses'])
+
+        print(f"{f'{lines} lines, {equations} eq':<24}{text_runs:>12.3f}{uncached:>18.3f}"
+              f"{cold_time:>13.3f}{warm_time:>13.3f}{hit_rate:>9.1%}")
+
+
+if __name__ == "__main__":
+    main()
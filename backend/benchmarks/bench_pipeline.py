@@ -0,0 +1,313 @@
+"""
+End-to-end benchmark of the document pipeline with a fake Gemini model
+
+Runs extract → detect → prompt → enhance → render through /enhance and then
+signs the output through /add-signature, all via the Flask test client and
+with FakeModel in place of Gemini (no API key or network needed). Reports:
+- p50/p95/p99 latency and requests per second, sequential and under
+  concurrent load
+- p50/p95/p99 time per pipeline stage, from the request traces
+- peak Python memory of each stage run in isolation (tracemalloc)
+
+Results can be saved as a baseline and later runs compared against it.
+
+Run from the backend folder:
+    python benchmarks/bench_pipeline.py --save-baseline /tmp/pipeline_baseline.json
+    python benchmarks/bench_pipeline.py --baseline /tmp/pipeline_baseline.json
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import default_specs, make_document
+from fake_gemini import FakeModel
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies):
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def make_signature_png(width=300, height=100):
+    """Opaque RGB PNG of a dark stroke on white, like a drawn signature"""
+    rows = []
+    for y in range(height):
+        row = bytearray(b'\x00')
+        for x in range(width):
+            on_stroke = abs(y - height // 2 - int(20 * ((x % 60) / 30 - 1))) < 3
+            row += b'\x10\x10\x40' if on_stroke else b'\xff\xff\xff'
+        rows.append(bytes(row))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(b''.join(rows)))
+            + chunk(b'IEND', b''))
+
+
+def setup_app(args):
+    """Import the app against a fake model, with caching out of the way"""
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    os.environ['GEMINI_RPM'] = '0'
+    os.environ['ENHANCE_CACHE_MAX_BYTES'] = '0'
+    os.environ.pop('ENHANCE_CACHE_DB', None)
+    os.environ.pop('METRICS_DIR', None)
+    os.environ['JOB_WORKERS'] = str(max(args.concurrency))
+    os.environ['JOB_MAX_PENDING'] = str(max(args.concurrency) * 4)
+    os.environ['JOB_STORE_DIR'] = tempfile.mkdtemp(prefix='bench_jobs_')
+
+    import app as backend_app
+    import metrics
+
+    backend_app.gemini_client.model = FakeModel(
+        mode='latex',
+        base_latency=args.latency,
+        latency_per_1k_tokens=args.latency_per_1k,
+        jitter=0.1
+    )
+
+    # Keep the spans of every finished request
+    traces = []
+    lock = threading.Lock()
+    finish = metrics.RequestTrace.finish
+
+    def capture(trace, outcome):
+        with lock:
+            traces.append(dict(trace.spans))
+        finish(trace, outcome)
+
+    metrics.RequestTrace.finish = capture
+    return backend_app, traces
+
+
+def run_one(client, spec, data, signature, run):
+    """POST one document to /enhance and sign the result; returns (enhance, sign) seconds"""
+    start = time.perf_counter()
+    response = client.post('/enhance', data={
+        'file': (io.BytesIO(data), spec.name + spec.file_ext),
+        # A distinct prompt per run keeps the result cache out of the measurement
+        'prompt': f"benchmark run {run}",
+        'doc_type': 'technical',
+    })
+    output = response.get_data()
+    response.close()
+    enhance_seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"{spec.name}{spec.file_ext}: /enhance returned {response.status_code}")
+
+    sign_seconds = None
+    if response.mimetype == DOCX_MIMETYPE:
+        start = time.perf_counter()
+        response = client.post('/add-signature', data={
+            'file': (io.BytesIO(output), 'enhanced.docx'),
+            'signature': signature,
+            'signer_name': 'Benchmark',
+        })
+        response.get_data()
+        response.close()
+        sign_seconds = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"{spec.name}{spec.file_ext}: /add-signature returned {response.status_code}")
+    return enhance_seconds, sign_seconds
+
+
+def run_load(backend_app, documents, signature, requests_per_doc, concurrency):
+    """Send every document requests_per_doc times with the given concurrency"""
+    work = [(spec, data, run) for run in range(requests_per_doc) for spec, data in documents]
+    local = threading.local()
+
+    def task(item):
+        if not hasattr(local, 'client'):
+            local.client = backend_app.app.test_client()
+        spec, data, run = item
+        return run_one(local.client, spec, data, signature, f"{concurrency}-{run}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(task, work))
+    wall = time.perf_counter() - start
+
+    enhance = [e for e, _ in results]
+    sign = [s for _, s in results if s is not None]
+    return {
+        'requests': len(results),
+        'rps': round(len(results) / wall, 2),
+        'enhance': summarize(enhance),
+        'sign': summarize(sign),
+    }, sign
+
+
+def stage_memory(backend_app, documents, signature_data):
+    """Peak traced memory of each stage, run in isolation on every document"""
+    converter = backend_app.doc_converter
+    latex = backend_app.latex_processor
+    peaks = {}
+
+    def measure(stage, fn):
+        tracemalloc.start()
+        try:
+            result = fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        peaks[stage] = max(peaks.get(stage, 0), peak)
+        return result
+
+    for spec, data in documents:
+        text = measure('extract_text', lambda: converter.extract_text(data, spec.file_ext))
+        has_math = bool(measure('detect_math', lambda: latex.detect_mathematical_content(text)))
+        plan = measure('prompt_build', lambda: backend_app.prompt_planner.plan(text, '', 'technical', has_math))
+        enhanced = measure('gemini', lambda: backend_app.chunked_enhancer.enhance(
+            text, '', 'technical', has_math, plan=plan
+        ))
+        processed = measure('process_latex', lambda: latex.process_latex_content(enhanced))
+        output_format = backend_app.pipeline.output_format_for(spec.file_ext)
+        output = measure('render_document', lambda: converter.create_document(
+            processed, spec.file_ext, output_format, has_math
+        ))
+        if output_format == '.docx':
+            measure('sign', lambda: converter.add_signature(output, signature_data, signer_name='Benchmark'))
+
+    return {stage: round(peak / 1024, 1) for stage, peak in peaks.items()}
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing changes against the baseline; regressions are flagged"""
+    lines = []
+    regressions = 0
+
+    def walk(current, previous, path):
+        nonlocal regressions
+        for key, value in current.items():
+            if key not in previous:
+                continue
+            if isinstance(value, dict):
+                walk(value, previous[key], path + [key])
+            elif isinstance(value, (int, float)) and previous[key]:
+                change = (value - previous[key]) / previous[key]
+                higher_is_better = key == 'rps'
+                worse = -change if higher_is_better else change
+                flag = ''
+                if worse > tolerance:
+                    flag = '  << regression'
+                    regressions += 1
+                elif worse < -tolerance:
+                    flag = '  (improved)'
+                lines.append(f"{'.'.join(path + [key]):<45} {previous[key]:>10} -> {value:>10} ({change:+.0%}){flag}")
+
+    for section in ('load', 'stages', 'memory_kb'):
+        walk(results.get(section, {}), baseline.get(section, {}), [section])
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2, help='requests per document per load level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--latency', type=float, default=0.05, help='fake model base latency (s)')
+    parser.add_argument('--latency-per-1k', type=float, default=0.02, help='fake model latency per 1k tokens (s)')
+    parser.add_argument('--scale', type=float, default=1.0, help='corpus size multiplier')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--save-baseline', help='write results as the baseline')
+    parser.add_argument('--baseline', help='compare against this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    backend_app, traces = setup_app(args)
+    specs = default_specs(args.scale)
+    documents = [(spec, make_document(spec)) for spec in specs]
+    png = make_signature_png()
+    signature = 'data:image/png;base64,' + base64.b64encode(png).decode()
+
+    print(f"Corpus: {len(documents)} documents, "
+          f"{sum(len(d) for _, d in documents) / 1024:.0f} KB total")
+
+    # The app logs every prompt plan; keep the report readable
+    quiet = contextlib.redirect_stdout(io.StringIO())
+
+    # One untimed pass warms imports, pools and the renderers
+    with quiet:
+        run_load(backend_app, documents[:3], signature, 1, 1)
+    traces.clear()
+
+    results = {'load': {}, 'stages': {}, 'memory_kb': {}}
+    sign_seconds = []
+    print(f"\n{'concurrency':>11} {'req':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'sign p95':>9}")
+    for concurrency in args.concurrency:
+        with contextlib.redirect_stdout(io.StringIO()):
+            load, sign = run_load(backend_app, documents, signature, args.requests, concurrency)
+        sign_seconds.extend(sign)
+        results['load'][f"c{concurrency}"] = load
+        e = load['enhance']
+        print(f"{concurrency:>11} {load['requests']:>5} {load['rps']:>8} {e['p50_ms']:>9} "
+              f"{e['p95_ms']:>9} {e['p99_ms']:>9} {load['sign']['p95_ms']:>9}")
+
+    stages = {'sign': sign_seconds}
+    for spans in traces:
+        for stage, seconds in spans.items():
+            stages.setdefault(stage, []).append(seconds)
+    print(f"\n{'stage':<16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KB':>10}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        memory = stage_memory(backend_app, documents, signature)
+    for stage in ('upload_read', 'extract_text', 'detect_math', 'prompt_build', 'gemini',
+                  'process_latex', 'render_document', 'response_send', 'sign'):
+        summary = summarize(stages.get(stage, []))
+        if stage in stages:
+            results['stages'][stage] = summary
+        if stage in memory:
+            results['memory_kb'][stage] = memory[stage]
+        print(f"{stage:<16} {summary['p50_ms']:>9} {summary['p95_ms']:>9} {summary['p99_ms']:>9} "
+              f"{memory.get(stage, ''):>10}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"\nResults written to {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print(f"\nAgainst baseline {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for line in lines:
+            print(line)
+        print(f"{regressions} regression(s)")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark for model routing and hedged Gemini calls
+
+Sends a mix of documents (short cover letters, and long or math-heavy
+reports) through the async client against two stub models: a slower
+"quality" one and a faster one, both with a long tail (a few calls stall
+for many times their usual latency, as overloaded backends do). Reports
+per-document-kind p50/p95/p99 latency and model calls made with everything
+on the quality model, with routing, and with routing and hedging.
+
+Run from the backend folder:
+    python benchmarks/bench_routing.py
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemini_client import GeminiClient
+from model_router import ModelRouter, Route
+from prompt_planner import estimate_tokens
+from rate_limiter import RateLimiter
+from single_flight import SingleFlight
+
+DOCUMENTS = 400
+CONCURRENCY = 32
+TAIL_SHARE = 0.05
+TAIL_FACTOR = 10
+
+
+class StubModel:
+    """Answers after seconds_per_1k_tokens of the output budget, stalling TAIL_FACTOR times longer now and then"""
+
+    def __init__(self, seconds_per_1k_tokens, seed):
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, generation_config=None, stream=False):
+        self.calls += 1
+        tokens = generation_config['max_output_tokens']
+        delay = self.seconds_per_1k_tokens * tokens / 1000 * self.rng.uniform(0.8, 1.2)
+        if self.rng.random() < TAIL_SHARE:
+            delay *= TAIL_FACTOR
+        await asyncio.sleep(delay)
+        return SimpleNamespace(text=prompt[:tokens * 4])
+
+
+def documents():
+    rng = random.Random(0)
+    docs = []
+    for i in range(DOCUMENTS):
+        if rng.random() < 0.7:
+            docs.append(('letter', "Dear hiring manager, " * 40, 'auto', False))
+        else:
+            docs.append(('report', "The integral of f over the domain is bounded. " * 200, 'academic', True))
+    return docs
+
+
+async def run(routing, hedge):
+    quality, fast = StubModel(0.2, 1), StubModel(0.05, 2)
+    routes = [Route('quality', 'pro', 8192)] + ([Route('fast', 'flash', 8192)] if routing else [])
+    router = ModelRouter(routes, hedge=hedge, latency_budget=5.0)
+    client = GeminiClient(
+        models={'quality': quality, 'fast': fast}, router=router,
+        rate_limiter=RateLimiter(requests_per_minute=0), single_flight=SingleFlight(enabled=False),
+        async_max_in_flight=CONCURRENCY * 2
+    )
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = {'letter': [], 'report': []}
+
+    async def enhance(kind, text, doc_type, include_latex):
+        input_tokens = estimate_tokens(text)
+        output_tokens = min(8192, int(input_tokens * (1.5 if include_latex else 1.25)) + 256)
+        route = router.choose(input_tokens, output_tokens, doc_type, include_latex)
+        async with semaphore:
+            started = time.perf_counter()
+            await client.enhance_content_async(f"[{len(latencies[kind])}] {text}", output_tokens, route=route.name)
+            latencies[kind].append(time.perf_counter() - started)
+
+    await asyncio.gather(*(enhance(*doc) for doc in documents()))
+    return latencies, quality.calls + fast.calls
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    print(f"{'mode':<20}{'kind':<8}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'model calls':>13}")
+    for name, routing, hedge in (('quality model only', False, False), ('routed', True, False),
+                                 ('routed + hedged', True, True)):
+        latencies, calls = asyncio.run(run(routing, hedge))
+        for kind, values in latencies.items():
+            print(f"{name:<20}{kind:<8}{percentile(values, 0.5):>8.2f}{percentile(values, 0.95):>8.2f}"
+                  f"{percentile(values, 0.99):>8.2f}{calls:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Benchmark for DocumentConverter.add_signature
+
+Signs copies of one template with one signature, comparing the python-docx
+path (load the whole document, add the picture, save) against the signature
+stamper (patch document.xml, rels and media in the zip, copy the rest). A
+plain copy of the file's bytes is shown as the I/O-bound reference. Also
+checks that the stamper leaves every other zip entry byte-identical.
+
+Then signs one document for many signers, one add_signature call at a time
+against BatchSigner's streamed archive on its process pool.
+
+Run from the backend folder:
+    python benchmarks/bench_signature.py
+"""
+
+import base64
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from docx import Document
+from docx.shared import Inches
+
+from batch_signer import BatchItem, BatchSigner
+from bench_pipeline import make_signature_png
+from corpus import CorpusSpec, make_docx
+from document_converter import DocumentConverter
+from zip_parts import read_local_data
+
+
+def with_images(docx_bytes, count, size=256 * 1024):
+    """The document with incompressible images added, like a scanned appendix"""
+    doc = Document(io.BytesIO(docx_bytes))
+    for i in range(count):
+        png = make_signature_png(width=400, height=200)
+        # A private chunk of random bytes makes each image distinct and large
+        noise = os.urandom(size)
+        chunk = len(noise).to_bytes(4, 'big') + b'ruNd' + noise + b'\x00\x00\x00\x00'
+        doc.add_picture(io.BytesIO(png[:-12] + chunk + png[-12:]), width=Inches(3))
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def untouched_entries_identical(original, signed):
+    """Entries other than the patched parts keep their compressed bytes"""
+    patched = {'word/document.xml', 'word/_rels/document.xml.rels', '[Content_Types].xml'}
+    with zipfile.ZipFile(io.BytesIO(original)) as before, zipfile.ZipFile(io.BytesIO(signed)) as after:
+        for info in before.infolist():
+            if info.filename in patched:
+                continue
+            if read_local_data(original, info) != read_local_data(signed, after.getinfo(info.filename)):
+                return False
+    return True
+
+
+def per_call(fn, copies):
+    start = time.perf_counter()
+    for _ in range(copies):
+        result = fn()
+    return (time.perf_counter() - start) / copies, result
+
+
+def main():
+    converter = DocumentConverter()
+    signature = 'data:image/png;base64,' + base64.b64encode(make_signature_png()).decode()
+
+    documents = [
+        ('small', make_docx(CorpusSpec('small', '.docx', 20, seed=1))),
+        ('large', make_docx(CorpusSpec('large', '.docx', 3000, tables=100, seed=2))),
+    ]
+    documents.append(('large+images', with_images(documents[1][1], 24)))
+
+    print(f"{'document':<14}{'size KB':>9}{'copies':>8}{'python-docx ms':>16}{'stamper ms':>12}"
+          f"{'copy ms':>9}{'speedup':>9}{'MB/s':>8}  untouched entries identical")
+    for name, data in documents:
+        copies = 50 if len(data) < 1024 * 1024 else 20
+        legacy, _ = per_call(lambda: converter._add_signature_docx(data, signature, 'bottom-right', 'Benchmark'), max(1, copies // 5))
+        stamped, signed = per_call(lambda: converter.add_signature(data, signature, 'bottom-right', 'Benchmark'), copies)
+        copied, _ = per_call(lambda: io.BytesIO().write(bytes(bytearray(data))), copies)
+        identical = untouched_entries_identical(data, signed)
+        print(f"{name:<14}{len(data) / 1024:>9.0f}{copies:>8}{legacy * 1000:>16.2f}{stamped * 1000:>12.2f}"
+              f"{copied * 1000:>9.2f}{legacy / stamped:>8.1f}x{len(data) / stamped / 1024 ** 2:>8.0f}  {identical}")
+
+    print(f"\nStamper cache: {converter.signature_stamper.stats}")
+
+    # Many signers on one document: serial calls vs one batch
+    name, data = documents[1]
+    signers = 200
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'template.docx')
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        serial, _ = per_call(lambda: [
+            converter.add_signature(data, signature, 'bottom-right', f"Signer {i}") for i in range(signers)
+        ], 1)
+        print(f"\n{signers} signers on the {name} document")
+        print(f"{'serial add_signature':<28}{serial:>8.2f} s")
+
+        for workers in (1, 2, 4):
+            batch = BatchSigner(workers=workers)
+            items = [BatchItem(i, path, 'template.docx', signature, signer_name=f"Signer {i}") for i in range(signers)]
+            batch.output_names(items, many_signers=True)
+            # Start the pool outside the measurement
+            if workers > 1:
+                list(batch.stream_zip(items[:workers]))
+            start = time.perf_counter()
+            size = sum(len(piece) for piece in batch.stream_zip(items))
+            elapsed = time.perf_counter() - start
+            print(f"{f'batch, {workers} worker(s)':<28}{elapsed:>8.2f} s  {serial / elapsed:>5.1f}x  "
+                  f"{size / 1024 ** 2:.1f} MB archive")
+            if batch._pool is not None:
+                batch._pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
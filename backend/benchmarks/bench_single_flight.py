@@ -0,0 +1,87 @@
+"""
+Benchmark for single-flight coalescing of identical Gemini calls
+
+Simulates a burst of identical uploads (the same document sent many times at
+once, e.g. a retrying client or a shared link) spread over several worker
+processes with several threads each, against a stub model that takes a fixed
+time per call. Reports model calls made and wall time with coalescing off,
+within each process only, and across the host through the shared SQLite file.
+
+Run from the backend folder:
+    python benchmarks/bench_single_flight.py
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemini_client import GeminiClient
+from rate_limiter import RateLimiter
+from single_flight import SingleFlight
+
+CALL_SECONDS = 0.5
+PROMPTS = ["Enhance this document: quarterly report", "Enhance this document: meeting notes"]
+
+
+class StubModel:
+    """Answers after CALL_SECONDS and counts its calls in a shared counter"""
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        with self.calls.get_lock():
+            self.calls.value += 1
+        time.sleep(CALL_SECONDS)
+        return SimpleNamespace(text="Enhanced: " + prompt)
+
+
+def worker(calls, mode, db_path, threads, start):
+    flight = SingleFlight(db_path=db_path if mode == 'host' else None, enabled=mode != 'off')
+    client = GeminiClient(model=StubModel(calls), rate_limiter=RateLimiter(requests_per_minute=0),
+                          max_in_flight=threads, single_flight=flight)
+    start.wait()
+    pool = [threading.Thread(target=client.enhance_content, args=(PROMPTS[i % len(PROMPTS)],))
+            for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+
+def run(mode, processes, threads):
+    calls = multiprocessing.Value('i', 0)
+    start = multiprocessing.Event()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "flight.db")
+        # Create the table before the burst, as the first worker request would
+        SingleFlight(db_path=db_path)
+        workers = [multiprocessing.Process(target=worker, args=(calls, mode, db_path, threads, start))
+                   for _ in range(processes)]
+        for process in workers:
+            process.start()
+        time.sleep(1)
+        began = time.perf_counter()
+        start.set()
+        for process in workers:
+            process.join()
+        return calls.value, time.perf_counter() - began
+
+
+def main():
+    print(f"{'burst':<28}{'mode':<10}{'model calls':>12}{'wall s':>9}")
+    for processes, threads in ((2, 8), (4, 16)):
+        burst = f"{processes} workers x {threads} threads"
+        for mode in ('off', 'process', 'host'):
+            calls, elapsed = run(mode, processes, threads)
+            print(f"{burst:<28}{mode:<10}{calls:>12}{elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
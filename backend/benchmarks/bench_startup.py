@@ -0,0 +1,149 @@
+"""
+Startup benchmark: import time, first-request latency and worker memory
+
+Each scenario runs in a fresh interpreter. A "worker" is forked from a
+master process the way gunicorn forks it, either cold (the master only
+imported the app) or warm (the master also ran warm_up, as with
+gunicorn.conf.py's preload_app + when_ready). Reported per scenario:
+- import of app.py, and which heavy modules it loaded
+- the first /health, /enhance (TXT, fake Gemini model) and /add-signature
+  request in the worker
+- the worker's private (not shared with the master) memory afterwards
+
+Run from the backend folder:
+    python benchmarks/bench_startup.py
+"""
+
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('google.generativeai', 'grpc', 'docx', 'PyPDF2')
+
+
+def private_kb() -> int:
+    """Private memory of this process (pages not shared with the master)"""
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith(('Private_Clean', 'Private_Dirty')))
+    except OSError:
+        return 0
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return round((time.perf_counter() - start) * 1000, 1), result
+
+
+def worker(backend_app):
+    """First requests of a freshly forked worker"""
+    import gc
+    from fake_gemini import FakeModel
+    from bench_pipeline import make_signature_png
+
+    result = {}
+    client = backend_app.app.test_client()
+    result['first_health_ms'], _ = timed(lambda: client.get('/health').close())
+
+    def enhance():
+        # Building the client is part of the first request; only the model is faked
+        backend_app.gemini_client.model = FakeModel(base_latency=0, latency_per_1k_tokens=0)
+        response = client.post('/enhance', data={'file': (io.BytesIO(b'Results\n\nE = mc^2 holds.'), 'doc.txt')})
+        data = response.get_data()
+        response.close()
+        return data
+
+    result['first_enhance_ms'], document = timed(enhance)
+    signature = base64.b64encode(make_signature_png()).decode()
+    result['first_sign_ms'], _ = timed(lambda: client.post('/add-signature', data={
+        'file': (io.BytesIO(document), 'doc.docx'), 'signature': signature
+    }).close())
+    result['second_enhance_ms'], _ = timed(enhance)
+    gc.collect()
+    result['worker_private_kb'] = private_kb()
+    return result
+
+
+def child(mode):
+    """One scenario, run in its own interpreter; prints a JSON line"""
+    sys.path.insert(0, BACKEND)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if mode == 'no-key':
+        os.environ.pop('GEMINI_API_KEY', None)
+    else:
+        os.environ['GEMINI_API_KEY'] = 'benchmark'
+    os.environ['GEMINI_RPM'] = '0'
+    os.environ['ENHANCE_CACHE_MAX_BYTES'] = '0'
+
+    result = {}
+    result['import_ms'], backend_app = timed(lambda: __import__('app'))
+    result['heavy_modules_after_import'] = [m for m in HEAVY_MODULES if m in sys.modules]
+
+    if mode == 'no-key':
+        client = backend_app.app.test_client()
+        result['first_health_ms'], _ = timed(lambda: client.get('/health').close())
+        response = client.post('/enhance', data={'file': (io.BytesIO(b'text'), 'doc.txt')})
+        result['enhance_status'] = response.status_code
+        print(json.dumps(result))
+        return
+
+    if mode == 'warm':
+        import gc
+        result['warm_up_ms'], _ = timed(backend_app.app.extensions['services'].warm_up)
+        gc.freeze()
+
+    # Fork a worker like gunicorn does and collect its measurements
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        with os.fdopen(write_end, 'w') as out:
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    measured = worker(backend_app)
+                finally:
+                    sys.stdout = stdout
+            out.write(json.dumps(measured))
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        result.update(json.loads(pipe.read() or '{}'))
+    os.waitpid(pid, 0)
+    print(json.dumps(result))
+
+
+def run(mode):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', mode],
+        cwd=BACKEND, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        child(sys.argv[2])
+        return
+
+    no_key = run('no-key')
+    print(f"Without GEMINI_API_KEY: import {no_key['import_ms']} ms, "
+          f"first /health {no_key['first_health_ms']} ms, /enhance -> {no_key['enhance_status']}, "
+          f"heavy modules loaded: {no_key['heavy_modules_after_import'] or 'none'}")
+
+    rows = [('cold worker', run('cold')), ('warm worker', run('warm'))]
+    columns = ('import_ms', 'warm_up_ms', 'first_health_ms', 'first_enhance_ms',
+               'first_sign_ms', 'second_enhance_ms', 'worker_private_kb')
+    print(f"\n{'':<12}" + ''.join(f"{c:>19}" for c in columns))
+    for name, result in rows:
+        print(f"{name:<12}" + ''.join(f"{result.get(c, '-'):>19}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
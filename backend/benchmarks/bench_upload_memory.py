@@ -0,0 +1,108 @@
+"""
+Benchmark for peak memory of one /enhance request by upload size
+
+Each measurement runs in a fresh process that posts a DOCX padded with an
+incompressible image (like a scanned report) through the Flask test client,
+with Gemini replaced by a stub. The reported number is the growth of the
+process's peak RSS during the request.
+
+Modes:
+- read: the previous upload path (buffer in memory, file.read())
+- spooled: spool to a temp file past UPLOAD_SPOOL_BYTES and mmap it
+
+Run from the backend folder:
+    python benchmarks/bench_upload_memory.py
+"""
+
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+
+def make_docx(path, image_mb):
+    """DOCX with a few pages of text and an image_mb MB stored media part"""
+    import zipfile
+    from docx import Document
+
+    doc = Document()
+    for i in range(200):
+        doc.add_paragraph(f"Paragraph {i}: the measured values are summarised in the attached figure.")
+    buffer = io.BytesIO()
+    doc.save(buffer)
+
+    with zipfile.ZipFile(buffer, 'a', compression=zipfile.ZIP_STORED) as docx_zip:
+        docx_zip.writestr('word/media/scan.bin', os.urandom(image_mb * 1024 * 1024))
+    with open(path, 'wb') as f:
+        f.write(buffer.getvalue())
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(mode, path):
+    """Measure one request in this process"""
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    os.environ['GEMINI_RPM'] = '0'
+    if mode == 'read':
+        # Everything below the limit stays in memory, as before spooling
+        os.environ['UPLOAD_SPOOL_BYTES'] = str(1 << 40)
+
+    from types import SimpleNamespace
+    import app as backend_app
+
+    class StubModel:
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            return SimpleNamespace(text="ENHANCED REPORT\nThe values are summarised in the figure.")
+
+    backend_app.gemini_client.model = StubModel()
+    if mode == 'read':
+        backend_app.map_upload = lambda file: file.read()
+
+    client = backend_app.app.test_client()
+    # Warm up imports and lazy pools with a tiny upload
+    client.post('/enhance', data={'file': (io.BytesIO(b'warm up text content'), 'warm.txt')})
+
+    before = peak_rss_mb()
+    with open(path, 'rb') as f:
+        response = client.post('/enhance', data={'file': (f, 'report.docx')})
+    after = peak_rss_mb()
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    print(f"{after - before:.1f}")
+
+
+def main():
+    print("Peak RSS growth of one /enhance request (MB)")
+    print(f"{'upload':>8} {'read':>8} {'spooled':>8}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for image_mb in (10, 25, 50):
+            path = os.path.join(tmp, f"upload_{image_mb}.docx")
+            make_docx(path, image_mb)
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+
+            results = {}
+            for mode in ('read', 'spooled'):
+                env = dict(os.environ, JOB_STORE_DIR=os.path.join(tmp, mode))
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--child', mode, path],
+                    cwd=BACKEND, env=env, capture_output=True, text=True, check=True
+                ).stdout
+                results[mode] = float(output.strip().splitlines()[-1])
+
+            print(f"{size_mb:>6.1f}MB {results['read']:>8.1f} {results['spooled']:>8.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,131 @@
+"""
+Synthetic document corpus for the offline benchmarks
+
+Generates TXT, DOCX and PDF files of a given size (in paragraphs), table
+density and math density. The same seed always gives the same files.
+
+Run from the backend folder to write a corpus to disk:
+    python benchmarks/corpus.py /tmp/corpus
+"""
+
+import io
+import os
+import random
+import sys
+from dataclasses import dataclass
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+
+from document_blocks import parse_blocks
+from pdf_renderer import PdfRenderer
+
+WORDS = (
+    "analysis results method data system model process value design report "
+    "performance measurement sample review project quality test output input "
+    "structure section figure table summary detail approach response budget"
+).split()
+
+MATH_LINES = [
+    "The energy follows E = mc^2 for every sample.",
+    "We integrate ∫ f(x) dx = F(b) - F(a) over the interval.",
+    "The sum ∑ x_i / n gives the mean, and √(σ^2) the deviation.",
+    "For the triangle a^2 + b^2 = c^2 holds by the theorem.",
+    "The rate k = 3 * 4 = 12 was used in the derivative of log(x).",
+]
+
+
+@dataclass
+class CorpusSpec:
+    """Shape of one generated document"""
+    name: str
+    file_ext: str
+    paragraphs: int
+    tables: int = 0
+    math_density: float = 0.0
+    seed: int = 0
+
+
+def make_lines(spec: CorpusSpec) -> List[str]:
+    """Headings and paragraphs; math_density of the paragraphs are math lines"""
+    rng = random.Random(spec.seed)
+    lines = []
+    for i in range(spec.paragraphs):
+        if i % 12 == 0:
+            lines.append(f"SECTION {i // 12 + 1} {rng.choice(WORDS).upper()}")
+        if rng.random() < spec.math_density:
+            lines.append(rng.choice(MATH_LINES))
+        else:
+            words = [rng.choice(WORDS) for _ in range(rng.randint(25, 60))]
+            lines.append(' '.join(words).capitalize() + '.')
+    return lines
+
+
+def make_txt(spec: CorpusSpec) -> bytes:
+    return '\n\n'.join(make_lines(spec)).encode('utf-8')
+
+
+def make_docx(spec: CorpusSpec) -> bytes:
+    rng = random.Random(spec.seed + 1)
+    lines = make_lines(spec)
+    doc = Document()
+    table_every = max(1, len(lines) // spec.tables) if spec.tables else 0
+
+    for i, line in enumerate(lines):
+        if line.startswith('SECTION'):
+            doc.add_heading(line.title(), level=1)
+        else:
+            doc.add_paragraph(line)
+        if table_every and i % table_every == table_every - 1:
+            rows, cols = rng.randint(4, 12), rng.randint(3, 6)
+            table = doc.add_table(rows=rows, cols=cols)
+            for r, row in enumerate(table.rows):
+                for c, cell in enumerate(row.cells):
+                    cell.text = f"{rng.choice(WORDS)} {r * cols + c}"
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def make_pdf(spec: CorpusSpec) -> bytes:
+    return PdfRenderer().render(parse_blocks('\n'.join(make_lines(spec))))
+
+
+GENERATORS = {'.txt': make_txt, '.docx': make_docx, '.pdf': make_pdf}
+
+
+def make_document(spec: CorpusSpec) -> bytes:
+    return GENERATORS[spec.file_ext](spec)
+
+
+def default_specs(scale: float = 1.0) -> List[CorpusSpec]:
+    """Small/medium/large documents of each format, plain, table- and math-heavy"""
+    specs = []
+    for size_name, paragraphs in (('small', 20), ('medium', 150), ('large', 600)):
+        paragraphs = max(4, int(paragraphs * scale))
+        specs.extend([
+            CorpusSpec(f"{size_name}_plain", '.txt', paragraphs, seed=paragraphs),
+            CorpusSpec(f"{size_name}_math", '.txt', paragraphs, math_density=0.3, seed=paragraphs + 1),
+            CorpusSpec(f"{size_name}_tables", '.docx', paragraphs, tables=max(1, paragraphs // 10), seed=paragraphs + 2),
+            CorpusSpec(f"{size_name}_math", '.docx', paragraphs, math_density=0.3, seed=paragraphs + 3),
+            CorpusSpec(f"{size_name}_report", '.pdf', paragraphs, math_density=0.1, seed=paragraphs + 4),
+        ])
+    return specs
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'corpus'
+    os.makedirs(directory, exist_ok=True)
+    for spec in default_specs():
+        data = make_document(spec)
+        path = os.path.join(directory, spec.name + spec.file_ext)
+        with open(path, 'wb') as f:
+            f.write(data)
+        print(f"{path}: {len(data) / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
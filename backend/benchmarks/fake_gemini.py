@@ -0,0 +1,131 @@
+"""
+Deterministic stand-in for the Gemini model used by the offline benchmarks
+
+FakeModel has the generate_content / generate_content_async / count_tokens
+surface GeminiClient uses, so the real client (deadlines, in-flight limit,
+retries) stays in the path.
+It answers with the document section of the prompt, either unchanged
+('echo') or with math lines wrapped in $$...$$ ('latex'), after a latency
+made of a fixed part plus a per-token part, with optional seeded jitter.
+"""
+
+import asyncio
+import os
+import random
+import re
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemini_client import GeminiClient
+from prompt_planner import estimate_tokens
+from rate_limiter import RateLimiter
+
+CONTENT_MARKER = "=" * 60
+MATH_LINE = re.compile(r'[=∫∑√^]')
+
+
+class FakeModel:
+    """Echoing model with configurable, reproducible latency"""
+
+    def __init__(
+        self,
+        mode: str = 'echo',
+        base_latency: float = 0.05,
+        latency_per_1k_tokens: float = 0.02,
+        jitter: float = 0.0,
+        stream_pieces: int = 8,
+        seed: int = 1234
+    ):
+        """
+        Initialize model
+
+        Args:
+            mode: 'echo' returns the document unchanged, 'latex' also wraps
+                lines that look like math in $$...$$
+            base_latency: Seconds added to every call
+            latency_per_1k_tokens: Seconds per 1000 estimated output tokens
+            jitter: Relative jitter of the latency (0.1 = up to ±10%)
+            stream_pieces: Pieces a streamed response is split into
+            seed: Seed of the jitter
+        """
+        self.mode = mode
+        self.base_latency = base_latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.jitter = jitter
+        self.stream_pieces = stream_pieces
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _answer(self, prompt: str) -> str:
+        parts = prompt.split(CONTENT_MARKER)
+        content = parts[1].strip('\n') if len(parts) >= 3 else prompt
+        if self.mode == 'latex':
+            content = '\n'.join(
+                f"$${line.strip()}$$" if MATH_LINE.search(line) and '$' not in line else line
+                for line in content.split('\n')
+            )
+        return content
+
+    def _latency(self, text: str) -> float:
+        latency = self.base_latency + estimate_tokens(text) / 1000 * self.latency_per_1k_tokens
+        with self._lock:
+            self.calls += 1
+            if self.jitter:
+                latency *= 1 + self._random.uniform(-self.jitter, self.jitter)
+        return latency
+
+    def _pieces(self, text: str):
+        size = max(1, -(-len(text) // self.stream_pieces))
+        return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        text = self._answer(prompt)
+        latency = self._latency(text)
+
+        if not stream:
+            time.sleep(latency)
+            return SimpleNamespace(text=text)
+
+        pieces = self._pieces(text)
+
+        def chunks():
+            for piece in pieces:
+                time.sleep(latency / len(pieces))
+                yield SimpleNamespace(text=piece, parts=[piece])
+
+        return chunks()
+
+    async def generate_content_async(self, prompt, generation_config=None, stream=False):
+        text = self._answer(prompt)
+        latency = self._latency(text)
+
+        if not stream:
+            await asyncio.sleep(latency)
+            return SimpleNamespace(text=text)
+
+        pieces = self._pieces(text)
+
+        async def chunks():
+            for piece in pieces:
+                await asyncio.sleep(latency / len(pieces))
+                yield SimpleNamespace(text=piece, parts=[piece])
+
+        return chunks()
+
+    def count_tokens(self, text):
+        return SimpleNamespace(total_tokens=estimate_tokens(text))
+
+
+def make_fake_client(**model_options) -> GeminiClient:
+    """GeminiClient backed by a FakeModel, with no rate limit and no retries wait"""
+    return GeminiClient(
+        model=FakeModel(**model_options),
+        rate_limiter=RateLimiter(requests_per_minute=0, tokens_per_minute=0),
+        max_in_flight=64,
+        sleep=lambda seconds: None
+    )
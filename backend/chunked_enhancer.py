@@ -0,0 +1,702 @@
+import asyncio
+import os
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from prompt_planner import estimate_tokens
+
+# Line put before each section of a prompt that enhances several sections,
+# so the output can be split back into the sections it came from
+SECTION_MARKER = re.compile(r'^[ \t]*\[\[\s*§\s*(\d+)\s*\]\][ \t]*$', re.MULTILINE)
+
+
+@dataclass
+class DocumentChunk:
+    """A contiguous slice of a document sent to Gemini as one prompt"""
+    index: int
+    text: str
+    context_before: str = ""
+    context_after: str = ""
+
+
+class DocumentChunker:
+    """Section-aware splitter for long documents"""
+
+    # Lines that start a new section: markdown headings, "Chapter 3",
+    # multi-level numbering ("2.1 Methods") and short ALL CAPS titles
+    HEADING_PATTERN = re.compile(
+        r'^(?:#{1,6}\s+\S'
+        r'|(?:chapter|section|part|appendix)\s+[\w.]+'
+        r'|\d+(?:\.\d+)+\.?\s+\S)',
+        re.IGNORECASE
+    )
+
+    PARAGRAPH_SPLIT = re.compile(r'\n\s*\n')
+    SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+
+    def __init__(self, max_chunk_chars: int = 12000, context_chars: int = 400, section_chars: int = 2000):
+        """
+        Initialize chunker
+
+        Args:
+            max_chunk_chars: Upper bound on the characters in a single chunk
+            context_chars: Characters of neighbouring text given to each chunk
+            section_chars: Target size of the units split_units returns
+        """
+        self.max_chunk_chars = max_chunk_chars
+        self.context_chars = context_chars
+        self.section_chars = section_chars
+
+    def is_heading(self, line: str) -> bool:
+        """Check whether a line looks like a section heading"""
+        line = line.strip()
+        if not line:
+            return False
+        if self.HEADING_PATTERN.match(line):
+            return True
+        return line.isupper() and len(line.split()) <= 10
+
+    def split_sections(self, text: str) -> List[str]:
+        """
+        Split text into sections, each starting at a heading
+
+        Args:
+            text: Full document text
+
+        Returns:
+            List of sections in document order
+        """
+        sections = []
+        current = []
+
+        for line in text.split('\n'):
+            if self.is_heading(line) and any(l.strip() for l in current):
+                sections.append('\n'.join(current).strip('\n'))
+                current = []
+            current.append(line)
+
+        if any(l.strip() for l in current):
+            sections.append('\n'.join(current).strip('\n'))
+
+        return sections
+
+    def split_units(self, text: str) -> List[str]:
+        """
+        Split text into the sections whose enhanced output is stored and reused
+
+        A section longer than section_chars is cut at paragraph breaks chosen
+        by the content of the paragraphs, not by a running length, so an edit
+        only moves the cuts next to it and every other unit keeps its text.
+
+        Args:
+            text: Full document text
+
+        Returns:
+            List of units in document order
+        """
+        units = []
+        for section in self.split_sections(text):
+            if len(section) <= self.section_chars:
+                units.append(section)
+                continue
+
+            current = []
+            size = 0
+            for paragraph in self._split_oversized(section):
+                current.append(paragraph)
+                size += len(paragraph)
+                if size >= self.section_chars or (
+                    size >= self.section_chars // 4 and zlib.crc32(paragraph.encode('utf-8')) % 4 == 0
+                ):
+                    units.append('\n\n'.join(current))
+                    current = []
+                    size = 0
+            if current:
+                units.append('\n\n'.join(current))
+        return units
+
+    def _split_oversized(self, text: str) -> List[str]:
+        """Break a section that does not fit in one chunk into smaller pieces"""
+        pieces = []
+        for paragraph in self.PARAGRAPH_SPLIT.split(text):
+            if not paragraph.strip():
+                continue
+            if len(paragraph) <= self.max_chunk_chars:
+                pieces.append(paragraph)
+                continue
+
+            # A single huge paragraph: fall back to sentences, then hard cuts
+            for sentence in self.SENTENCE_SPLIT.split(paragraph):
+                while len(sentence) > self.max_chunk_chars:
+                    cut = sentence.rfind(' ', 0, self.max_chunk_chars)
+                    if cut <= 0:
+                        cut = self.max_chunk_chars
+                    pieces.append(sentence[:cut])
+                    sentence = sentence[cut:].lstrip()
+                if sentence:
+                    pieces.append(sentence)
+        return pieces
+
+    def _pack(self, pieces: List[str], separator: str = '\n\n') -> List[str]:
+        """Greedily pack consecutive pieces into chunks up to the size bound"""
+        chunks = []
+        current = []
+        current_len = 0
+
+        for piece in pieces:
+            added = len(piece) + (len(separator) if current else 0)
+            if current and current_len + added > self.max_chunk_chars:
+                chunks.append(separator.join(current))
+                current = []
+                current_len = 0
+                added = len(piece)
+            current.append(piece)
+            current_len += added
+
+        if current:
+            chunks.append(separator.join(current))
+        return chunks
+
+    def chunk(self, text: str) -> List[DocumentChunk]:
+        """
+        Split a document into ordered chunks with neighbouring context
+
+        Args:
+            text: Full document text
+
+        Returns:
+            List of chunks; a short document yields exactly one chunk
+        """
+        if len(text) <= self.max_chunk_chars:
+            return [DocumentChunk(index=0, text=text)]
+
+        pieces = []
+        for section in self.split_sections(text):
+            if len(section) <= self.max_chunk_chars:
+                pieces.append(section)
+            else:
+                pieces.extend(self._pack(self._split_oversized(section)))
+
+        texts = self._pack(pieces)
+        chunks = []
+        for i, chunk_text in enumerate(texts):
+            before = texts[i - 1][-self.context_chars:] if i > 0 else ""
+            after = texts[i + 1][:self.context_chars] if i + 1 < len(texts) else ""
+            chunks.append(DocumentChunk(
+                index=i,
+                text=chunk_text,
+                context_before=before,
+                context_after=after
+            ))
+        return chunks
+
+
+@dataclass
+class _SectionPlan:
+    """A document's sections, their stored outputs and the chunks enhancing the rest"""
+    sections: List[str]
+    keys: List[str]
+    outputs: List[Optional[str]]
+    missing: List[int]
+    chunks: List[DocumentChunk]
+
+    @property
+    def reused(self) -> int:
+        return len(self.sections) - len(self.missing)
+
+
+def _split_marked(text: str, count: int) -> Optional[List[str]]:
+    """Split enhanced sections at their markers; None if the markers did not survive"""
+    matches = list(SECTION_MARKER.finditer(text))
+    if [int(match.group(1)) for match in matches] != list(range(1, count + 1)):
+        return None
+
+    pieces = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        pieces.append(text[match.end():end].strip('\n'))
+    lead = text[:matches[0].start()].strip('\n')
+    if lead:
+        pieces[0] = f"{lead}\n\n{pieces[0]}"
+    if not all(piece.strip() for piece in pieces):
+        return None
+    return pieces
+
+
+def _strip_markers(text: str) -> str:
+    return re.sub(r'\n{3,}', '\n\n', SECTION_MARKER.sub('', text)).strip('\n')
+
+
+class ChunkedEnhancer:
+    """
+    Enhances long documents chunk by chunk with bounded parallelism
+
+    With a section cache, the enhanced output of every section is stored
+    under the section's text and the prompt parameters. When a document
+    comes back with a few sections edited, only the new or changed
+    sections are sent to Gemini; the others are spliced back from the
+    cache. A stored section was enhanced with the neighbours it had then,
+    which are given to a prompt as context only.
+    """
+
+    def __init__(
+        self,
+        gemini_client,
+        latex_processor,
+        chunker: Optional[DocumentChunker] = None,
+        max_workers: Optional[int] = None,
+        section_cache=None
+    ):
+        """
+        Initialize enhancer
+
+        Args:
+            gemini_client: Client exposing enhance_content(prompt)
+            latex_processor: Processor used to build chunk prompts
+            chunker: Document chunker (defaults from environment)
+            max_workers: Concurrent Gemini calls per process
+                (defaults to GEMINI_MAX_WORKERS or 4)
+            section_cache: ResultCache storing the output of each section
+                (optional; without it documents are always enhanced whole)
+        """
+        self.gemini_client = gemini_client
+        self.latex_processor = latex_processor
+        self.chunker = chunker or DocumentChunker(
+            max_chunk_chars=int(os.getenv('ENHANCE_CHUNK_CHARS', 12000)),
+            context_chars=int(os.getenv('ENHANCE_CONTEXT_CHARS', 400)),
+            section_chars=int(os.getenv('ENHANCE_SECTION_CHARS', 2000))
+        )
+        self.max_workers = max_workers or int(os.getenv('GEMINI_MAX_WORKERS', 4))
+        self.section_cache = section_cache
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Process-wide pool shared by all requests, created on first use"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='gemini-chunk'
+                    )
+        return self._executor
+
+    def _chunker_for(self, plan=None) -> DocumentChunker:
+        """The chunker, at the chunk size of the prompt plan if there is one"""
+        chunker = self.chunker
+        if plan is not None and plan.chunk_chars != chunker.max_chunk_chars:
+            chunker = DocumentChunker(plan.chunk_chars, chunker.context_chars, chunker.section_chars)
+        return chunker
+
+    def _chunks_for(self, content: str, plan=None) -> List[DocumentChunk]:
+        """Chunk a document, at the chunk size of the prompt plan if there is one"""
+        return self._chunker_for(plan).chunk(content)
+
+    @staticmethod
+    def _call_options(plan=None) -> dict:
+        """Keyword arguments for the Gemini client implied by the prompt plan"""
+        if plan is None:
+            return {}
+        if plan.route:
+            return {'max_output_tokens': plan.max_output_tokens, 'route': plan.route}
+        return {'max_output_tokens': plan.max_output_tokens}
+
+    def _build_prompt(
+        self,
+        chunk: DocumentChunk,
+        total: int,
+        user_instructions: str,
+        doc_type: str,
+        include_latex: bool,
+        plan=None,
+        section_markers: bool = False
+    ) -> str:
+        """Build the prompt for one chunk"""
+        summarize_words = None
+        if plan is not None and plan.action == 'summarize':
+            # Leave room for markup in the output budget
+            summarize_words = int(plan.max_output_tokens / 1.5)
+        return self.latex_processor.build_enhancement_prompt(
+            content=chunk.text,
+            user_instructions=user_instructions,
+            doc_type=doc_type,
+            include_latex=include_latex,
+            context_before=chunk.context_before,
+            context_after=chunk.context_after,
+            part=(chunk.index + 1, total) if total > 1 else None,
+            summarize_words=summarize_words,
+            section_markers=section_markers
+        )
+
+    def _enhance_chunk(
+        self,
+        chunk: DocumentChunk,
+        total: int,
+        user_instructions: str,
+        doc_type: str,
+        include_latex: bool,
+        plan=None
+    ) -> str:
+        """Build the prompt for one chunk and enhance it"""
+        prompt = self._build_prompt(chunk, total, user_instructions, doc_type, include_latex, plan)
+        return self.gemini_client.enhance_content(prompt, **self._call_options(plan)).strip('\n')
+
+    def _call_all(self, prompts: List[str], plan=None) -> List[str]:
+        """Enhance prompts in parallel on the shared pool, results in order"""
+        options = self._call_options(plan)
+        if len(prompts) == 1:
+            return [self.gemini_client.enhance_content(prompts[0], **options).strip('\n')]
+
+        futures = [
+            self.executor.submit(self.gemini_client.enhance_content, prompt, **options)
+            for prompt in prompts
+        ]
+        try:
+            return [future.result().strip('\n') for future in futures]
+        finally:
+            # Don't spend quota on chunks whose result will be thrown away
+            for future in futures:
+                future.cancel()
+
+    async def _call_all_async(self, prompts: List[str], plan=None) -> List[str]:
+        """_call_all as coroutines, bounded by the client's async in-flight limit"""
+        options = self._call_options(plan)
+        tasks = [
+            asyncio.ensure_future(self.gemini_client.enhance_content_async(prompt, **options))
+            for prompt in prompts
+        ]
+        try:
+            return [result.strip('\n') for result in await asyncio.gather(*tasks)]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _section_key(self, section: str, user_instructions: str, doc_type: str, include_latex: bool, plan=None) -> str:
+        return self.section_cache.make_key(
+            'section',
+            section,
+            user_instructions,
+            doc_type,
+            include_latex,
+            # The model of the plan's route wrote the output, not necessarily the default one
+            plan.model_name if plan is not None and plan.model_name else self.gemini_client.model_name,
+            self.gemini_client.generation_config
+        )
+
+    def _plan_sections(
+        self,
+        content: str,
+        user_instructions: str,
+        doc_type: str,
+        include_latex: bool,
+        plan=None
+    ) -> Optional[_SectionPlan]:
+        """
+        Look up the stored output of every section and chunk the rest
+
+        Returns:
+            The section plan, or None when the document is enhanced whole
+            (no section cache, or a summary, which has no per-section output)
+        """
+        if self.section_cache is None or (plan is not None and plan.action == 'summarize'):
+            return None
+
+        chunker = self._chunker_for(plan)
+        sections = chunker.split_units(content)
+        if not sections:
+            return None
+
+        keys = [self._section_key(section, user_instructions, doc_type, include_latex, plan) for section in sections]
+        outputs = [self.section_cache.get_text('section', key) for key in keys]
+
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        return _SectionPlan(sections, keys, outputs, missing, self._missing_chunks(chunker, sections, missing))
+
+    @staticmethod
+    def _missing_chunks(chunker: DocumentChunker, sections: List[str], missing: List[int]) -> List[DocumentChunk]:
+        """
+        Chunks enhancing the sections with no stored output
+
+        All of them are packed together, so the number of calls depends on
+        how much text changed rather than on how many places it changed in.
+        Several sections are each preceded by a marker line to split the
+        output at.
+        """
+        if not missing:
+            return []
+        if len(missing) == 1:
+            text = sections[missing[0]]
+        else:
+            text = '\n\n'.join(f"[[§{number}]]\n{sections[i]}" for number, i in enumerate(missing, 1))
+        chunks = chunker.chunk(text)
+
+        # Sections around a single changed stretch are its context, as
+        # neighbouring chunks are
+        first, last = missing[0], missing[-1]
+        if chunker.context_chars and last - first == len(missing) - 1:
+            if first > 0:
+                chunks[0].context_before = sections[first - 1][-chunker.context_chars:]
+            if last + 1 < len(sections):
+                chunks[-1].context_after = sections[last + 1][:chunker.context_chars]
+        return chunks
+
+    def _whole_prompts(
+        self,
+        content: str,
+        user_instructions: str,
+        doc_type: str,
+        include_latex: bool,
+        plan=None
+    ) -> List[str]:
+        chunks = self._chunks_for(content, plan)
+        return [
+            self._build_prompt(chunk, len(chunks), user_instructions, doc_type, include_latex, plan)
+            for chunk in chunks
+        ]
+
+    def _missing_prompts(
+        self,
+        section_plan: _SectionPlan,
+        user_instructions: str,
+        doc_type: str,
+        include_latex: bool,
+        plan=None
+    ) -> List[str]:
+        total = len(section_plan.chunks)
+        return [
+            self._build_prompt(
+                chunk, total, user_instructions, doc_type, include_latex, plan,
+                section_markers=len(section_plan.missing) > 1
+            )
+            for chunk in section_plan.chunks
+        ]
+
+    @staticmethod
+    def _splice(section_plan: _SectionPlan, results: List[str]) -> Tuple[Optional[str], List[Tuple[str, str]]]:
+        """
+        Put the newly enhanced sections back between the stored ones
+
+        Returns:
+            Tuple of (enhanced document, or None if it has to be enhanced
+            whole, and (key, output) of each newly enhanced section)
+        """
+        if not section_plan.missing:
+            return '\n\n'.join(section_plan.outputs), []
+
+        enhanced = '\n\n'.join(results)
+        missing = section_plan.missing
+        pieces = [enhanced] if len(missing) == 1 else _split_marked(enhanced, len(missing))
+        if pieces is not None:
+            outputs = list(section_plan.outputs)
+            for i, piece in zip(missing, pieces):
+                outputs[i] = piece
+            return '\n\n'.join(outputs), [(section_plan.keys[i], piece) for i, piece in zip(missing, pieces)]
+
+        # The markers did not come back intact, so the output can't be split
+        # and nothing is stored. Changed sections that are all adjacent still
+        # have a place in the document; scattered ones don't
+        first, last = missing[0], missing[-1]
+        if last - first != len(missing) - 1:
+            return None, []
+        outputs = section_plan.outputs[:first] + [_strip_markers(enhanced)] + section_plan.outputs[last + 1:]
+        return '\n\n'.join(outputs), []
+
+    @staticmethod
+    def _record_sections(trace, section_plan: _SectionPlan, prompts: List[str]):
+        if trace is not None:
+            trace.set(
+                sections=len(section_plan.sections),
+                sections_reused=section_plan.reused,
+                prompt_tokens=sum(estimate_tokens(prompt) for prompt in prompts)
+            )
+
+    def _store_sections(self, stored: List[Tuple[str, str]]):
+        for key, output in stored:
+            self.section_cache.set_text('section', key, output)
+
+    def enhance(
+        self,
+        content: str,
+        user_instructions: str = "",
+        doc_type: str = "auto",
+        include_latex: bool = False,
+        plan=None,
+        trace=None
+    ) -> str:
+        """
+        Enhance a document, splitting it into chunks if it is long
+
+        Args:
+            content: Extracted document text
+            user_instructions: User's specific instructions
+            doc_type: Type of document
+            include_latex: Whether to include LaTeX formatting
+            plan: PromptPlan sizing the chunks and output budget (optional)
+            trace: RequestTrace recording sections reused and prompt tokens
+                sent (optional)
+
+        Returns:
+            Enhanced content with chunks stitched back in order
+        """
+        section_plan = self._plan_sections(content, user_instructions, doc_type, include_latex, plan)
+        if section_plan is not None:
+            prompts = self._missing_prompts(section_plan, user_instructions, doc_type, include_latex, plan)
+            self._record_sections(trace, section_plan, prompts)
+            results = self._call_all(prompts, plan) if prompts else []
+            enhanced, stored = self._splice(section_plan, results)
+            self._store_sections(stored)
+            if enhanced is not None:
+                return enhanced
+
+        prompts = self._whole_prompts(content, user_instructions, doc_type, include_latex, plan)
+        return '\n\n'.join(self._call_all(prompts, plan))
+
+    def enhance_stream(
+        self,
+        content: str,
+        user_instructions: str = "",
+        doc_type: str = "auto",
+        include_latex: bool = False,
+        plan=None
+    ) -> Iterator[str]:
+        """
+        Enhance a document, yielding enhanced text as soon as it is available
+
+        The first chunk is streamed from Gemini token by token while the
+        remaining chunks are enhanced in the background, so time to first
+        byte does not depend on the document length.
+
+        Args:
+            content: Extracted document text
+            user_instructions: User's specific instructions
+            doc_type: Type of document
+            include_latex: Whether to include LaTeX formatting
+            plan: PromptPlan sizing the chunks and output budget (optional)
+
+        Yields:
+            Pieces of enhanced content in document order
+        """
+        chunks = self._chunks_for(content, plan)
+        total = len(chunks)
+
+        futures = [
+            self.executor.submit(
+                self._enhance_chunk,
+                chunk, total, user_instructions, doc_type, include_latex, plan
+            )
+            for chunk in chunks[1:]
+        ]
+
+        try:
+            prompt = self._build_prompt(chunks[0], total, user_instructions, doc_type, include_latex, plan)
+            yield from self.gemini_client.stream_content(prompt, **self._call_options(plan))
+            for future in futures:
+                yield '\n\n'
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def _enhance_chunk_async(
+        self,
+        chunk: DocumentChunk,
+        total: int,
+        user_instructions: str,
+        doc_type: str,
+        include_latex: bool,
+        plan=None
+    ) -> str:
+        prompt = self._build_prompt(chunk, total, user_instructions, doc_type, include_latex, plan)
+        enhanced = await self.gemini_client.enhance_content_async(prompt, **self._call_options(plan))
+        return enhanced.strip('\n')
+
+    async def enhance_async(
+        self,
+        content: str,
+        user_instructions: str = "",
+        doc_type: str = "auto",
+        include_latex: bool = False,
+        plan=None,
+        trace=None
+    ) -> str:
+        """
+        enhance on the event loop: chunks are enhanced concurrently as
+        coroutines, bounded by the client's async in-flight limit instead of
+        this enhancer's thread pool, and section cache I/O runs on the
+        loop's default executor
+
+        Args:
+            content: Extracted document text
+            user_instructions: User's specific instructions
+            doc_type: Type of document
+            include_latex: Whether to include LaTeX formatting
+            plan: PromptPlan sizing the chunks and output budget (optional)
+            trace: RequestTrace recording sections reused and prompt tokens
+                sent (optional)
+
+        Returns:
+            Enhanced content with chunks stitched back in order
+        """
+        loop = asyncio.get_running_loop()
+        section_plan = await loop.run_in_executor(
+            None, self._plan_sections, content, user_instructions, doc_type, include_latex, plan
+        )
+        if section_plan is not None:
+            prompts = self._missing_prompts(section_plan, user_instructions, doc_type, include_latex, plan)
+            self._record_sections(trace, section_plan, prompts)
+            results = await self._call_all_async(prompts, plan) if prompts else []
+            enhanced, stored = self._splice(section_plan, results)
+            await loop.run_in_executor(None, self._store_sections, stored)
+            if enhanced is not None:
+                return enhanced
+
+        prompts = self._whole_prompts(content, user_instructions, doc_type, include_latex, plan)
+        return '\n\n'.join(await self._call_all_async(prompts, plan))
+
+    async def enhance_stream_async(
+        self,
+        content: str,
+        user_instructions: str = "",
+        doc_type: str = "auto",
+        include_latex: bool = False,
+        plan=None
+    ) -> AsyncIterator[str]:
+        """
+        enhance_stream on the event loop
+
+        Args:
+            content: Extracted document text
+            user_instructions: User's specific instructions
+            doc_type: Type of document
+            include_latex: Whether to include LaTeX formatting
+            plan: PromptPlan sizing the chunks and output budget (optional)
+
+        Yields:
+            Pieces of enhanced content in document order
+        """
+        chunks = self._chunks_for(content, plan)
+        total = len(chunks)
+
+        tasks = [
+            asyncio.ensure_future(self._enhance_chunk_async(
+                chunk, total, user_instructions, doc_type, include_latex, plan
+            ))
+            for chunk in chunks[1:]
+        ]
+
+        try:
+            prompt = self._build_prompt(chunks[0], total, user_instructions, doc_type, include_latex, plan)
+            async for piece in self.gemini_client.stream_content_async(prompt, **self._call_options(plan)):
+                yield piece
+            for task in tasks:
+                yield '\n\n'
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,131 @@
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from latex_processor import scan_latex
+
+
+@dataclass
+class Block:
+    """
+    One paragraph-level element of an enhanced document
+
+    kind is one of:
+    - 'empty': blank spacing paragraph
+    - 'heading': heading of the given level
+    - 'paragraph': plain text paragraph
+    - 'bullet' / 'number': bulleted or numbered list item
+    - 'display_math': centered display equation (text is the LaTeX source)
+    - 'math_paragraph': text with inline equations in segments
+    """
+    kind: str
+    text: str = ""
+    level: int = 0
+    # (is_math, text) pairs for 'math_paragraph'
+    segments: List[Tuple[bool, str]] = field(default_factory=list)
+
+
+NUMBERED_ITEM = re.compile(r'^\d+\.\s*')
+
+
+def _heading_block(line: str) -> Optional[Block]:
+    """Heading block for a line that is all caps or starts with #"""
+    if line.isupper() and len(line.split()) <= 10:
+        return Block('heading', line, level=1)
+    if line.startswith('# '):
+        # Markdown-style heading
+        heading_level = min(len(line) - len(line.lstrip('#')), 3)
+        return Block('heading', line.replace('#', '').strip(), level=heading_level)
+    return None
+
+
+def _line_block(line: str) -> Block:
+    """Block for one stripped line of text without equations"""
+    if not line:
+        # Empty paragraph for spacing
+        return Block('empty')
+    heading = _heading_block(line)
+    if heading:
+        return heading
+    if line.startswith('- ') or line.startswith('• '):
+        return Block('bullet', line[2:].strip())
+    numbered = NUMBERED_ITEM.match(line)
+    if numbered:
+        return Block('number', line[numbered.end():])
+    return Block('paragraph', line)
+
+
+def _math_line_block(segments: List[Tuple[bool, str]]) -> Block:
+    """Block for one line of (is_math, text) segments"""
+    source = ''.join(f"${text}$" if is_math else text for is_math, text in segments).strip()
+    if not any(is_math for is_math, _ in segments):
+        return _line_block(source.replace('\\$', '$'))
+    heading = _heading_block(source)
+    if heading:
+        return heading
+
+    segments = [(is_math, text if is_math else text.replace('\\$', '$')) for is_math, text in segments]
+    if not segments[0][0]:
+        segments[0] = (False, segments[0][1].lstrip())
+    if not segments[-1][0]:
+        segments[-1] = (False, segments[-1][1].rstrip())
+    return Block('math_paragraph', source, segments=segments)
+
+
+def parse_blocks(
+    content: str,
+    include_latex: bool = False,
+    spans: Optional[List[Tuple[str, str]]] = None
+) -> List[Block]:
+    """
+    Parse enhanced markdown/LaTeX text into a block model in one pass
+
+    Args:
+        content: Enhanced content
+        include_latex: Whether '$' delimits LaTeX equations
+        spans: LaTeXContent.spans of the content when it was already scanned
+            (include_latex only)
+
+    Returns:
+        Blocks in document order
+    """
+    if not include_latex:
+        return [_line_block(line.strip()) for line in content.split('\n')]
+
+    if spans is None:
+        spans = scan_latex(content).spans
+
+    blocks = []
+    # (is_math, text) segments of the current line
+    line = []
+    # Whether the current line held a display equation
+    display = False
+
+    def end_line():
+        if any(is_math or text.strip() for is_math, text in line):
+            blocks.append(_math_line_block(line))
+        elif not display:
+            blocks.append(Block('empty'))
+
+    for kind, text in spans:
+        if kind == 'text':
+            pieces = text.split('\n')
+            line.append((False, pieces[0]))
+            if len(pieces) > 1:
+                end_line()
+                # Lines wholly inside the text have no equations
+                blocks.extend(_line_block(piece.strip().replace('\\$', '$')) for piece in pieces[1:-1])
+                line = [(False, pieces[-1])]
+                display = False
+        elif kind == 'inline':
+            line.append((True, text))
+        else:
+            # Display equations are on their own line in scanned content
+            if any(is_math or piece.strip() for is_math, piece in line):
+                blocks.append(_math_line_block(line))
+            line = []
+            blocks.append(Block('display_math', text.strip()))
+            display = True
+    end_line()
+
+    return blocks
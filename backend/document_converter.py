@@ -1,21 +1,96 @@
 import io
+import os
+import hashlib
 import re
-import base64
-from typing import Optional
+import mmap
+import zipfile
+import tempfile
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 from docx import Document
-from docx.shared import Pt, Inches, RGBColor
+from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import PyPDF2
 
+from document_blocks import parse_blocks
+from docx_patcher import DocxPatcher, DocxSource, PatchingNotSupported, SourceParagraph
+from docx_renderer import DocxRenderer
+from omml_converter import OmmlConverter
+from pdf_renderer import PdfRenderer
+from signature_stamper import SignatureStamper, StampingNotSupported
+from upload_spool import UploadContent, open_stream
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+class DocumentTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured page or byte limits"""
+    status_code = 413
+
+def _extract_pdf_page_range(path: str, start: int, end: int) -> List[str]:
+    """
+    Extract the text of pages [start, end) of a PDF file
+    
+    Runs in a worker process: each worker parses the file itself from a
+    memory-mapped view, so only page text crosses the process boundary.
+    """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pdf_reader = PyPDF2.PdfReader(mapped)
+            return [pdf_reader.pages[i].extract_text() for i in range(start, end)]
+
 class DocumentConverter:
     """Converter for various document formats"""
     
-    def extract_text(self, file_content: bytes, file_ext: str) -> str:
+    # PDFs with at least this many pages are extracted on the process pool
+    PDF_PARALLEL_MIN_PAGES = 16
+    
+    # Smallest page range handed to one worker task
+    PDF_MIN_PAGES_PER_TASK = 4
+    
+    def __init__(
+        self,
+        pdf_workers: Optional[int] = None,
+        max_pdf_pages: Optional[int] = None,
+        max_pdf_bytes: Optional[int] = None
+    ):
+        """
+        Initialize converter
+        
+        Args:
+            pdf_workers: Processes used for PDF extraction (PDF_EXTRACT_WORKERS,
+                default: CPU count; 1 disables the process pool)
+            max_pdf_pages: Reject PDFs with more pages (PDF_MAX_PAGES, default: 1000)
+            max_pdf_bytes: Reject PDFs larger than this (PDF_MAX_BYTES, default: 100 MB)
+        """
+        self.pdf_workers = pdf_workers or int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 1))
+        self.max_pdf_pages = max_pdf_pages or int(os.getenv('PDF_MAX_PAGES', 1000))
+        self.max_pdf_bytes = max_pdf_bytes or int(os.getenv('PDF_MAX_BYTES', 100 * 1024 * 1024))
+        self._pdf_pool = None
+        self.docx_renderer = DocxRenderer(OmmlConverter.from_env())
+        self.docx_patcher = DocxPatcher.from_env(self.docx_renderer)
+        self.pdf_renderer = PdfRenderer()
+        self.signature_stamper = SignatureStamper.from_env()
+    
+    @property
+    def pdf_pool(self) -> ProcessPoolExecutor:
+        """Process pool for PDF extraction, started on first use"""
+        if self._pdf_pool is None:
+            # spawn: forking a threaded gunicorn worker can copy held locks
+            self._pdf_pool = ProcessPoolExecutor(
+                max_workers=self.pdf_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._pdf_pool
+    
+    def extract_text(self, file_content: UploadContent, file_ext: str) -> str:
         """
         Extract text from various document formats
         
         Args:
-            file_content: Raw file bytes
+            file_content: Raw file bytes (or a read-only mmap of them)
             file_ext: File extension (.docx, .pdf, .txt)
             
         Returns:
@@ -26,52 +101,232 @@ class DocumentConverter:
         elif file_ext == '.pdf':
             return self._extract_from_pdf(file_content)
         elif file_ext == '.txt':
-            return file_content.decode('utf-8', errors='ignore')
+            return str(file_content, 'utf-8', errors='ignore')
         else:
             raise ValueError(f"Unsupported file format: {file_ext}")
     
-    def _extract_from_docx(self, file_content: bytes) -> str:
-        """Extract text from DOCX file"""
-        try:
-            doc = Document(io.BytesIO(file_content))
+    def extract(self, file_content: UploadContent, file_ext: str) -> Tuple[str, Optional[DocxSource]]:
+        """
+        Extract text, and for DOCX uploads the paragraph map patching needs
+        
+        Args:
+            file_content: Raw file bytes (or a read-only mmap of them)
+            file_ext: File extension (.docx, .pdf, .txt)
             
-            paragraphs = []
-            for para in doc.paragraphs:
-                if para.text.strip():
-                    paragraphs.append(para.text)
+        Returns:
+            Tuple of (extracted text, paragraph map or None when the output
+            is not patched into the upload)
+        """
+        if file_ext not in ('.docx', '.doc') or not self.docx_patcher.enabled:
+            return self.extract_text(file_content, file_ext), None
+        
+        paragraphs = []
+        text = self._extract_from_docx(file_content, paragraphs)
+        return text, DocxSource(digest=hashlib.sha256(file_content).hexdigest(), paragraphs=paragraphs)
+    
+    def _extract_from_docx(self, file_content: UploadContent, source: Optional[List[SourceParagraph]] = None) -> str:
+        """
+        Extract text from DOCX file
+        
+        Args:
+            file_content: Raw DOCX bytes (or a read-only mmap of them)
+            source: List that gets the paragraph map, in extraction order (optional)
+        """
+        try:
+            with zipfile.ZipFile(open_stream(file_content)) as docx_zip:
+                names = set(docx_zip.namelist())
+                
+                # Headers and footers usually repeat (default/first/even page)
+                header_footer = []
+                for pattern in (r'word/header\d*\.xml$', r'word/footer\d*\.xml$'):
+                    parts = sorted(
+                        (name for name in names if re.match(pattern, name)),
+                        key=lambda name: int(re.sub(r'\D', '', name) or 0)
+                    )
+                    texts = []
+                    for name in parts:
+                        for text in self._iter_docx_part_text(docx_zip, name):
+                            if text not in texts:
+                                texts.append(text)
+                    header_footer.append(texts)
+                headers, footers = header_footer
+                
+                paragraphs = list(headers)
+                paragraphs.extend(self._iter_docx_part_text(docx_zip, 'word/document.xml', source))
+                notes = []
+                for name in ('word/footnotes.xml', 'word/endnotes.xml'):
+                    if name in names:
+                        notes.extend(self._iter_docx_part_text(docx_zip, name))
+                paragraphs.extend(notes)
+                paragraphs.extend(footers)
             
-            # Also extract from tables
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        if cell.text.strip():
-                            paragraphs.append(cell.text)
+            if source is not None:
+                # Only the body is patched; the rest anchors the alignment
+                source[:0] = [SourceParagraph(text) for text in headers]
+                source.extend(SourceParagraph(text) for text in notes + footers)
             
             return '\n\n'.join(paragraphs)
         except Exception as e:
             raise ValueError(f"Failed to extract text from DOCX: {str(e)}")
     
-    def _extract_from_pdf(self, file_content: bytes) -> str:
+    def _iter_docx_part_text(
+        self,
+        docx_zip: zipfile.ZipFile,
+        name: str,
+        source: Optional[List[SourceParagraph]] = None
+    ) -> Iterator[str]:
+        """
+        Stream paragraph and table cell texts of one WordprocessingML part
+        
+        Reads the part incrementally with iterparse and frees each paragraph
+        once its text is taken, so memory stays flat for large documents.
+        Table cells are emitted once in document order; cells continuing a
+        vertical merge are skipped instead of repeating the merged text.
+        
+        Args:
+            docx_zip: Open DOCX archive
+            name: Part name, e.g. 'word/document.xml'
+            source: List that gets each non-blank paragraph with its position
+                among the part's <w:p> elements (optional)
+            
+        Yields:
+            Non-blank paragraph and table cell texts
+        """
+        p_tag, tc_tag = W_NS + 'p', W_NS + 'tc'
+        t_tag, tab_tag = W_NS + 't', W_NS + 'tab'
+        breaks = (W_NS + 'br', W_NS + 'cr')
+        
+        cells = []          # paragraph texts of each open table cell
+        fallback_depth = 0  # inside mc:Fallback, a duplicate of mc:Choice
+        ordinals = []       # positions of the open paragraphs
+        paragraph_count = 0
+        
+        with docx_zip.open(name) as part:
+            for event, elem in ET.iterparse(part, events=('start', 'end')):
+                tag = elem.tag
+                
+                if event == 'start':
+                    if tag == MC_FALLBACK:
+                        fallback_depth += 1
+                    elif tag == tc_tag:
+                        cells.append([])
+                    elif tag == p_tag:
+                        ordinals.append(paragraph_count)
+                        paragraph_count += 1
+                    continue
+                
+                if tag == p_tag:
+                    ordinal = ordinals.pop()
+                    if not fallback_depth:
+                        text = ''.join(
+                            node.text or '' if node.tag == t_tag
+                            else '\t' if node.tag == tab_tag
+                            else '\n' if node.tag in breaks
+                            else ''
+                            for node in elem.iter()
+                        )
+                        if source is not None and text.strip():
+                            source.append(SourceParagraph(text, ordinal))
+                        if cells:
+                            cells[-1].append(text)
+                        elif text.strip():
+                            yield text
+                    elem.clear()
+                
+                elif tag == tc_tag:
+                    cell_text = '\n'.join(cells.pop())
+                    v_merge = elem.find(f'{W_NS}tcPr/{W_NS}vMerge')
+                    is_continuation = (
+                        v_merge is not None and v_merge.get(W_NS + 'val', 'continue') == 'continue'
+                    )
+                    if not is_continuation and cell_text.strip():
+                        if cells:
+                            # Nested table: its text belongs to the outer cell
+                            cells[-1].append(cell_text)
+                        else:
+                            yield cell_text
+                    elem.clear()
+                
+                elif tag == MC_FALLBACK:
+                    fallback_depth -= 1
+                    elem.clear()
+    
+    def _extract_from_pdf(self, file_content: UploadContent) -> str:
         """Extract text from PDF file"""
         try:
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+            return '\n\n'.join(
+                text for text in self.iter_pdf_pages(file_content) if text.strip()
+            )
+        except DocumentTooLargeError:
+            raise
+        except Exception as e:
+            raise ValueError(f"Failed to extract text from PDF: {str(e)}")
+    
+    def iter_pdf_pages(self, file_content: UploadContent) -> Iterator[str]:
+        """
+        Extract PDF text page by page
+        
+        Large PDFs are split into page ranges that are extracted in parallel
+        on the process pool. Pages are still yielded in order, as soon as the
+        range containing them is done.
+        
+        Args:
+            file_content: Raw PDF bytes (or a read-only mmap of them)
+            
+        Yields:
+            Text of each page in order
             
-            text_parts = []
+        Raises:
+            DocumentTooLargeError: If the PDF exceeds the byte or page limit
+                (checked before any page is extracted)
+        """
+        if len(file_content) > self.max_pdf_bytes:
+            raise DocumentTooLargeError(
+                f"PDF is larger than the {self.max_pdf_bytes // (1024 * 1024)} MB limit"
+            )
+        
+        pdf_reader = PyPDF2.PdfReader(open_stream(file_content))
+        page_count = len(pdf_reader.pages)
+        if page_count > self.max_pdf_pages:
+            raise DocumentTooLargeError(
+                f"PDF has {page_count} pages; the limit is {self.max_pdf_pages}"
+            )
+        
+        if self.pdf_workers <= 1 or page_count < self.PDF_PARALLEL_MIN_PAGES:
             for page in pdf_reader.pages:
-                text = page.extract_text()
-                if text.strip():
-                    text_parts.append(text)
+                yield page.extract_text()
+            return
+        
+        # Roughly two tasks per worker so a slow range doesn't idle the rest
+        per_task = max(self.PDF_MIN_PAGES_PER_TASK, -(-page_count // (self.pdf_workers * 2)))
+        
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as temp_file:
+            temp_file.write(file_content)
+            temp_file.flush()
             
-            return '\n\n'.join(text_parts)
-        except Exception as e:
-            raise ValueError(f"Failed to extract text from PDF: {str(e)}")
+            futures = [
+                self.pdf_pool.submit(
+                    _extract_pdf_page_range,
+                    temp_file.name, start, min(start + per_task, page_count)
+                )
+                for start in range(0, page_count, per_task)
+            ]
+            try:
+                for future in futures:
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
     
     def create_document(
         self, 
         content: str, 
         original_format: str = '.docx',
         output_format: str = '.docx',
-        include_latex: bool = False
+        include_latex: bool = False,
+        spans: Optional[List[Tuple[str, str]]] = None,
+        source: Optional[DocxSource] = None,
+        file_content: Optional[UploadContent] = None
     ) -> bytes:
         """
         Create a document from enhanced content
@@ -81,154 +336,64 @@ class DocumentConverter:
             original_format: Original file format
             output_format: Desired output format
             include_latex: Whether content includes LaTeX
+            spans: LaTeXContent.spans of the content if it was already scanned
+                for equations (saves scanning it again)
+            source: Paragraph map of the uploaded DOCX, from extract (optional)
+            file_content: The uploaded DOCX, patched in place when source is
+                given (optional)
             
         Returns:
             Document file as bytes
         """
         if output_format == '.docx':
-            return self._create_docx(content, include_latex)
+            return self._create_docx(content, include_latex, spans, source, file_content)
         elif output_format == '.pdf':
-            # For PDF, first create DOCX then convert
-            # In production, you'd use pandoc or similar
-            docx_bytes = self._create_docx(content, include_latex)
-            # For now, return DOCX (PDF conversion requires additional tools)
-            return docx_bytes
+            return self.pdf_renderer.render(parse_blocks(content, include_latex, spans))
         else:
             raise ValueError(f"Unsupported output format: {output_format}")
     
-    def _create_docx(self, content: str, include_latex: bool = False) -> bytes:
+    def _create_docx(
+        self,
+        content: str,
+        include_latex: bool = False,
+        spans: Optional[List[Tuple[str, str]]] = None,
+        source: Optional[DocxSource] = None,
+        file_content: Optional[UploadContent] = None
+    ) -> bytes:
         """
         Create DOCX document from content
         
+        The uploaded DOCX, when there is one, keeps its formatting: the
+        enhanced text is written into it by the patcher. Documents it can't
+        patch, and other uploads, are rendered from scratch.
+        
         Args:
             content: Enhanced content
             include_latex: Whether to preserve LaTeX formatting
+            spans: LaTeXContent.spans of the content (optional)
+            source: Paragraph map of the uploaded DOCX (optional)
+            file_content: The uploaded DOCX (optional)
             
         Returns:
             DOCX file as bytes
         """
-        doc = Document()
-        
-        # Set document styling
-        style = doc.styles['Normal']
-        font = style.font
-        font.name = 'Calibri'
-        font.size = Pt(11)
-        
-        # Process content line by line
-        lines = content.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            
-            if not line:
-                # Add empty paragraph for spacing
-                doc.add_paragraph()
-                continue
-            
-            # Detect headings (lines that are all caps or start with #)
-            if line.isupper() and len(line.split()) <= 10:
-                # Likely a heading
-                heading = doc.add_heading(line, level=1)
-            elif line.startswith('# '):
-                # Markdown-style heading
-                heading_text = line.replace('#', '').strip()
-                heading_level = min(len(line) - len(line.lstrip('#')), 3)
-                doc.add_heading(heading_text, level=heading_level)
-            elif include_latex and ('$' in line):
-                # Handle LaTeX equations
-                self._add_latex_paragraph(doc, line)
-            else:
-                # Regular paragraph
-                para = doc.add_paragraph(line)
-                
-                # Check if it's a bullet point
-                if line.startswith('- ') or line.startswith('• '):
-                    para.style = 'List Bullet'
-                    para.text = line[2:].strip()
-                elif re.match(r'^\d+\.', line):
-                    para.style = 'List Number'
-                    para.text = re.sub(r'^\d+\.\s*', '', line)
-        
-        # Save to bytes
-        output_buffer = io.BytesIO()
-        doc.save(output_buffer)
-        output_buffer.seek(0)
-        
-        return output_buffer.getvalue()
-    
-    def _add_latex_paragraph(self, doc: Document, line: str):
-        """
-        Add paragraph with LaTeX equations
-        
-        For display equations ($$...$$), center them
-        For inline equations ($...$), keep them inline with special formatting
-        """
-        # Check if it's a display equation
-        if '$$' in line:
-            # Display equation - center it
-            equation_match = re.search(r'\$\$(.*?)\$\$', line)
-            if equation_match:
-                equation_text = equation_match.group(1).strip()
-                para = doc.add_paragraph()
-                para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                run = para.add_run(equation_text)
-                run.font.name = 'Cambria Math'
-                run.font.size = Pt(12)
-                run.italic = True
-        else:
-            # Inline equation or mixed text
-            para = doc.add_paragraph()
-            
-            # Split by $ to find equations
-            parts = line.split('$')
-            for i, part in enumerate(parts):
-                if i % 2 == 0:
-                    # Regular text
-                    if part:
-                        para.add_run(part)
-                else:
-                    # Equation
-                    run = para.add_run(part)
-                    run.font.name = 'Cambria Math'
-                    run.italic = True
-    
-    def preserve_formatting(self, original_doc: Document, enhanced_content: str) -> Document:
-        """
-        Attempt to preserve original document formatting
-        
-        Args:
-            original_doc: Original document
-            enhanced_content: Enhanced text content
-            
-        Returns:
-            New document with enhanced content and preserved formatting
-        """
-        # This is a simplified version
-        # In production, you'd want more sophisticated formatting preservation
-        new_doc = Document()
-        
-        # Copy styles from original
-        for style in original_doc.styles:
+        blocks = parse_blocks(content, include_latex, spans)
+        if source is not None and file_content is not None and self.docx_patcher.enabled:
             try:
-                if style.name not in new_doc.styles:
-                    new_doc.styles.add_style(style.name, style.type)
-            except:
-                pass
-        
-        # Add enhanced content
-        for line in enhanced_content.split('\n'):
-            if line.strip():
-                new_doc.add_paragraph(line)
-        
-        return new_doc
+                return self.docx_patcher.patch(file_content, source, blocks)
+            except PatchingNotSupported as e:
+                print(f"DOCX patching not possible, rebuilding: {str(e)}")
+        return self.docx_renderer.render(blocks)
 
-    def add_signature(self, file_content: bytes, signature_data: str, position: str = 'bottom-right', signer_name: str = None) -> bytes:
+    def add_signature(self, file_content: UploadContent, signature_data: str, position: str = 'bottom-right', signer_name: str = None) -> bytes:
         """
         Add signature to document
         
+        The package is patched in place by the signature stamper; documents
+        it cannot patch go through python-docx instead.
+        
         Args:
-            file_content: Original DOCX content
+            file_content: Original DOCX content (bytes or a read-only mmap)
             signature_data: Base64 encoded signature image
             position: Position of signature (bottom-right, bottom-center, bottom-left)
             signer_name: Optional name of signer
@@ -237,48 +402,44 @@ class DocumentConverter:
             Signed document bytes
         """
         try:
-            doc = Document(io.BytesIO(file_content))
-            
-            # Decode signature image
-            if ',' in signature_data:
-                signature_data = signature_data.split(',')[1]
-            image_data = base64.b64decode(signature_data)
-            image_stream = io.BytesIO(image_data)
-            
-            # Add some spacing
-            doc.add_paragraph()
-            doc.add_paragraph()
-            
-            # Add signature paragraph
-            sig_para = doc.add_paragraph()
-            
-            # Set alignment based on position
-            if 'right' in position:
-                sig_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif 'center' in position:
-                sig_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            else:
-                sig_para.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                
-            # Add image
-            run = sig_para.add_run()
-            run.add_picture(image_stream, width=Inches(2.0))
-            
-            # Add signer name if provided
-            if signer_name:
-                name_para = doc.add_paragraph(signer_name)
-                if 'right' in position:
-                    name_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                elif 'center' in position:
-                    name_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                else:
-                    name_para.alignment = WD_ALIGN_PARAGRAPH.LEFT
-            
-            # Save
-            output_buffer = io.BytesIO()
-            doc.save(output_buffer)
-            output_buffer.seek(0)
-            return output_buffer.getvalue()
-            
+            try:
+                return self.signature_stamper.stamp(file_content, signature_data, position, signer_name)
+            except StampingNotSupported as e:
+                print(f"Signature stamping not possible, using python-docx: {str(e)}")
+            return self._add_signature_docx(file_content, signature_data, position, signer_name)
         except Exception as e:
             raise ValueError(f"Failed to add signature: {str(e)}")
+    
+    def _add_signature_docx(self, file_content: UploadContent, signature_data: str, position: str, signer_name: str = None) -> bytes:
+        """Add a signature by loading and re-saving the whole document"""
+        doc = Document(open_stream(file_content))
+        image = self.signature_stamper.load_image(signature_data)
+        
+        # Add some spacing
+        doc.add_paragraph()
+        doc.add_paragraph()
+        
+        # Add signature paragraph
+        sig_para = doc.add_paragraph()
+        
+        # Set alignment based on position
+        if 'right' in position:
+            sig_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+        elif 'center' in position:
+            sig_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        else:
+            sig_para.alignment = WD_ALIGN_PARAGRAPH.LEFT
+            
+        # Add image
+        run = sig_para.add_run()
+        run.add_picture(io.BytesIO(image.blob), width=Inches(2.0))
+        
+        # Add signer name if provided
+        if signer_name:
+            name_para = doc.add_paragraph(signer_name)
+            name_para.alignment = sig_para.alignment
+        
+        # Save
+        output_buffer = io.BytesIO()
+        doc.save(output_buffer)
+        return output_buffer.getvalue()
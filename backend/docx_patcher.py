@@ -0,0 +1,662 @@
+import copy
+import io
+import os
+import re
+import threading
+import zipfile
+from bisect import bisect_left
+from collections import Counter
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from docx.oxml.ns import nsdecls
+from lxml import etree
+
+from document_blocks import NUMBERED_ITEM, Block
+from docx_renderer import INVALID_XML_CHARS, MATH_RUN_PROPERTIES, RUN_SPECIAL_CHARS, DocxRenderer
+from upload_spool import UploadContent, open_stream
+from zip_parts import UnsupportedEntry, compressed_entry, read_local_data, write_raw
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+MAIN_DOCUMENT = 'word/document.xml'
+
+P, R, T, PPR, RPR = W_NS + 'p', W_NS + 'r', W_NS + 't', W_NS + 'pPr', W_NS + 'rPr'
+TAB, BR, CR, SECT_PR, BODY = W_NS + 'tab', W_NS + 'br', W_NS + 'cr', W_NS + 'sectPr', W_NS + 'body'
+
+# Run children that only carry text; runs holding anything else (drawings,
+# fields, note references, page breaks) are never rewritten
+TEXT_RUN_CHILDREN = {RPR, T, TAB, BR, CR, W_NS + 'lastRenderedPageBreak'}
+
+# Inline elements whose runs are part of the paragraph's own text
+RUN_CONTAINERS = {W_NS + 'hyperlink', W_NS + 'smartTag', W_NS + 'customXml', W_NS + 'ins'}
+
+# Paragraph children that go with a removed paragraph; anything else
+# (bookmarks, comments, equations) keeps it in place with its text cleared
+REMOVABLE_CHILDREN = {PPR, R, W_NS + 'proofErr'}
+
+WORD = re.compile(r'\w+')
+LIST_MARKER = re.compile(r'^(?:\d+\.\s*|[-•]\s+|#+\s+)')
+
+XML_PARSER = etree.XMLParser(huge_tree=True, resolve_entities=False)
+
+
+class PatchingNotSupported(Exception):
+    """The document can't be patched in place and is rebuilt instead"""
+
+
+@dataclass
+class SourceParagraph:
+    """One extracted paragraph of an uploaded DOCX"""
+    text: str
+    # Index of the <w:p> among all paragraphs of the main document part, in
+    # document order; None for header, footer and note text, which is kept
+    ordinal: Optional[int] = None
+
+
+@dataclass
+class DocxSource:
+    """The paragraph-ID map of an uploaded DOCX, recorded during extraction"""
+    digest: str
+    paragraphs: List[SourceParagraph]
+
+
+def _key(text: str) -> str:
+    """Paragraph text as compared when aligning: no list marker or spacing differences"""
+    return ' '.join(LIST_MARKER.sub('', text.strip()).split())
+
+
+def _similarity(a: frozenset, b: frozenset) -> float:
+    """Share of words two paragraphs have in common"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _common_prefix(a: str, b: str) -> int:
+    """Length of the common start of two strings, compared a slice at a time"""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _block_text(block: Block) -> str:
+    if block.kind == 'display_math':
+        return f"$${block.text}$$"
+    return block.text
+
+
+def _unique_anchors(a: List[str], b: List[str]) -> List[Tuple[int, int]]:
+    """
+    Pairs (i, j) with a[i] == b[j] where the item occurs once in each list,
+    keeping the longest run of them that is in order in both
+    """
+    count_a, count_b = Counter(a), Counter(b)
+    position = {item: j for j, item in enumerate(b) if count_b[item] == 1}
+    pairs = [(i, position[item]) for i, item in enumerate(a) if count_a[item] == 1 and item in position]
+
+    # Longest increasing subsequence of j (pairs are already ordered by i)
+    tails, tail_pairs = [], []
+    previous = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        x = bisect_left(tails, j)
+        if x == len(tails):
+            tails.append(j)
+            tail_pairs.append(k)
+        else:
+            tails[x] = j
+            tail_pairs[x] = k
+        previous[k] = tail_pairs[x - 1] if x else None
+
+    anchors = []
+    k = tail_pairs[-1] if tail_pairs else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = previous[k]
+    return anchors[::-1]
+
+
+def diff(a: List[str], b: List[str]) -> Iterator[Tuple[str, int, int, int, int]]:
+    """
+    SequenceMatcher-style opcodes between two lists of paragraph keys
+
+    Paragraphs that occur once on each side anchor the alignment (as in
+    patience diff), so only the short runs between anchors go through
+    SequenceMatcher. Edited documents are mostly anchors, which keeps this
+    near linear where SequenceMatcher alone is not.
+    """
+    i0 = j0 = 0
+    for i, j in _unique_anchors(a, b) + [(len(a), len(b))]:
+        if i - i0 > 1 and j - j0 > 1:
+            matcher = SequenceMatcher(None, a[i0:i], b[j0:j], autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                yield tag, i0 + i1, i0 + i2, j0 + j1, j0 + j2
+        elif i > i0 or j > j0:
+            tag = 'replace' if i > i0 and j > j0 else 'delete' if i > i0 else 'insert'
+            yield tag, i0, i, j0, j
+        if i < len(a):
+            yield 'equal', i, i + 1, j, j + 1
+        i0, j0 = i + 1, j + 1
+
+
+def _own_runs(parent) -> List:
+    """Runs of a paragraph, including those in hyperlinks and tracked insertions"""
+    runs = []
+    for child in parent:
+        if child.tag == R:
+            runs.append(child)
+        elif child.tag in RUN_CONTAINERS:
+            runs.extend(_own_runs(child))
+    return runs
+
+
+def _is_text_run(run) -> bool:
+    for child in run:
+        if child.tag not in TEXT_RUN_CHILDREN:
+            return False
+        if child.tag == BR and child.get(W_NS + 'type') not in (None, 'textWrapping'):
+            return False
+    return True
+
+
+def _run_text(run) -> str:
+    return ''.join(
+        child.text or '' if child.tag == T
+        else '\t' if child.tag == TAB
+        else '\n' if child.tag in (BR, CR)
+        else ''
+        for child in run
+    )
+
+
+def _set_run_text(run, text: str):
+    """Replace a run's text nodes, splitting tabs and line breaks the way the renderer does"""
+    for child in list(run):
+        if child.tag != RPR:
+            run.remove(child)
+    for piece in RUN_SPECIAL_CHARS.split(INVALID_XML_CHARS.sub('', text)):
+        if piece == '\t':
+            etree.SubElement(run, TAB)
+        elif piece in ('\r', '\n'):
+            etree.SubElement(run, BR)
+        elif piece:
+            node = etree.SubElement(run, T)
+            node.text = piece
+            if len(piece.strip()) < len(piece):
+                node.set(XML_SPACE, 'preserve')
+
+
+def _remove(element):
+    """Remove an element, and inline containers (hyperlinks) it leaves empty"""
+    parent = element.getparent()
+    parent.remove(element)
+    while parent.tag in RUN_CONTAINERS and not len(parent):
+        grandparent = parent.getparent()
+        grandparent.remove(parent)
+        parent = grandparent
+
+
+class DocxPatcher:
+    """
+    Writes enhanced text back into the uploaded DOCX instead of rebuilding it
+
+    Enhanced blocks are aligned to the paragraphs recorded at extraction with
+    a sequence diff. Only paragraphs whose text changed are touched, and only
+    their text runs: within a paragraph, words are aligned again so unchanged
+    words keep their run (bold, links, fonts) and new words take the
+    formatting of the text before them. Blocks with no counterpart become new
+    paragraphs formatted like their neighbour; paragraphs with none are
+    removed. Every zip entry but the main document part is copied across
+    still compressed, so media, styles and numbering come back byte for byte.
+    """
+
+    def __init__(self, renderer: Optional[DocxRenderer] = None, enabled: bool = True):
+        """
+        Initialize patcher
+
+        Args:
+            renderer: Renderer whose equation converter writes patched equations
+                (default: a new one)
+            enabled: False rebuilds every document
+        """
+        self.renderer = renderer or DocxRenderer()
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.stats = {
+            'documents': 0,
+            'kept': 0,
+            'rewritten': 0,
+            'inserted': 0,
+            'removed': 0,
+        }
+
+    @classmethod
+    def from_env(cls, renderer: Optional[DocxRenderer] = None) -> 'DocxPatcher':
+        """Build a patcher from DOCX_PATCH"""
+        return cls(renderer, enabled=os.getenv('DOCX_PATCH', '1') != '0')
+
+    def _count(self, counts: Dict[str, int]):
+        with self._lock:
+            self.stats['documents'] += 1
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    # -- alignment -----------------------------------------------------------
+
+    # Changed runs of paragraphs up to this many old x new pairs are matched
+    # by word overlap; larger ones are spread over each other in order
+    MATCH_CELLS = 40000
+
+    # Score of pairing a paragraph with a block on top of their overlap, so
+    # that rewritten paragraphs keep their place (and formatting) rather than
+    # being removed and inserted again
+    PAIR_BONUS = 0.2
+
+    @classmethod
+    def _pair(cls, original: List[str], enhanced: List[str]) -> List[Optional[int]]:
+        """
+        Match changed paragraphs to changed blocks by word overlap, in order
+
+        Returns:
+            For each original paragraph, the index of its block or None
+        """
+        old_words = [frozenset(WORD.findall(text.lower())) for text in original]
+        new_words = [frozenset(WORD.findall(text.lower())) for text in enhanced]
+        n, m = len(original), len(enhanced)
+        # score[i][j]: best pairing of the first i paragraphs with the first j blocks
+        score = [[0.0] * (m + 1) for _ in range(n + 1)]
+        for i in range(1, n + 1):
+            row, previous = score[i], score[i - 1]
+            for j in range(1, m + 1):
+                row[j] = max(
+                    previous[j],
+                    row[j - 1],
+                    previous[j - 1] + cls.PAIR_BONUS + _similarity(old_words[i - 1], new_words[j - 1])
+                )
+        pairs = [None] * n
+        i, j = n, m
+        while i and j:
+            if score[i][j] == score[i - 1][j]:
+                i -= 1
+            elif score[i][j] == score[i][j - 1]:
+                j -= 1
+            else:
+                pairs[i - 1] = j - 1
+                i -= 1
+                j -= 1
+        return pairs
+
+    @classmethod
+    def align(cls, source: DocxSource, blocks: List[Block]):
+        """
+        Assign enhanced blocks to source paragraphs
+
+        Args:
+            source: Paragraph map from extraction
+            blocks: Blocks of the enhanced content
+
+        Returns:
+            (replacements, after, leading): replacements[i] is the blocks that
+            replace paragraph i (None when it is unchanged, [] when it goes),
+            after[i] the blocks inserted after it, and leading the blocks
+            that come before the first paragraph
+        """
+        units = [block for block in blocks if block.kind != 'empty']
+        original = [_key(paragraph.text) for paragraph in source.paragraphs]
+        enhanced = [_key(_block_text(block)) for block in units]
+
+        replacements = [None] * len(original)
+        after = [[] for _ in original]
+        leading = []
+        for tag, i1, i2, j1, j2 in diff(original, enhanced):
+            if tag == 'equal':
+                continue
+            if i1 == i2:
+                (after[i1 - 1] if i1 else leading).extend(units[j1:j2])
+                continue
+            count, new_count = i2 - i1, j2 - j1
+            if count == new_count or count * new_count > cls.MATCH_CELLS:
+                # Spread the new blocks over the old paragraphs in order
+                for k in range(count):
+                    replacements[i1 + k] = units[j1 + k * new_count // count:j1 + (k + 1) * new_count // count]
+                continue
+
+            pairs = cls._pair(original[i1:i2], enhanced[j1:j2])
+            # Unpaired blocks go after the paragraph before them
+            target = after[i1 - 1] if i1 else leading
+            j = j1
+            for k, pair in enumerate(pairs):
+                if pair is None:
+                    replacements[i1 + k] = []
+                else:
+                    target.extend(units[j:j1 + pair])
+                    replacements[i1 + k] = [units[j1 + pair]]
+                    j = j1 + pair + 1
+                target = after[i1 + k]
+            target.extend(units[j:j2])
+        return replacements, after, leading
+
+    # -- writing -------------------------------------------------------------
+
+    def _math_elements(self, block: Block, properties) -> List:
+        """Runs and equations for a block with LaTeX, text runs formatted with properties"""
+        if block.kind == 'display_math':
+            omml = self.renderer.omml_converter.convert(block.text)
+            if omml is not None:
+                xml = f'<m:oMathPara>{omml}</m:oMathPara>'
+            else:
+                xml = self.renderer.run_xml(block.text, MATH_RUN_PROPERTIES)
+            return list(etree.fromstring(f'<w:p {nsdecls("w", "m")}>{xml}</w:p>'))
+
+        elements = []
+        for is_math, text in block.segments:
+            if is_math:
+                fragment = f'<w:p {nsdecls("w", "m")}>{self.renderer._math_xml(text)}</w:p>'
+                elements.extend(etree.fromstring(fragment))
+            elif text:
+                run = etree.Element(R)
+                if properties is not None:
+                    run.append(copy.deepcopy(properties))
+                _set_run_text(run, text)
+                elements.append(run)
+        return elements
+
+    @staticmethod
+    def _block_text_for(block: Block, original: str) -> str:
+        """Plain text of a block, keeping a list marker the original typed out"""
+        text = block.text
+        if block.kind == 'number':
+            marker = NUMBERED_ITEM.match(original.strip())
+            if marker:
+                return marker.group(0) + text
+        if block.kind == 'bullet' and original.strip()[:2] in ('- ', '• '):
+            return original.strip()[:2] + text
+        return text
+
+    @staticmethod
+    def _rewrite_runs(runs: List, text: str) -> bool:
+        """
+        Spread new text over a paragraph's text runs
+
+        Text the paragraph starts and ends with as before stays in its runs;
+        the changed span between is shared out by _spread.
+
+        Returns:
+            Whether any run changed
+        """
+        old_texts = [_run_text(run) for run in runs]
+        if len(runs) == 1:
+            if text == old_texts[0]:
+                return False
+            _set_run_text(runs[0], text)
+            return True
+
+        old = ''.join(old_texts)
+        bounds = [0]
+        for old_text in old_texts:
+            bounds.append(bounds[-1] + len(old_text))
+        start = _common_prefix(old, text)
+        end = _common_prefix(old[start:][::-1], text[start:][::-1])
+        old_end, new_end = len(old) - end, len(text) - end
+
+        pieces = [[] for _ in runs]
+        for index in range(len(runs)):
+            if bounds[index] < start:
+                pieces[index].append(old[bounds[index]:min(bounds[index + 1], start)])
+
+        new = text[start:new_end]
+        if new:
+            changed = {
+                index: old[max(bounds[index], start):min(bounds[index + 1], old_end)]
+                for index in range(len(runs))
+                if bounds[index] < old_end and bounds[index + 1] > start
+            }
+            before = max((index for index in range(len(runs)) if bounds[index] < start), default=None)
+            if len(changed) == 1:
+                pieces[next(iter(changed))].append(new)
+            elif not changed:
+                # Inserted text takes the run before it
+                pieces[before if before is not None else 0].append(new)
+            else:
+                DocxPatcher._spread(pieces, changed, new, before)
+
+        for index in range(len(runs)):
+            if bounds[index + 1] > old_end:
+                pieces[index].append(old[max(bounds[index], old_end):bounds[index + 1]])
+
+        changed_any = False
+        for run, old_text, piece in zip(runs, old_texts, pieces):
+            new_text = ''.join(piece)
+            if not new_text:
+                _remove(run)
+                changed_any = True
+            elif new_text != old_text:
+                _set_run_text(run, new_text)
+                changed_any = True
+        return changed_any
+
+    @staticmethod
+    def _spread(pieces: List[List[str]], texts: Dict[int, str], new: str, before: Optional[int]):
+        """
+        Share changed text spanning several runs between them
+
+        Runs whose old text is still there, as whole words and in order, keep
+        it; text between two such runs goes to the first run between them
+        that lost its text (replaced words), or to the run before it
+        (inserted words).
+
+        Args:
+            pieces: New text of each run, appended to
+            texts: Old text of each run in the changed span, in order
+            new: New text of the span
+            before: Run of the text before the span (None at the start)
+        """
+        def aligned(position: int, end: int) -> bool:
+            return ((position == 0 or not (new[position - 1].isalnum() and new[position].isalnum()))
+                    and (end == len(new) or not (new[end - 1].isalnum() and new[end].isalnum())))
+
+        anchors = []
+        cursor = 0
+        for run, text in texts.items():
+            if not text.strip():
+                continue
+            position = new.find(text, cursor)
+            while position >= 0 and not aligned(position, position + len(text)):
+                position = new.find(text, position + 1)
+            if position >= 0:
+                anchors.append((run, position, position + len(text)))
+                cursor = position + len(text)
+
+        runs = list(texts)
+        previous, previous_end = before, 0
+        for run, position, end in anchors + [(None, len(new), len(new))]:
+            gap = new[previous_end:position]
+            if gap:
+                # Runs between the previous anchor and this one lost their text
+                lost = [r for r in runs if (previous is None or r > previous) and (run is None or r < run)]
+                owner = lost[0] if lost else previous if previous is not None else run
+                pieces[owner].append(gap)
+            if run is not None:
+                pieces[run].append(new[position:end])
+                previous, previous_end = run, end
+
+    def _fill(self, paragraph, runs: List, block: Block, original: str, properties) -> bool:
+        """
+        Put a block's content in a paragraph in place of its text runs
+
+        Returns:
+            Whether the paragraph changed
+        """
+        if block.kind not in ('math_paragraph', 'display_math'):
+            text = self._block_text_for(block, original)
+            if runs:
+                return self._rewrite_runs(runs, text)
+            run = etree.SubElement(paragraph, R)
+            if properties is not None:
+                run.append(copy.deepcopy(properties))
+            _set_run_text(run, text)
+            return True
+
+        elements = self._math_elements(block, properties)
+        if runs:
+            first = runs[0]
+            parent, index = first.getparent(), first.getparent().index(first)
+            parent[index:index] = elements
+            for run in runs:
+                _remove(run)
+        else:
+            paragraph.extend(elements)
+        return True
+
+    @staticmethod
+    def _run_properties(runs: List):
+        """Formatting of the first text run, which new text starts with"""
+        return runs[0].find(RPR) if runs else None
+
+    def _new_paragraph(self, template, block: Block):
+        """A paragraph for a block with no counterpart, formatted like template"""
+        paragraph = etree.Element(P)
+        properties = template.find(PPR)
+        if properties is not None:
+            properties = copy.deepcopy(properties)
+            for section in properties.findall(SECT_PR):
+                properties.remove(section)
+            paragraph.append(properties)
+        text_runs = [run for run in _own_runs(template) if _is_text_run(run)]
+        self._fill(paragraph, [], block, '', self._run_properties(text_runs))
+        return paragraph
+
+    @staticmethod
+    def _removable(paragraph) -> bool:
+        """Whether a paragraph can go without taking anything but its text"""
+        if paragraph.getparent().tag != BODY:
+            # Table cells need a paragraph
+            return False
+        if paragraph.find(f'{PPR}/{SECT_PR}') is not None:
+            return False
+        return all(_is_text_run(run) for run in _own_runs(paragraph)) and all(
+            child.tag in REMOVABLE_CHILDREN or child.tag in RUN_CONTAINERS for child in paragraph
+        )
+
+    def _patch_xml(self, document_xml: bytes, source: DocxSource, blocks: List[Block]) -> bytes:
+        """The main document part with the enhanced blocks written in"""
+        try:
+            root = etree.fromstring(document_xml, XML_PARSER)
+        except etree.XMLSyntaxError as e:
+            raise PatchingNotSupported(f"Main document is not well-formed: {str(e)}")
+        elements = list(root.iter(P))
+        body_paragraphs = [p for p in source.paragraphs if p.ordinal is not None]
+        if not body_paragraphs:
+            raise PatchingNotSupported("Document body has no text to patch")
+        if max(p.ordinal for p in body_paragraphs) >= len(elements):
+            raise PatchingNotSupported("Paragraph map does not match the document")
+
+        replacements, after, leading = self.align(source, blocks)
+        counts = {'kept': 0, 'rewritten': 0, 'inserted': 0, 'removed': 0}
+
+        def insert_after(anchor, template, new_blocks):
+            for block in new_blocks:
+                paragraph = self._new_paragraph(template, block)
+                anchor.addnext(paragraph)
+                anchor = paragraph
+                counts['inserted'] += 1
+
+        first = elements[body_paragraphs[0].ordinal]
+        for block in leading:
+            first.addprevious(self._new_paragraph(first, block))
+            counts['inserted'] += 1
+
+        # Blocks aligned to header or footer text go after the body text before it
+        previous = None
+        pending = []
+        for paragraph, replacement, following in zip(source.paragraphs, replacements, after):
+            if paragraph.ordinal is None:
+                pending.extend(following)
+                continue
+            element = elements[paragraph.ordinal]
+            if pending:
+                if previous is not None:
+                    insert_after(previous, previous, pending)
+                else:
+                    for block in pending:
+                        element.addprevious(self._new_paragraph(element, block))
+                        counts['inserted'] += 1
+                pending = []
+
+            if replacement is None:
+                counts['kept'] += 1
+                insert_after(element, element, following)
+                previous = element
+                continue
+
+            runs = [run for run in _own_runs(element) if _is_text_run(run)]
+            if not replacement:
+                insert_after(element, element, following)
+                if self._removable(element):
+                    element.getparent().remove(element)
+                    counts['removed'] += 1
+                    continue
+                for run in runs:
+                    _remove(run)
+                counts['rewritten'] += 1
+            elif runs:
+                insert_after(element, element, replacement[1:] + following)
+                properties = self._run_properties(runs)
+                if self._fill(element, runs, replacement[0], paragraph.text, properties):
+                    counts['rewritten'] += 1
+                else:
+                    counts['kept'] += 1
+            else:
+                # All of its text is in fields or drawings: leave it as it is
+                counts['kept'] += 1
+                insert_after(element, element, replacement[1:] + following)
+            previous = element
+        if pending:
+            insert_after(previous, previous, pending)
+
+        self._count(counts)
+        return etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+    def patch(self, file_content: UploadContent, source: DocxSource, blocks: List[Block]) -> bytes:
+        """
+        Write enhanced blocks into the uploaded DOCX
+
+        Args:
+            file_content: The uploaded DOCX (bytes or a read-only mmap)
+            source: Its paragraph map, from DocumentConverter.extract
+            blocks: Blocks of the enhanced content
+
+        Returns:
+            The patched DOCX file as bytes
+
+        Raises:
+            PatchingNotSupported: If the package can't be patched in place
+        """
+        try:
+            archive = zipfile.ZipFile(open_stream(file_content))
+        except zipfile.BadZipFile as e:
+            raise PatchingNotSupported(f"Not a DOCX file: {str(e)}")
+
+        with archive:
+            info = archive.NameToInfo.get(MAIN_DOCUMENT)
+            if info is None:
+                raise PatchingNotSupported("Package has no main document")
+            document_xml = self._patch_xml(archive.read(MAIN_DOCUMENT), source, blocks)
+
+            output_buffer = io.BytesIO()
+            try:
+                with zipfile.ZipFile(output_buffer, 'w') as output:
+                    for entry in archive.infolist():
+                        if entry.filename == MAIN_DOCUMENT:
+                            write_raw(output, *compressed_entry(MAIN_DOCUMENT, document_xml, info.date_time))
+                        else:
+                            write_raw(output, entry, read_local_data(file_content, entry))
+            except UnsupportedEntry as e:
+                raise PatchingNotSupported(str(e))
+            return output_buffer.getvalue()
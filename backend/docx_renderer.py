@@ -0,0 +1,151 @@
+import functools
+import io
+import re
+from typing import List, Optional
+from xml.sax.saxutils import escape
+
+from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.shared import Pt
+
+from document_blocks import Block
+from omml_converter import OmmlConverter
+
+# Characters XML 1.0 does not allow; python-docx would reject them too
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f￾￿]')
+RUN_SPECIAL_CHARS = re.compile(r'([\t\r\n])')
+
+STYLE_IDS = {
+    'bullet': 'ListBullet',
+    'number': 'ListNumber',
+}
+
+MATH_RUN_PROPERTIES = '<w:rFonts w:ascii="Cambria Math" w:hAnsi="Cambria Math"/><w:i/>'
+
+
+@functools.lru_cache(maxsize=1)
+def default_template() -> bytes:
+    """python-docx's default template, loaded once per process"""
+    buffer = io.BytesIO()
+    Document().save(buffer)
+    return buffer.getvalue()
+
+
+class DocxRenderer:
+    """
+    Renders a block model to DOCX by generating WordprocessingML in bulk
+
+    The body is built as one XML string, parsed once and spliced into the
+    default template, instead of going through python-docx's add_paragraph /
+    add_run for every line. The markup is the same python-docx would produce.
+    Equations are written as native Word equations (OMML); one that can't be
+    converted is written as its LaTeX source in Cambria Math instead.
+    """
+
+    def __init__(self, omml_converter: Optional[OmmlConverter] = None):
+        """
+        Initialize renderer
+
+        Args:
+            omml_converter: Equation converter, whose cache is shared by every
+                document rendered (default: a new one)
+        """
+        self.omml_converter = omml_converter or OmmlConverter()
+
+    def run_xml(self, text: str, properties: str = '') -> str:
+        """One <w:r>, splitting tabs and line breaks the way python-docx does"""
+        parts = ['<w:r>']
+        if properties:
+            parts.append(f'<w:rPr>{properties}</w:rPr>')
+        for piece in RUN_SPECIAL_CHARS.split(INVALID_XML_CHARS.sub('', text)):
+            if piece == '\t':
+                parts.append('<w:tab/>')
+            elif piece in ('\r', '\n'):
+                parts.append('<w:br/>')
+            elif piece:
+                space = ' xml:space="preserve"' if len(piece.strip()) < len(piece) else ''
+                parts.append(f'<w:t{space}>{escape(piece)}</w:t>')
+        parts.append('</w:r>')
+        return ''.join(parts)
+
+    def _paragraph_xml(self, runs: str, style_id: str = '', centered: bool = False) -> str:
+        properties = ''
+        if style_id:
+            properties += f'<w:pStyle w:val="{style_id}"/>'
+        if centered:
+            properties += '<w:jc w:val="center"/>'
+        if properties:
+            return f'<w:p><w:pPr>{properties}</w:pPr>{runs}</w:p>'
+        return f'<w:p>{runs}</w:p>'
+
+    def _math_xml(self, latex: str) -> str:
+        """Inline equation: an <m:oMath> among the paragraph's runs"""
+        omml = self.omml_converter.convert(latex)
+        if omml is None:
+            return self.run_xml(latex, MATH_RUN_PROPERTIES)
+        return omml
+
+    def block_xml(self, block: Block) -> str:
+        """WordprocessingML for one block"""
+        kind = block.kind
+
+        if kind == 'empty':
+            return '<w:p/>'
+        if kind == 'heading':
+            # python-docx maps level 0 to the Title style
+            style_id = 'Title' if block.level == 0 else f'Heading{block.level}'
+            return self._paragraph_xml(self.run_xml(block.text), style_id)
+        if kind in STYLE_IDS:
+            return self._paragraph_xml(self.run_xml(block.text), STYLE_IDS[kind])
+        if kind == 'display_math':
+            omml = self.omml_converter.convert(block.text)
+            if omml is not None:
+                return f'<w:p><m:oMathPara>{omml}</m:oMathPara></w:p>'
+            run = self.run_xml(block.text, MATH_RUN_PROPERTIES + '<w:sz w:val="24"/>')
+            return self._paragraph_xml(run, centered=True)
+        if kind == 'math_paragraph':
+            runs = ''.join(
+                self._math_xml(text) if is_math else self.run_xml(text)
+                for is_math, text in block.segments
+                # Empty text between '$' signs is dropped, empty math keeps its run
+                if is_math or text
+            )
+            return self._paragraph_xml(runs)
+        return self._paragraph_xml(self.run_xml(block.text))
+
+    def new_document(self) -> Document:
+        """Default template with the document-wide styling applied"""
+        doc = Document(io.BytesIO(default_template()))
+
+        # Set document styling
+        style = doc.styles['Normal']
+        font = style.font
+        font.name = 'Calibri'
+        font.size = Pt(11)
+
+        return doc
+
+    def render(self, blocks: List[Block]) -> bytes:
+        """
+        Render blocks to a DOCX file
+
+        Args:
+            blocks: Blocks from parse_blocks
+
+        Returns:
+            DOCX file as bytes
+        """
+        doc = self.new_document()
+
+        body_xml = ''.join(self.block_xml(block) for block in blocks)
+        fragment = parse_xml(f'<w:body {nsdecls("w", "m")}>{body_xml}</w:body>')
+
+        # Splice all paragraphs in before the section properties at once
+        body = doc.element.body
+        index = len(body) - 1 if body.sectPr is not None else len(body)
+        body[index:index] = list(fragment)
+
+        output_buffer = io.BytesIO()
+        doc.save(output_buffer)
+        return output_buffer.getvalue()
@@ -0,0 +1,474 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Iterator, Optional, Tuple
+
+from admission import AdmissionTicket
+from docx_patcher import DocxSource
+from latex_processor import stream_cut
+from metrics import RequestTrace, log_json
+from prompt_planner import PromptPlan, estimate_tokens
+
+
+class EnhancementError(Exception):
+    """Error caused by the request itself, reported to the client as-is"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class EnhancementRequest:
+    """An extracted upload together with everything that keys its result"""
+    extracted_text: str
+    file_ext: str
+    user_prompt: str
+    doc_type: str
+    has_math: bool
+    cache_key: str
+    output_format: str
+    plan: Optional[PromptPlan] = None
+    # Paragraph map of a DOCX upload the output is patched into
+    source: Optional[DocxSource] = None
+
+    @property
+    def document_key(self) -> str:
+        """Cache key of the rendered output document"""
+        if self.source is not None:
+            # A patched document also depends on everything but the text
+            return self.cache_key + self.source.digest + self.output_format
+        return self.cache_key + self.output_format
+
+
+class EnhancementPipeline:
+    """The extract → enhance → render pipeline behind /enhance and /jobs/enhance"""
+
+    STAGES = ('extracting', 'enhancing', 'rendering')
+
+    def __init__(
+        self,
+        gemini_client,
+        latex_processor,
+        doc_converter,
+        chunked_enhancer,
+        result_cache,
+        prompt_planner=None
+    ):
+        """
+        Initialize pipeline
+
+        Args:
+            gemini_client: Gemini client (model config is part of the cache key)
+            latex_processor: LaTeX processor
+            doc_converter: Document converter
+            chunked_enhancer: Enhancer that splits long documents
+            result_cache: Cache for enhanced text and rendered documents
+            prompt_planner: Planner that sizes (or rejects) the Gemini calls
+                before any is made (optional)
+        """
+        self.gemini_client = gemini_client
+        self.latex_processor = latex_processor
+        self.doc_converter = doc_converter
+        self.chunked_enhancer = chunked_enhancer
+        self.result_cache = result_cache
+        self.prompt_planner = prompt_planner
+
+    @staticmethod
+    def output_format_for(file_ext: str) -> str:
+        """Output format produced for an upload with the given extension"""
+        return file_ext if file_ext in ['.docx', '.pdf'] else '.docx'
+
+    def prepare(
+        self,
+        file_content: bytes,
+        file_ext: str,
+        user_prompt: str = "",
+        doc_type: str = "auto",
+        trace: Optional[RequestTrace] = None,
+        ticket: Optional[AdmissionTicket] = None
+    ) -> EnhancementRequest:
+        """
+        Extract and analyze an upload, everything before the Gemini call
+
+        Args:
+            file_content: Raw uploaded file bytes
+            file_ext: File extension (.docx, .pdf, .txt)
+            user_prompt: User's enhancement instructions
+            doc_type: Document type hint
+            trace: Trace collecting stage timings (optional)
+            ticket: Admission ticket, re-costed from the extracted text (optional)
+
+        Returns:
+            The prepared request
+            
+        Raises:
+            EnhancementError: If nothing could be extracted, or the prompt
+                plan rejects the document (413)
+        """
+        trace = trace or RequestTrace()
+        trace.set(bytes_in=len(file_content))
+        
+        # Extract text from document
+        with trace.span('extract_text'):
+            extracted_text, source = self.doc_converter.extract(file_content, file_ext)
+
+        if not extracted_text or len(extracted_text.strip()) < 10:
+            raise EnhancementError('Could not extract text from document')
+
+        # Detect if document contains mathematical/scientific content
+        with trace.span('detect_math'):
+            has_math = bool(self.latex_processor.detect_mathematical_content(extracted_text))
+        if ticket is not None:
+            ticket.refine(len(extracted_text), has_math)
+
+        plan = None
+        if self.prompt_planner is not None:
+            with trace.span('prompt_build'):
+                plan = self.prompt_planner.plan(extracted_text, user_prompt, doc_type, has_math)
+            trace.set(plan_action=plan.action, plan_chunks=plan.chunks)
+            log_json('prompt_plan', **plan.to_dict())
+            if plan.action == 'reject':
+                raise EnhancementError(plan.reason, status_code=413)
+
+        # Same text + same parameters + same model => same result (the model
+        # being the one the plan routes to)
+        cache_key = self.result_cache.make_key(
+            extracted_text,
+            user_prompt,
+            doc_type,
+            has_math,
+            plan.model_name if plan is not None and plan.model_name else self.gemini_client.model_name,
+            self.gemini_client.generation_config
+        )
+        
+        return EnhancementRequest(
+            extracted_text=extracted_text,
+            file_ext=file_ext,
+            user_prompt=user_prompt,
+            doc_type=doc_type,
+            has_math=has_math,
+            cache_key=cache_key,
+            output_format=self.output_format_for(file_ext),
+            plan=plan,
+            source=source
+        )
+
+    def render(
+        self,
+        prepared: EnhancementRequest,
+        enhanced_content: str,
+        already_processed: bool = False,
+        trace: Optional[RequestTrace] = None,
+        file_content: Optional[bytes] = None
+    ) -> bytes:
+        """
+        Post-process enhanced content and render the output document
+
+        Args:
+            prepared: Request from prepare
+            enhanced_content: Gemini output
+            already_processed: Content already went through process_latex_content
+                (as the pieces yielded by stream do)
+            trace: Trace collecting stage timings (optional)
+            file_content: The upload, which a DOCX output is patched into
+                (without it the document is rebuilt)
+
+        Returns:
+            Output document bytes
+        """
+        trace = trace or RequestTrace()
+        
+        # Process LaTeX in the enhanced content; the renderer reuses the
+        # equations found doing so
+        spans = None
+        if already_processed:
+            processed_content = enhanced_content
+        else:
+            with trace.span('process_latex'):
+                latex = self.latex_processor.normalize(enhanced_content)
+            processed_content, spans = latex.text, latex.spans
+
+        # Convert back to document format
+        with trace.span('render_document'):
+            output_file = self.doc_converter.create_document(
+                content=processed_content,
+                original_format=prepared.file_ext,
+                output_format=prepared.output_format,
+                include_latex=prepared.has_math,
+                spans=spans if prepared.has_math else None,
+                source=prepared.source,
+                file_content=file_content
+            )
+        self.result_cache.set('document', prepared.document_key, output_file)
+        trace.set(bytes_out=len(output_file))
+        return output_file
+
+    def _record_gemini_tokens(self, prepared: EnhancementRequest, enhanced_content: str, trace: RequestTrace):
+        """Estimated prompt/response tokens of the Gemini calls made for a request"""
+        if 'prompt_tokens' in trace.fields:
+            # Counted by the enhancer from the prompts it actually sent
+            # (sections reused from the cache cost nothing)
+            trace.set(response_tokens=estimate_tokens(enhanced_content))
+            return
+        if prepared.plan is not None:
+            prompt_tokens = prepared.plan.input_tokens + prepared.plan.chunks * prepared.plan.prompt_overhead_tokens
+        else:
+            prompt_tokens = estimate_tokens(prepared.extracted_text)
+        trace.set(prompt_tokens=prompt_tokens, response_tokens=estimate_tokens(enhanced_content))
+
+    def run(
+        self,
+        file_content: bytes,
+        file_ext: str,
+        user_prompt: str = "",
+        doc_type: str = "auto",
+        on_stage: Optional[Callable[[str], None]] = None,
+        trace: Optional[RequestTrace] = None,
+        ticket: Optional[AdmissionTicket] = None
+    ) -> Tuple[bytes, str]:
+        """
+        Enhance an uploaded document
+
+        Args:
+            file_content: Raw uploaded file bytes
+            file_ext: File extension (.docx, .pdf, .txt)
+            user_prompt: User's enhancement instructions
+            doc_type: Document type hint
+            on_stage: Called with each stage name as the pipeline reaches it
+            trace: Trace collecting stage timings, sizes and cache hits (optional)
+            ticket: Admission ticket of the request (optional)
+
+        Returns:
+            Tuple of (output document bytes, output format extension)
+        """
+        report = on_stage or (lambda stage: None)
+        trace = trace or RequestTrace()
+
+        report('extracting')
+        prepared = self.prepare(file_content, file_ext, user_prompt, doc_type, trace=trace, ticket=ticket)
+
+        output_file = self.result_cache.get('document', prepared.document_key)
+        trace.set(document_cache_hit=output_file is not None)
+        if output_file is not None:
+            trace.set(bytes_out=len(output_file))
+            return output_file, prepared.output_format
+
+        report('enhancing')
+        enhanced_content = self.result_cache.get_text('enhanced', prepared.cache_key)
+        trace.set(enhanced_cache_hit=enhanced_content is not None)
+        if enhanced_content is None:
+            # Use Gemini to enhance the content (long documents are split into
+            # sections and enhanced in parallel)
+            with trace.span('gemini'):
+                enhanced_content = self.chunked_enhancer.enhance(
+                    content=prepared.extracted_text,
+                    user_instructions=user_prompt,
+                    doc_type=doc_type,
+                    include_latex=prepared.has_math,
+                    plan=prepared.plan,
+                    trace=trace
+                )
+            self._record_gemini_tokens(prepared, enhanced_content, trace)
+            self.result_cache.set_text('enhanced', prepared.cache_key, enhanced_content)
+
+        report('rendering')
+        return self.render(prepared, enhanced_content, trace=trace, file_content=file_content), prepared.output_format
+
+    def stream(self, prepared: EnhancementRequest, trace: Optional[RequestTrace] = None) -> Iterator[str]:
+        """
+        Enhance a prepared request, yielding LaTeX-processed text as it arrives
+
+        Text is released one complete line at a time, and held back from the
+        start of a display equation until it is closed, so a piece is never
+        cut inside an equation that process_latex_content would join across
+        lines of the full output.
+
+        Args:
+            prepared: Request from prepare
+            trace: Trace collecting stage timings (optional)
+
+        Yields:
+            Processed enhanced text in order
+        """
+        trace = trace or RequestTrace()
+        enhanced_content = self.result_cache.get_text('enhanced', prepared.cache_key)
+        trace.set(enhanced_cache_hit=enhanced_content is not None)
+        if enhanced_content is not None:
+            with trace.span('process_latex'):
+                processed = self.latex_processor.process_latex_content(enhanced_content)
+            yield processed
+            return
+
+        received = []
+        pending = ''
+        # Waiting on Gemini and post-processing are interleaved; each is
+        # summed and recorded as one stage, not as one span per piece
+        gemini_seconds = 0.0
+        latex_seconds = 0.0
+        pieces = self.chunked_enhancer.enhance_stream(
+            content=prepared.extracted_text,
+            user_instructions=prepared.user_prompt,
+            doc_type=prepared.doc_type,
+            include_latex=prepared.has_math,
+            plan=prepared.plan
+        )
+        while True:
+            start = time.perf_counter()
+            piece = next(pieces, None)
+            gemini_seconds += time.perf_counter() - start
+            if piece is None:
+                break
+            received.append(piece)
+            pending += piece
+            cut = stream_cut(pending)
+            if cut >= 0:
+                ready, pending = pending[:cut + 1], pending[cut + 1:]
+                start = time.perf_counter()
+                processed = self.latex_processor.process_latex_content(ready)
+                latex_seconds += time.perf_counter() - start
+                yield processed
+        if pending:
+            start = time.perf_counter()
+            processed = self.latex_processor.process_latex_content(pending)
+            latex_seconds += time.perf_counter() - start
+            yield processed
+
+        trace.record('gemini', gemini_seconds)
+        trace.record('process_latex', latex_seconds)
+        enhanced_content = ''.join(received)
+        self._record_gemini_tokens(prepared, enhanced_content, trace)
+        self.result_cache.set_text('enhanced', prepared.cache_key, enhanced_content)
+
+    @staticmethod
+    def _offload(executor: Optional[Executor], fn, *args, **kwargs):
+        """Run blocking work (extraction, rendering, cache I/O) off the event loop"""
+        return asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+    async def run_async(
+        self,
+        file_content: bytes,
+        file_ext: str,
+        user_prompt: str = "",
+        doc_type: str = "auto",
+        trace: Optional[RequestTrace] = None,
+        executor: Optional[Executor] = None,
+        ticket: Optional[AdmissionTicket] = None
+    ) -> Tuple[bytes, str]:
+        """
+        run for the async serving mode
+
+        The Gemini calls are coroutines, so waiting on them holds no thread;
+        extraction, rendering and cache I/O run on executor.
+
+        Args:
+            file_content: Raw uploaded file bytes
+            file_ext: File extension (.docx, .pdf, .txt)
+            user_prompt: User's enhancement instructions
+            doc_type: Document type hint
+            trace: Trace collecting stage timings, sizes and cache hits (optional)
+            executor: Pool for the blocking stages (default: the loop's default executor)
+            ticket: Admission ticket of the request (optional)
+
+        Returns:
+            Tuple of (output document bytes, output format extension)
+        """
+        trace = trace or RequestTrace()
+
+        prepared = await self._offload(
+            executor, self.prepare, file_content, file_ext, user_prompt, doc_type, trace=trace, ticket=ticket
+        )
+
+        output_file = await self._offload(executor, self.result_cache.get, 'document', prepared.document_key)
+        trace.set(document_cache_hit=output_file is not None)
+        if output_file is not None:
+            trace.set(bytes_out=len(output_file))
+            return output_file, prepared.output_format
+
+        enhanced_content = await self._offload(executor, self.result_cache.get_text, 'enhanced', prepared.cache_key)
+        trace.set(enhanced_cache_hit=enhanced_content is not None)
+        if enhanced_content is None:
+            with trace.span('gemini'):
+                enhanced_content = await self.chunked_enhancer.enhance_async(
+                    content=prepared.extracted_text,
+                    user_instructions=user_prompt,
+                    doc_type=doc_type,
+                    include_latex=prepared.has_math,
+                    plan=prepared.plan,
+                    trace=trace
+                )
+            self._record_gemini_tokens(prepared, enhanced_content, trace)
+            await self._offload(executor, self.result_cache.set_text, 'enhanced', prepared.cache_key, enhanced_content)
+
+        output_file = await self._offload(
+            executor, self.render, prepared, enhanced_content, trace=trace, file_content=file_content
+        )
+        return output_file, prepared.output_format
+
+    async def stream_async(
+        self,
+        prepared: EnhancementRequest,
+        trace: Optional[RequestTrace] = None,
+        executor: Optional[Executor] = None
+    ) -> AsyncIterator[str]:
+        """
+        stream for the async serving mode
+
+        Args:
+            prepared: Request from prepare
+            trace: Trace collecting stage timings (optional)
+            executor: Pool for LaTeX processing and cache I/O (default: the
+                loop's default executor)
+
+        Yields:
+            Processed enhanced text in order
+        """
+        trace = trace or RequestTrace()
+        process = self.latex_processor.process_latex_content
+        enhanced_content = await self._offload(executor, self.result_cache.get_text, 'enhanced', prepared.cache_key)
+        trace.set(enhanced_cache_hit=enhanced_content is not None)
+        if enhanced_content is not None:
+            with trace.span('process_latex'):
+                processed = await self._offload(executor, process, enhanced_content)
+            yield processed
+            return
+
+        received = []
+        pending = ''
+        gemini_seconds = 0.0
+        latex_seconds = 0.0
+        pieces = aiter(self.chunked_enhancer.enhance_stream_async(
+            content=prepared.extracted_text,
+            user_instructions=prepared.user_prompt,
+            doc_type=prepared.doc_type,
+            include_latex=prepared.has_math,
+            plan=prepared.plan
+        ))
+        while True:
+            start = time.perf_counter()
+            piece = await anext(pieces, None)
+            gemini_seconds += time.perf_counter() - start
+            if piece is None:
+                break
+            received.append(piece)
+            pending += piece
+            cut = stream_cut(pending)
+            if cut >= 0:
+                ready, pending = pending[:cut + 1], pending[cut + 1:]
+                start = time.perf_counter()
+                processed = await self._offload(executor, process, ready)
+                latex_seconds += time.perf_counter() - start
+                yield processed
+        if pending:
+            start = time.perf_counter()
+            processed = await self._offload(executor, process, pending)
+            latex_seconds += time.perf_counter() - start
+            yield processed
+
+        trace.record('gemini', gemini_seconds)
+        trace.record('process_latex', latex_seconds)
+        enhanced_content = ''.join(received)
+        self._record_gemini_tokens(prepared, enhanced_content, trace)
+        await self._offload(executor, self.result_cache.set_text, 'enhanced', prepared.cache_key, enhanced_content)
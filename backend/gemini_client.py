@@ -1,28 +1,123 @@
+import asyncio
 import os
-import google.generativeai as genai
-from typing import Optional
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from model_router import ModelRouter, Route
+from prompt_planner import estimate_tokens
+from rate_limiter import RateLimiter
+from result_cache import ResultCache
+from single_flight import FlightFailed, SingleFlight
+
+# Upstream errors worth another attempt: quota, overload and timeouts
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError)
+
+# The same from google.api_core.exceptions, matched by name (with their
+# subclasses) because importing that module loads grpc and protobuf
+GOOGLE_EXCEPTIONS_MODULE = 'google.api_core.exceptions'
+RETRYABLE_GOOGLE_ERRORS = frozenset({
+    'TooManyRequests',
+    'ResourceExhausted',
+    'ServiceUnavailable',
+    'InternalServerError',
+    'DeadlineExceeded',
+    'Aborted',
+})
+
+
+class GeminiError(Exception):
+    """A Gemini call that failed after all retries"""
+
+    def __init__(self, message: str, retryable: bool = False, status_code: int = 502):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
+
+
+class _InFlightSlot:
+    """One permit of the in-flight semaphore, safe to release from either side of a timeout"""
+
+    def __init__(self, semaphore: threading.BoundedSemaphore):
+        self._semaphore = semaphore
+        self._lock = threading.Lock()
+        self._held = True
+
+    def release(self):
+        with self._lock:
+            if self._held:
+                self._held = False
+                self._semaphore.release()
+
 
 class GeminiClient:
-    """Client for interacting with Google Gemini API"""
+    """
+    Client for interacting with Google Gemini API
+
+    Every call goes through the same guard rails:
+    - a shared token bucket on requests and estimated tokens per minute
+    - a bounded number of calls in flight in this process
+    - a deadline per attempt
+    - exponential backoff with full jitter on retryable errors
+    
+    Identical unary calls in flight at the same time, in this process or any
+    worker on the host, are made once and share the outcome (single-flight).
     
-    def __init__(self, api_key: Optional[str] = None):
+    Calls go to the model of a route chosen by the router (see ModelRouter);
+    a unary attempt still running at its route's p95 latency is hedged with a
+    second attempt, if rate budget and a permit are free, and the first to
+    answer is used.
+    """
+    
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model=None,
+        rate_limiter: Optional[RateLimiter] = None,
+        timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+        rate_limit_wait: Optional[float] = None,
+        sleep: Callable[[float], None] = time.sleep,
+        metrics=None,
+        async_max_in_flight: Optional[int] = None,
+        async_sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+        single_flight: Optional[SingleFlight] = None,
+        router: Optional[ModelRouter] = None,
+        models: Optional[Dict[str, object]] = None
+    ):
         """
         Initialize Gemini client
         
         Args:
             api_key: Gemini API key (if not provided, reads from environment)
+            model: Object with generate_content (and generate_content_async for
+                the async methods), used instead of the Gemini SDK model (tests
+                and local fake servers; no API key needed)
+            rate_limiter: Shared request/token budget (defaults from environment)
+            timeout: Deadline of one attempt in seconds (GEMINI_TIMEOUT, 120)
+            max_retries: Retries after the first attempt (GEMINI_MAX_RETRIES, 3)
+            max_in_flight: Concurrent calls in this process (GEMINI_MAX_IN_FLIGHT, 8)
+            backoff_base: First backoff ceiling in seconds (GEMINI_BACKOFF_BASE, 1)
+            backoff_max: Largest backoff ceiling in seconds (GEMINI_BACKOFF_MAX, 30)
+            rate_limit_wait: Longest wait for rate budget (GEMINI_RATE_MAX_WAIT, 60)
+            sleep: Sleep function used between retries
+            metrics: Metrics recording attempt latency and retries (optional)
+            async_max_in_flight: Concurrent calls made through the async methods
+                (GEMINI_ASYNC_MAX_IN_FLIGHT, 256); a waiting coroutine holds no
+                thread, so this can be far above max_in_flight
+            async_sleep: Sleep coroutine used between retries of async calls
+            single_flight: Coalescing of identical calls (defaults from
+                environment, leased for as long as a call can take)
+            router: Model routes, their latency and hedging (defaults from environment)
+            models: Objects like model per route name, used instead of model
+                for those routes (stub models of different latency)
         """
-        self.api_key = api_key or os.getenv('GEMINI_API_KEY')
-        
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY is required")
-        
-        # Configure Gemini
-        genai.configure(api_key=self.api_key)
-        
-        # Use Gemini Pro model
-        self.model = genai.GenerativeModel('gemini-pro')
-        
         # Generation config for better output
         self.generation_config = {
             'temperature': 0.7,
@@ -30,31 +125,543 @@ class GeminiClient:
             'top_k': 40,
             'max_output_tokens': 8192,
         }
+        
+        self.router = router or ModelRouter.from_env(self.generation_config['max_output_tokens'])
+        # The default route's model, which names results made without a routed plan
+        self.model_name = self.router.default.model_name
+        
+        if model is None and not models:
+            self.api_key = api_key or os.getenv('GEMINI_API_KEY')
+            
+            if not self.api_key:
+                raise ValueError("GEMINI_API_KEY is required")
+            
+            # Imported here: the SDK pulls in grpc and protobuf, which a
+            # client with its own model never needs
+            import google.generativeai as genai
+            
+            # Configure Gemini
+            genai.configure(api_key=self.api_key)
+            self.models = {
+                name: genai.GenerativeModel(route.model_name) for name, route in self.router.routes.items()
+            }
+        else:
+            self.api_key = api_key
+            self.models = {name: (models or {}).get(name, model) for name in self.router.routes}
+        
+        self.model = self.models[self.router.default.name]
+        
+        self.rate_limiter = rate_limiter or RateLimiter.from_env()
+        self.timeout = timeout or float(os.getenv('GEMINI_TIMEOUT', 120))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('GEMINI_MAX_RETRIES', 3))
+        self.max_in_flight = max_in_flight or int(os.getenv('GEMINI_MAX_IN_FLIGHT', 8))
+        self.backoff_base = backoff_base if backoff_base is not None else float(os.getenv('GEMINI_BACKOFF_BASE', 1))
+        self.backoff_max = backoff_max if backoff_max is not None else float(os.getenv('GEMINI_BACKOFF_MAX', 30))
+        self.rate_limit_wait = rate_limit_wait if rate_limit_wait is not None else float(os.getenv('GEMINI_RATE_MAX_WAIT', 60))
+        self.async_max_in_flight = async_max_in_flight or int(os.getenv('GEMINI_ASYNC_MAX_IN_FLIGHT', 256))
+        self._sleep = sleep
+        self._async_sleep = async_sleep
+        self.metrics = metrics
+        self.single_flight = single_flight or SingleFlight.from_env(
+            lease_seconds=self.timeout * (self.max_retries + 1)
+            + self.backoff_max * self.max_retries + self.rate_limit_wait,
+            metrics=metrics
+        )
+        
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # asyncio semaphores belong to one event loop; keep one per loop
+        self._async_in_flight = weakref.WeakKeyDictionary()
     
-    def enhance_content(self, prompt: str) -> str:
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Threads that run the SDK calls, so a caller can stop waiting at the deadline"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_in_flight,
+                        thread_name_prefix='gemini-call'
+                    )
+        return self._executor
+    
+    @staticmethod
+    def estimate_tokens(prompt: str) -> int:
+        """Local token estimate of a prompt, used for the rate limit"""
+        return estimate_tokens(prompt)
+    
+    def count_tokens(self, text: str) -> int:
+        """
+        Exact token count of a text from the Gemini API
+        
+        Args:
+            text: Text to count
+            
+        Returns:
+            Total tokens
+        """
+        future = self.executor.submit(self.model.count_tokens, text)
+        try:
+            return future.result(timeout=self.timeout).total_tokens
+        except FutureTimeout:
+            raise GeminiError(f"Gemini token count timed out after {self.timeout:g}s", retryable=True, status_code=504)
+    
+    def _generation_config(self, max_output_tokens: Optional[int], route: Route) -> dict:
+        """generation_config with the output budget of one call, capped by its route"""
+        max_output_tokens = min(max_output_tokens or route.max_output_tokens, route.max_output_tokens)
+        if max_output_tokens == self.generation_config['max_output_tokens']:
+            return self.generation_config
+        return dict(self.generation_config, max_output_tokens=max_output_tokens)
+    
+    def _flight_key(self, prompt: str, generation_config: dict, route: Route) -> str:
+        """Single-flight key: the model, the config and the prompt without trailing whitespace"""
+        normalized = '\n'.join(line.rstrip() for line in prompt.strip().splitlines())
+        return ResultCache.make_key('gemini', route.model_name, generation_config, normalized)
+    
+    @staticmethod
+    def _flight_error(error: FlightFailed) -> GeminiError:
+        """The failure of a call made by another worker, as that worker raised it"""
+        return GeminiError(str(error), retryable=error.retryable, status_code=error.status_code)
+    
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        """Whether a failed attempt may succeed if tried again"""
+        if isinstance(error, GeminiError):
+            return error.retryable
+        if isinstance(error, RETRYABLE_ERRORS):
+            return True
+        return any(
+            cls.__module__ == GOOGLE_EXCEPTIONS_MODULE and cls.__name__ in RETRYABLE_GOOGLE_ERRORS
+            for cls in type(error).__mro__
+        )
+    
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter: uniform between 0 and the exponential ceiling"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    def _admit(self, prompt: str) -> _InFlightSlot:
+        """Take rate budget and an in-flight permit for one attempt"""
+        if not self.rate_limiter.acquire(self.estimate_tokens(prompt), timeout=self.rate_limit_wait):
+            raise GeminiError("Gemini rate limit reached, try again later", retryable=False, status_code=503)
+        
+        if not self._in_flight.acquire(timeout=self.timeout):
+            raise GeminiError("Too many Gemini calls in flight", retryable=True, status_code=503)
+        return _InFlightSlot(self._in_flight)
+    
+    def _try_admit(self, prompt: str) -> Optional[_InFlightSlot]:
+        """_admit without waiting: a hedge is only sent if budget and a permit are free now"""
+        if not self._in_flight.acquire(blocking=False):
+            return None
+        if self.rate_limiter.try_acquire(self.estimate_tokens(prompt)) != 0.0:
+            self._in_flight.release()
+            return None
+        return _InFlightSlot(self._in_flight)
+    
+    def _submit_call(self, prompt: str, generation_config: dict, route: Route, slot: _InFlightSlot) -> Future:
+        """Start one call to route's model on the executor"""
+        model = self.models[route.name]
+        
+        def call():
+            started = time.perf_counter()
+            try:
+                response = model.generate_content(
+                    prompt,
+                    generation_config=generation_config
+                )
+            finally:
+                # Held until the SDK call really returns, even after a timeout
+                slot.release()
+            
+            if not response or not response.text:
+                raise ValueError("Empty response from Gemini")
+            self.router.tracker.record(route.name, time.perf_counter() - started, estimate_tokens(response.text))
+            return response.text
+        
+        return self.executor.submit(call)
+    
+    def _count_hedge(self, calls: List, winner):
+        if len(calls) > 1 and self.metrics is not None:
+            self.metrics.inc('gemini_hedges_total', winner='primary' if winner is calls[0] else 'hedge')
+    
+    def _call_once(self, prompt: str, generation_config: dict, route: Route) -> str:
+        """
+        One attempt of a unary call, bounded by the deadline
+        
+        Past the route's p95 a second call is sent and the first successful
+        answer is used. The SDK can't stop a call already sent, so the other
+        one is left to finish on its own (holding its permit until it does).
+        """
+        deadline = time.monotonic() + self.timeout
+        calls = [self._submit_call(prompt, generation_config, route, self._admit(prompt))]
+        
+        hedge_delay = self.router.hedge_delay(route.name, generation_config['max_output_tokens'])
+        if hedge_delay is not None and hedge_delay < self.timeout:
+            done, _ = wait(calls, timeout=hedge_delay)
+            if not done:
+                slot = self._try_admit(prompt)
+                if slot is not None:
+                    calls.append(self._submit_call(prompt, generation_config, route, slot))
+        
+        pending, error = set(calls), None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for call in done:
+                if call.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    self._count_hedge(calls, call)
+                    return call.result()
+                error = error or call.exception()
+        if not pending:
+            raise error
+        raise GeminiError(f"Gemini call timed out after {self.timeout:g}s", retryable=True, status_code=504)
+    
+    def _open_stream_once(self, prompt: str, generation_config: dict, route: Route):
+        """
+        One attempt at starting a streamed call: everything up to the first text
+        
+        Returns:
+            Tuple of (first piece of text, response iterator, in-flight slot)
+        """
+        slot = self._admit(prompt)
+        model = self.models[route.name]
+        
+        def open_stream():
+            response = iter(model.generate_content(
+                prompt,
+                generation_config=generation_config,
+                stream=True
+            ))
+            for chunk in response:
+                # Chunks without text parts (e.g. only safety metadata) are skipped
+                text = chunk.text if chunk.parts else ''
+                if text:
+                    return text, response
+            raise ValueError("Empty response from Gemini")
+        
+        future = self.executor.submit(open_stream)
+        try:
+            first, response = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.add_done_callback(lambda f: slot.release())
+            raise GeminiError(f"Gemini call timed out after {self.timeout:g}s", retryable=True, status_code=504)
+        except BaseException:
+            slot.release()
+            raise
+        return first, response, slot
+    
+    def _attempt_ok(self, started: float, route: Route):
+        if self.metrics is not None:
+            self.metrics.observe('gemini_call_seconds', time.perf_counter() - started, outcome='ok', route=route.name)
+    
+    def _attempt_failed(self, error: Exception, attempt: int, started: float, route: Route) -> float:
+        """
+        Record a failed attempt
+        
+        Returns:
+            Seconds to back off before the next attempt
+            
+        Raises:
+            GeminiError: If the call should not be attempted again
+        """
+        if self.metrics is not None:
+            self.metrics.observe('gemini_call_seconds', time.perf_counter() - started, outcome='error', route=route.name)
+        if attempt >= self.max_retries or not self.is_retryable(error):
+            print(f"Gemini API error: {str(error)}")
+            if isinstance(error, GeminiError):
+                raise error
+            raise GeminiError(
+                f"Failed to enhance content with AI: {str(error)}",
+                retryable=self.is_retryable(error)
+            ) from error
+        if self.metrics is not None:
+            self.metrics.inc('gemini_retries_total')
+        delay = self._backoff(attempt)
+        print(f"Gemini API error (attempt {attempt + 1}, retrying in {delay:.1f}s): {str(error)}")
+        return delay
+    
+    def _with_retries(self, attempt_call: Callable[[], object], route: Route):
+        """Run attempt_call, retrying retryable failures with backoff"""
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                result = attempt_call()
+            except Exception as e:
+                self._sleep(self._attempt_failed(e, attempt, start, route))
+                attempt += 1
+                continue
+            self._attempt_ok(start, route)
+            return result
+    
+    def enhance_content(self, prompt: str, max_output_tokens: Optional[int] = None, route: Optional[str] = None) -> str:
         """
         Enhance content using Gemini API
         
         Args:
             prompt: The enhancement prompt including content and instructions
+            max_output_tokens: Output budget of this call (defaults to the route's)
+            route: Name of the route to call (defaults to the router's default)
             
         Returns:
             Enhanced content from Gemini
+            
+        Raises:
+            GeminiError: If the call still fails after retries
         """
+        route = self.router.get(route)
+        config = self._generation_config(max_output_tokens, route)
         try:
-            response = self.model.generate_content(
-                prompt,
-                generation_config=self.generation_config
+            return self.single_flight.do(
+                self._flight_key(prompt, config, route),
+                lambda: self._with_retries(lambda: self._call_once(prompt, config, route), route)
             )
+        except FlightFailed as e:
+            raise self._flight_error(e) from e
+    
+    def stream_content(
+        self, prompt: str, max_output_tokens: Optional[int] = None, route: Optional[str] = None
+    ) -> Iterator[str]:
+        """
+        Enhance content using Gemini API, yielding text as it is generated
+        
+        Starting the stream is retried like a unary call (but not hedged); once
+        text has been yielded a failure is raised as is, since it can't be
+        taken back.
+        
+        Args:
+            prompt: The enhancement prompt including content and instructions
+            max_output_tokens: Output budget of this call (defaults to the route's)
+            route: Name of the route to call (defaults to the router's default)
             
+        Yields:
+            Pieces of enhanced content in order
+        """
+        route = self.router.get(route)
+        config = self._generation_config(max_output_tokens, route)
+        first, response, slot = self._with_retries(lambda: self._open_stream_once(prompt, config, route), route)
+        
+        try:
+            yield first
+            for chunk in response:
+                text = chunk.text if chunk.parts else ''
+                if text:
+                    yield text
+        except Exception as e:
+            print(f"Gemini API error: {str(e)}")
+            raise GeminiError(f"Failed to enhance content with AI: {str(e)}") from e
+        finally:
+            slot.release()
+    
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_in_flight.get(loop)
+        if semaphore is None:
+            semaphore = self._async_in_flight[loop] = asyncio.Semaphore(self.async_max_in_flight)
+        return semaphore
+    
+    async def _admit_async(self, prompt: str) -> asyncio.Semaphore:
+        """_admit for coroutines: waits for budget and a permit without blocking the event loop"""
+        if not await self.rate_limiter.acquire_async(self.estimate_tokens(prompt), timeout=self.rate_limit_wait):
+            raise GeminiError("Gemini rate limit reached, try again later", retryable=False, status_code=503)
+        
+        semaphore = self._async_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise GeminiError("Too many Gemini calls in flight", retryable=True, status_code=503)
+        return semaphore
+    
+    async def _try_admit_async(self, prompt: str) -> Optional[asyncio.Semaphore]:
+        """_try_admit for coroutines"""
+        semaphore = self._async_semaphore()
+        if semaphore.locked():
+            return None
+        # Not locked, so this takes the permit without yielding; the permit
+        # comes first because taking budget may yield, and budget taken for a
+        # hedge that then finds no permit would never be given back
+        await semaphore.acquire()
+        try:
+            admitted = await self.rate_limiter.acquire_async(self.estimate_tokens(prompt), timeout=0)
+        except BaseException:
+            # Cancelled while waiting on the limiter
+            semaphore.release()
+            raise
+        if not admitted:
+            semaphore.release()
+            return None
+        return semaphore
+    
+    def _start_call_async(
+        self, prompt: str, generation_config: dict, route: Route, semaphore: asyncio.Semaphore
+    ) -> asyncio.Task:
+        """Start one call to route's model as a task, which gives the permit back when it ends"""
+        model = self.models[route.name]
+        
+        async def call():
+            started = time.perf_counter()
+            response = await model.generate_content_async(prompt, generation_config=generation_config)
             if not response or not response.text:
                 raise ValueError("Empty response from Gemini")
-            
+            self.router.tracker.record(route.name, time.perf_counter() - started, estimate_tokens(response.text))
             return response.text
+        
+        def finished(task):
+            # Also runs for a task cancelled before it started
+            semaphore.release()
+            if not task.cancelled():
+                # Retrieved, so the error of a losing attempt isn't logged as unhandled
+                task.exception()
+        
+        task = asyncio.ensure_future(call())
+        task.add_done_callback(finished)
+        return task
+    
+    async def _call_once_async(self, prompt: str, generation_config: dict, route: Route) -> str:
+        """One attempt of a unary call through the SDK's async API, hedged like _call_once and cancelled at the deadline"""
+        semaphore = await self._admit_async(prompt)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        calls = [self._start_call_async(prompt, generation_config, route, semaphore)]
+        try:
+            hedge_delay = self.router.hedge_delay(route.name, generation_config['max_output_tokens'])
+            if hedge_delay is not None and hedge_delay < self.timeout:
+                done, _ = await asyncio.wait(calls, timeout=hedge_delay)
+                if not done:
+                    hedge = await self._try_admit_async(prompt)
+                    if hedge is not None:
+                        calls.append(self._start_call_async(prompt, generation_config, route, hedge))
             
+            pending, error = set(calls), None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for call in done:
+                    if call.exception() is None:
+                        self._count_hedge(calls, call)
+                        return call.result()
+                    error = error or call.exception()
+            if not pending:
+                raise error
+            raise GeminiError(f"Gemini call timed out after {self.timeout:g}s", retryable=True, status_code=504)
+        finally:
+            # The other attempt, or every attempt past the deadline
+            for call in calls:
+                call.cancel()
+    
+    async def _open_stream_once_async(self, prompt: str, generation_config: dict, route: Route):
+        """
+        One attempt at starting a streamed call through the SDK's async API
+        
+        Returns:
+            Tuple of (first piece of text, async chunk iterator, semaphore holding the permit)
+        """
+        semaphore = await self._admit_async(prompt)
+        model = self.models[route.name]
+        
+        async def open_stream():
+            response = await model.generate_content_async(
+                prompt,
+                generation_config=generation_config,
+                stream=True
+            )
+            chunks = aiter(response)
+            async for chunk in chunks:
+                text = chunk.text if chunk.parts else ''
+                if text:
+                    return text, chunks
+            raise ValueError("Empty response from Gemini")
+        
+        try:
+            first, chunks = await asyncio.wait_for(open_stream(), self.timeout)
+        except asyncio.TimeoutError:
+            semaphore.release()
+            raise GeminiError(f"Gemini call timed out after {self.timeout:g}s", retryable=True, status_code=504)
+        except BaseException:
+            semaphore.release()
+            raise
+        return first, chunks, semaphore
+    
+    async def _with_retries_async(self, attempt_call: Callable[[], Awaitable], route: Route):
+        """_with_retries for coroutines"""
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                result = await attempt_call()
+            except Exception as e:
+                await self._async_sleep(self._attempt_failed(e, attempt, start, route))
+                attempt += 1
+                continue
+            self._attempt_ok(start, route)
+            return result
+    
+    async def enhance_content_async(
+        self, prompt: str, max_output_tokens: Optional[int] = None, route: Optional[str] = None
+    ) -> str:
+        """
+        enhance_content without blocking a thread: the call goes through the
+        SDK's async API and waits (for rate budget, a permit, the response or
+        a backoff) happen on the event loop
+        
+        Args:
+            prompt: The enhancement prompt including content and instructions
+            max_output_tokens: Output budget of this call (defaults to the route's)
+            route: Name of the route to call (defaults to the router's default)
+            
+        Returns:
+            Enhanced content from Gemini
+            
+        Raises:
+            GeminiError: If the call still fails after retries
+        """
+        route = self.router.get(route)
+        config = self._generation_config(max_output_tokens, route)
+        try:
+            return await self.single_flight.do_async(
+                self._flight_key(prompt, config, route),
+                lambda: self._with_retries_async(lambda: self._call_once_async(prompt, config, route), route)
+            )
+        except FlightFailed as e:
+            raise self._flight_error(e) from e
+    
+    async def stream_content_async(
+        self, prompt: str, max_output_tokens: Optional[int] = None, route: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        stream_content through the SDK's async API
+        
+        Args:
+            prompt: The enhancement prompt including content and instructions
+            max_output_tokens: Output budget of this call (defaults to the route's)
+            route: Name of the route to call (defaults to the router's default)
+            
+        Yields:
+            Pieces of enhanced content in order
+        """
+        route = self.router.get(route)
+        config = self._generation_config(max_output_tokens, route)
+        first, chunks, semaphore = await self._with_retries_async(
+            lambda: self._open_stream_once_async(prompt, config, route), route
+        )
+        
+        try:
+            yield first
+            async for chunk in chunks:
+                text = chunk.text if chunk.parts else ''
+                if text:
+                    yield text
         except Exception as e:
             print(f"Gemini API error: {str(e)}")
-            raise Exception(f"Failed to enhance content with AI: {str(e)}")
+            raise GeminiError(f"Failed to enhance content with AI: {str(e)}") from e
+        finally:
+            semaphore.release()
     
     def enhance_with_context(self, content: str, instructions: str, context: dict = None) -> str:
         """
@@ -0,0 +1,40 @@
+"""
+gunicorn settings
+
+The app is loaded once in the master (preload_app) and warmed up there
+before any worker is forked: the Gemini SDK, python-docx, PyPDF2 and the
+docx default template are then already in memory in every worker, shared
+copy-on-write instead of being imported again per worker.
+
+Run from the backend folder:
+    gunicorn -c gunicorn.conf.py app:app
+
+or, to serve the async endpoints of asgi_app (one worker then holds
+hundreds of enhancement requests instead of one per thread):
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi_app:app
+"""
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 7860)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+# Threads keep /health and job polling responsive while /enhance waits on its job
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+# /enhance stops waiting on its job before this (JOB_WAIT_TIMEOUT)
+timeout = 120
+preload_app = True
+
+
+def when_ready(server):
+    """Warm the preloaded app up in the master, before workers are forked"""
+    if os.getenv('APP_WARM_UP', '1') == '0':
+        return
+    application = server.app.wsgi()
+    # asgi_app's AsyncApp wraps the Flask app
+    flask_app = getattr(application, 'flask_app', application)
+    seconds = flask_app.extensions['services'].warm_up()
+    server.log.info("Warm-up took %.2fs", seconds)
+    # Keep the collector from walking (and so writing to, and copying) the
+    # pages of everything loaded so far in each worker
+    gc.freeze()
@@ -0,0 +1,289 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+
+class JobQueueFull(Exception):
+    """Raised when the background executor already has its maximum backlog"""
+
+
+class JobStore(ABC):
+    """
+    Interface for job state and result storage
+
+    Implementations must be safe to use from several threads and, if jobs are
+    polled through a different gunicorn worker than the one that accepted them,
+    from several processes.
+    """
+
+    FIELDS = ('status', 'stage', 'error', 'details', 'status_code', 'filename', 'mimetype')
+
+    @abstractmethod
+    def create(self, job_id: str):
+        """Record a new queued job"""
+
+    @abstractmethod
+    def update(self, job_id: str, **fields):
+        """Update any of the FIELDS of a job"""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[dict]:
+        """Return the job record, or None if it is unknown or expired"""
+
+    @abstractmethod
+    def save_result(self, job_id: str, data: bytes):
+        """Persist the finished output of a job"""
+
+    @abstractmethod
+    def result_path(self, job_id: str) -> Optional[str]:
+        """Path of the stored output file, or None if there is none"""
+
+
+class SQLiteJobStore(JobStore):
+    """Job store backed by a SQLite file with results as files beside it"""
+
+    # Purge expired jobs every N creations
+    PURGE_INTERVAL = 50
+
+    def __init__(self, directory: Optional[str] = None, ttl_seconds: float = 3600):
+        """
+        Initialize store
+
+        Args:
+            directory: Where the database and result files live
+            ttl_seconds: How long finished jobs and their results are kept
+        """
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'verolabz_jobs')
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.db_path = os.path.join(self.directory, 'jobs.db')
+        self._local = threading.local()
+        self._creates = 0
+
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " stage TEXT,"
+            " error TEXT,"
+            " details TEXT,"
+            " status_code INTEGER,"
+            " filename TEXT,"
+            " mimetype TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.result")
+
+    def create(self, job_id: str):
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO jobs (id, status, created_at, updated_at)"
+            " VALUES (?, 'queued', ?, ?)",
+            (job_id, now, now)
+        )
+        self._creates += 1
+        if self._creates % self.PURGE_INTERVAL == 0:
+            self.purge_expired()
+
+    def update(self, job_id: str, **fields):
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._connection().execute(
+            f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?",
+            (*fields.values(), time.time(), job_id)
+        )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT * FROM jobs WHERE id = ? AND created_at >= ?",
+            (job_id, time.time() - self.ttl_seconds)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def save_result(self, job_id: str, data: bytes):
+        # Write then rename so a poller never sees a half-written file
+        path = self._path(job_id)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def result_path(self, job_id: str) -> Optional[str]:
+        path = self._path(job_id)
+        return path if os.path.exists(path) else None
+
+    def purge_expired(self):
+        """Delete expired jobs and their result files"""
+        cutoff = time.time() - self.ttl_seconds
+        conn = self._connection()
+        expired = [row['id'] for row in conn.execute(
+            "SELECT id FROM jobs WHERE created_at < ?", (cutoff,)
+        )]
+        for job_id in expired:
+            try:
+                os.remove(self._path(job_id))
+            except FileNotFoundError:
+                pass
+        conn.execute("DELETE FROM jobs WHERE created_at < ?", (cutoff,))
+
+
+class JobRunner:
+    """Runs jobs on a bounded background executor and tracks them in a JobStore"""
+
+    def __init__(self, store: JobStore, max_workers: int = 2, max_pending: int = 32, wait_timeout: float = 110):
+        """
+        Initialize runner
+
+        Args:
+            store: Where job state and results are kept
+            max_workers: Jobs executed concurrently
+            max_pending: Jobs queued or running before submissions are refused
+            wait_timeout: Longest a request waits on its job before being
+                told to poll it (below gunicorn's worker timeout)
+        """
+        self.store = store
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._events = {}
+        self._events_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'JobRunner':
+        """Build a runner with a SQLite store from JOB_* environment variables"""
+        store = SQLiteJobStore(
+            directory=os.getenv('JOB_STORE_DIR') or None,
+            ttl_seconds=float(os.getenv('JOB_TTL', 3600))
+        )
+        return cls(
+            store,
+            max_workers=int(os.getenv('JOB_WORKERS', 2)),
+            max_pending=int(os.getenv('JOB_MAX_PENDING', 32)),
+            wait_timeout=float(os.getenv('JOB_WAIT_TIMEOUT', 110))
+        )
+
+    def submit(self, work: Callable[[Callable[[str], None]], Tuple[bytes, str, str]]) -> str:
+        """
+        Queue a job
+
+        Args:
+            work: Callable taking a stage reporter and returning
+                (output bytes, download filename, mimetype)
+
+        Returns:
+            Job id
+
+        Raises:
+            JobQueueFull: If max_pending jobs are already queued or running
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull("Too many jobs in progress")
+
+        job_id = uuid.uuid4().hex
+        try:
+            self.store.create(job_id)
+            with self._events_lock:
+                self._events[job_id] = threading.Event()
+            self._executor.submit(self._run, job_id, work)
+        except Exception:
+            self._slots.release()
+            raise
+        return job_id
+
+    def store_result(self, data: bytes, filename: str, mimetype: str) -> str:
+        """
+        Record output produced outside the executor as a finished job
+
+        Args:
+            data: Output document bytes
+            filename: Download filename
+            mimetype: Mimetype of the output
+
+        Returns:
+            Job id whose result can be downloaded like any other job's
+        """
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id)
+        self.store.save_result(job_id, data)
+        self.store.update(
+            job_id,
+            status='done',
+            stage='done',
+            filename=filename,
+            mimetype=mimetype
+        )
+        return job_id
+
+    def _run(self, job_id: str, work):
+        try:
+            self.store.update(job_id, status='running')
+            data, filename, mimetype = work(lambda stage: self.store.update(job_id, stage=stage))
+            self.store.save_result(job_id, data)
+            self.store.update(
+                job_id,
+                status='done',
+                stage='done',
+                filename=filename,
+                mimetype=mimetype
+            )
+        except Exception as e:
+            status_code = getattr(e, 'status_code', 500)
+            if status_code >= 500:
+                print(f"Error processing job {job_id}: {str(e)}")
+                print(traceback.format_exc())
+                error = 'Failed to process document. Please try again.'
+            else:
+                error = str(e)
+            self.store.update(
+                job_id,
+                status='failed',
+                error=error,
+                details=str(e),
+                status_code=status_code
+            )
+        finally:
+            self._slots.release()
+            with self._events_lock:
+                event = self._events.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        Block until a job submitted by this process finishes
+
+        Args:
+            job_id: Job id from submit
+            timeout: Seconds to wait (None waits forever)
+
+        Returns:
+            The job record, still queued or running if the timeout ran out
+        """
+        with self._events_lock:
+            event = self._events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        return self.store.get(job_id)
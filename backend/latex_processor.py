@@ -1,20 +1,274 @@
 import re
-from typing import List, Tuple
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+@dataclass
+class MathDetection:
+    """Result of scanning text for mathematical/scientific content"""
+    score: float
+    categories: List[str] = field(default_factory=list)
+    scanned_chars: int = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.categories)
+
+
+@dataclass
+class LaTeXContent:
+    """Enhanced text after one scan for its equations"""
+    # Normalized text: equations spaced from the words around them, display
+    # equations on their own line, every equation delimited by $ or $$
+    text: str
+    # ('text' | 'inline' | 'display', text) pieces making up the normalized
+    # text in order; equations without their delimiters
+    spans: List[Tuple[str, str]] = field(default_factory=list)
+    # ('inline' | 'display', equation) in document order
+    equations: List[Tuple[str, str]] = field(default_factory=list)
+
+
+# Everything the scanner stops at: an escaped backslash or dollar (never a
+# delimiter), \( \) \[ \], $$ and $
+LATEX_TOKEN = re.compile(r'\\[\\$()\[\]]|\$\$?')
+
+# Opening delimiter: (equation kind, closing delimiter)
+MATH_DELIMITERS = {
+    '$': ('inline', '$'),
+    '\\(': ('inline', '\\)'),
+    '$$': ('display', '$$'),
+    '\\[': ('display', '\\]'),
+}
+
+
+def scan_latex(content: str) -> LaTeXContent:
+    """
+    Find the equations of a text and normalize it in one linear scan
+
+    Inline equations ($...$ or \\(...\\)) end on the line they start on;
+    display equations ($$...$$ or \\[...\\]) may span lines and are put on
+    one line of their own. A delimiter that is escaped (\\$) or never closed
+    is kept as text.
+
+    Args:
+        content: Enhanced content
+
+    Returns:
+        LaTeXContent with the normalized text, its spans and its equations
+    """
+    pieces = []
+    spans = []
+    equations = []
+    search = LATEX_TOKEN.search
+    length = len(content)
+
+    pos = 0
+    text_start = 0
+    line_end = -1
+    # Closing delimiter -> end of the range it was last searched for in vain
+    missing = {}
+    # What the last emitted piece was, for the spacing of the next one
+    previous = 'start'
+
+    def emit_text(text: str, before: Optional[str]):
+        """Append text ahead of an equation of kind before (None: end of content)"""
+        nonlocal previous
+        if previous == 'display':
+            text = text.lstrip(' \t')
+            if (text or before) and not text.startswith('\n'):
+                text = '\n' + text
+        elif previous == 'inline' and text[:1].isalnum():
+            text = ' ' + text
+
+        if before == 'inline' and text[-1:].isalnum():
+            text += ' '
+        elif before == 'display':
+            text = text.rstrip(' \t')
+            if (text or pieces) and not (text or pieces[-1]).endswith('\n'):
+                text += '\n'
+
+        if text:
+            pieces.append(text)
+            spans.append(('text', text))
+            previous = 'text'
+
+    while True:
+        match = search(content, pos)
+        if match is None:
+            break
+        token = match.group()
+        pos = match.end()
+        if token not in MATH_DELIMITERS:
+            continue
+
+        kind, closer = MATH_DELIMITERS[token]
+        if kind == 'inline':
+            if line_end < pos:
+                line_end = content.find('\n', pos)
+                if line_end < 0:
+                    line_end = length
+            end = line_end
+        else:
+            end = length
+        if missing.get(closer) == end:
+            continue
+
+        # Look for the closing delimiter, stepping over escapes. As in TeX,
+        # the first $ of a $$ closes an inline equation
+        close = None
+        at = pos
+        while True:
+            found = search(content, at, end)
+            if found is None:
+                missing[closer] = end
+                break
+            if found.group() == closer or (closer == '$' and found.group() == '$$'):
+                close = found.start()
+                break
+            at = found.end()
+        if close is None:
+            continue
+
+        body = content[pos:close]
+        if kind == 'display' and '\n' in body:
+            body = ' '.join(line.strip() for line in body.split('\n') if line.strip())
+        emit_text(content[text_start:match.start()], kind)
+        delimiter = '$' if kind == 'inline' else '$$'
+        pieces.append(f"{delimiter}{body}{delimiter}")
+        spans.append((kind, body))
+        equations.append((kind, body.strip()))
+        previous = kind
+        pos = text_start = close + len(closer)
+
+    emit_text(content[text_start:], None)
+    return LaTeXContent(''.join(pieces), spans, equations)
+
+
+def stream_cut(content: str) -> int:
+    """
+    Last line break at which streamed text can be processed so far
+
+    Pairs delimiters as scan_latex does and never cuts inside a display
+    equation, which scan_latex joins across lines, nor after the start of one
+    that is still open, since the rest of it may be yet to come.
+
+    Args:
+        content: Text received so far
+
+    Returns:
+        Index of the line break, or -1 if there is none to cut at
+    """
+    search = LATEX_TOKEN.search
+    length = len(content)
+    limit = length
+    displays = []
+    pos = 0
+    while True:
+        match = search(content, pos)
+        if match is None:
+            break
+        pos = match.end()
+        if match.group() not in MATH_DELIMITERS:
+            continue
+
+        kind, closer = MATH_DELIMITERS[match.group()]
+        end = length
+        if kind == 'inline':
+            end = content.find('\n', pos)
+            if end < 0:
+                end = length
+        close = None
+        at = pos
+        while True:
+            found = search(content, at, end)
+            if found is None:
+                break
+            if found.group() == closer or (closer == '$' and found.group() == '$$'):
+                close = found.start()
+                break
+            at = found.end()
+        if close is None:
+            if kind == 'display':
+                limit = match.start()
+                break
+            continue
+        pos = close + len(closer)
+        if kind == 'display':
+            displays.append((match.start(), pos))
+
+    cut = content.rfind('\n', 0, limit)
+    for start, end in reversed(displays):
+        if cut < start:
+            continue
+        if cut < end:
+            cut = content.rfind('\n', 0, start)
+    return cut
+
 
 class LaTeXProcessor:
     """Processor for LaTeX content in documents"""
     
     # Common mathematical terms and symbols that indicate math content
-    MATH_INDICATORS = [
-        r'\b(equation|formula|theorem|proof|lemma|corollary)\b',
-        r'[∫∑∏√∞≤≥≠±×÷∈∉⊂⊃∪∩∀∃∇∂]',
-        r'\d+\s*[+\-*/=]\s*\d+',
-        r'\b(sin|cos|tan|log|ln|exp|lim|integral|derivative)\b',
-        r'[a-z]\s*=\s*[a-z0-9]',
-        r'\^|\d+_\d+',
+    MATH_CATEGORIES = [
+        ('keyword', r'\b(?:equation|formula|theorem|proof|lemma|corollary)\b'),
+        ('symbol', r'[∫∑∏√∞≤≥≠±×÷∈∉⊂⊃∪∩∀∃∇∂]'),
+        ('arithmetic', r'\d+\s*[+\-*/=]\s*\d+'),
+        ('function', r'\b(?:sin|cos|tan|log|ln|exp|lim|integral|derivative)\b'),
+        ('assignment', r'[a-z]\s*=\s*[a-z0-9]'),
+        ('notation', r'\^|\d+_\d+'),
     ]
+    MATH_INDICATORS = [pattern for _, pattern in MATH_CATEGORIES]
+    
+    MATH_KEYWORDS = frozenset(['equation', 'formula', 'theorem', 'proof', 'lemma', 'corollary'])
+    
+    # The categories above folded into one compiled alternation, so a single
+    # pass finds all of them. Alternatives sharing a first character are
+    # merged (every word, every run of digits) because each alternative costs
+    # a check at every position; matches are mapped back to categories in
+    # _math_category. Only the word alternatives are case-insensitive, which
+    # avoids lowercasing a copy of the text.
+    MATH_PATTERN = re.compile(
+        r'(?P<word>\b(?i:equation|formula|theorem|proof|lemma|corollary'
+        r'|sin|cos|tan|log|ln|exp|lim|integral|derivative)\b)'
+        r'|(?P<symbol>[∫∑∏√∞≤≥≠±×÷∈∉⊂⊃∪∩∀∃∇∂^])'
+        r'|(?P<number>\d+(?:\s*[+\-*/=]\s*\d+|_\d+))'
+        r'|(?P<assignment>[a-zA-Z]\s*=\s*[a-zA-Z0-9])'
+    )
+    
+    # Texts up to this size are scanned in full; larger ones are scanned as a
+    # prefix plus evenly spaced sample windows
+    MATH_SCAN_LIMIT = 128 * 1024
+    MATH_PREFIX_CHARS = 32 * 1024
+    MATH_SAMPLE_WINDOWS = 24
+    MATH_WINDOW_CHARS = 4 * 1024
+    
+    # Stop scanning once this many matches have been seen
+    MATH_MAX_MATCHES = 64
     
-    def detect_mathematical_content(self, text: str) -> bool:
+    def _math_category(self, match) -> str:
+        """Map a MATH_PATTERN match back to its MATH_CATEGORIES name"""
+        group = match.lastgroup
+        text = match.group()
+        if group == 'word':
+            return 'keyword' if text.lower() in self.MATH_KEYWORDS else 'function'
+        if group == 'symbol':
+            return 'notation' if text == '^' else 'symbol'
+        if group == 'number':
+            return 'notation' if '_' in text else 'arithmetic'
+        return group
+    
+    def _math_scan_ranges(self, length: int) -> List[Tuple[int, int]]:
+        """Character ranges of the text that the detector looks at"""
+        if length <= self.MATH_SCAN_LIMIT:
+            return [(0, length)]
+        
+        ranges = [(0, self.MATH_PREFIX_CHARS)]
+        remaining = length - self.MATH_PREFIX_CHARS
+        step = remaining // self.MATH_SAMPLE_WINDOWS
+        for i in range(self.MATH_SAMPLE_WINDOWS):
+            start = self.MATH_PREFIX_CHARS + i * step
+            ranges.append((start, min(start + self.MATH_WINDOW_CHARS, length)))
+        return ranges
+    
+    def detect_mathematical_content(self, text: str) -> MathDetection:
         """
         Detect if text contains mathematical/scientific content
         
@@ -22,22 +276,43 @@ class LaTeXProcessor:
             text: Text to analyze
             
         Returns:
-            True if mathematical content is detected
+            MathDetection, truthy if mathematical content is detected. Its score
+            is the number of matches per 1000 scanned characters.
         """
-        text_lower = text.lower()
+        found = set()
+        matches = 0
+        scanned = 0
         
-        for pattern in self.MATH_INDICATORS:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return True
+        for start, end in self._math_scan_ranges(len(text)):
+            # pos/endpos scan the window in place without slicing a copy
+            for match in self.MATH_PATTERN.finditer(text, start, end):
+                found.add(self._math_category(match))
+                matches += 1
+                if matches >= self.MATH_MAX_MATCHES:
+                    break
+            scanned += end - start
+            if matches >= self.MATH_MAX_MATCHES:
+                # Count only what was actually scanned for the density
+                scanned -= end - match.end()
+                break
         
-        return False
+        return MathDetection(
+            score=matches * 1000 / scanned if scanned else 0.0,
+            categories=[name for name, _ in self.MATH_CATEGORIES if name in found],
+            scanned_chars=scanned
+        )
     
     def build_enhancement_prompt(
         self, 
         content: str, 
         user_instructions: str = "",
         doc_type: str = "auto",
-        include_latex: bool = False
+        include_latex: bool = False,
+        context_before: str = "",
+        context_after: str = "",
+        part: Optional[Tuple[int, int]] = None,
+        summarize_words: Optional[int] = None,
+        section_markers: bool = False
     ) -> str:
         """
         Build comprehensive enhancement prompt for Gemini
@@ -47,6 +322,13 @@ class LaTeXProcessor:
             user_instructions: User's specific instructions
             doc_type: Type of document (auto, academic, technical, business, etc.)
             include_latex: Whether to include LaTeX formatting
+            context_before: Text just before this content (chunked documents)
+            context_after: Text just after this content (chunked documents)
+            part: (part number, total parts) when enhancing one chunk of a document
+            summarize_words: Condense the content to about this many words
+                (documents too long to enhance in full)
+            section_markers: The content has [[§n]] marker lines that must come
+                back unchanged (the output is split at them)
             
         Returns:
             Complete prompt for Gemini
@@ -106,6 +388,42 @@ class LaTeXProcessor:
                 ""
             ])
         
+        # Add chunk position and neighbouring context for long documents
+        if part:
+            prompt_parts.extend([
+                f"🧩 This is part {part[0]} of {part[1]} of a longer document.",
+                "- Enhance ONLY the content of this part",
+                "- Do not add an introduction or conclusion that the part does not already have",
+                ""
+            ])
+        if summarize_words:
+            prompt_parts.extend([
+                f"📝 This content is too long to enhance in full. Condense it to at most about {summarize_words} words.",
+                "- Keep every key fact, number, equation and section heading",
+                "- Drop repetition and filler rather than whole topics",
+                ""
+            ])
+        if section_markers:
+            prompt_parts.extend([
+                "🔖 The content is divided by marker lines such as [[§1]], [[§2]].",
+                "- Keep every marker line exactly as it is, on its own line, in the same order",
+                "- Enhance the text between markers in place; do not move text across markers or add new markers",
+                "- Sections may come from different parts of the document; enhance each one on its own",
+                ""
+            ])
+        if context_before:
+            prompt_parts.extend([
+                "⬆️ Preceding context (for continuity only, do NOT include it in your output):",
+                context_before,
+                ""
+            ])
+        if context_after:
+            prompt_parts.extend([
+                "⬇️ Following context (for continuity only, do NOT include it in your output):",
+                context_after,
+                ""
+            ])
+        
         # Add the content
         prompt_parts.extend([
             "📄 Original Document Content:",
@@ -120,6 +438,18 @@ class LaTeXProcessor:
         
         return "\n".join(prompt_parts)
     
+    def normalize(self, content: str) -> LaTeXContent:
+        """
+        Normalize content and extract its equations in the same pass
+
+        Args:
+            content: Content potentially containing LaTeX
+
+        Returns:
+            LaTeXContent (see scan_latex)
+        """
+        return scan_latex(content)
+    
     def process_latex_content(self, content: str) -> str:
         """
         Process and validate LaTeX content
@@ -130,15 +460,7 @@ class LaTeXProcessor:
         Returns:
             Processed content with valid LaTeX
         """
-        # Ensure proper spacing around inline equations
-        content = re.sub(r'(\S)\$', r'\1 $', content)
-        content = re.sub(r'\$(\S)', r'$ \1', content)
-        
-        # Ensure display equations are on their own lines
-        content = re.sub(r'(\S)\$\$', r'\1\n$$', content)
-        content = re.sub(r'\$\$(\S)', r'$$\n\1', content)
-        
-        return content
+        return scan_latex(content).text
     
     def extract_latex_equations(self, content: str) -> List[Tuple[str, str]]:
         """
@@ -148,22 +470,10 @@ class LaTeXProcessor:
             content: Content containing LaTeX
             
         Returns:
-            List of tuples (equation_type, equation_content)
+            List of tuples (equation_type, equation_content) in document order
             equation_type is either 'inline' or 'display'
         """
-        equations = []
-        
-        # Extract display equations ($$...$$)
-        display_pattern = r'\$\$(.*?)\$\$'
-        for match in re.finditer(display_pattern, content, re.DOTALL):
-            equations.append(('display', match.group(1).strip()))
-        
-        # Extract inline equations ($...$)
-        inline_pattern = r'(?<!\$)\$(?!\$)(.*?)(?<!\$)\$(?!\$)'
-        for match in re.finditer(inline_pattern, content):
-            equations.append(('inline', match.group(1).strip()))
-        
-        return equations
+        return scan_latex(content).equations
     
     def validate_latex(self, latex_code: str) -> Tuple[bool, str]:
         """
@@ -0,0 +1,268 @@
+import glob
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (1024, 16 * 1024, 128 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+
+# name -> (type, help, histogram buckets)
+METRIC_DEFINITIONS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint and status', None),
+    'http_request_seconds': ('histogram', 'HTTP request latency including the response send', LATENCY_BUCKETS),
+    'stage_seconds': ('histogram', 'Time spent in each enhancement stage', LATENCY_BUCKETS),
+    'enhancements_total': ('counter', 'Enhancement requests by outcome', None),
+    'request_bytes': ('histogram', 'Document bytes in and out per enhancement', BYTES_BUCKETS),
+    'tokens_total': ('counter', 'Estimated Gemini prompt and response tokens', None),
+    'cache_lookups_total': ('counter', 'Result cache lookups by layer and result', None),
+    'sections_total': ('counter', 'Document sections by whether their stored enhancement was reused', None),
+    'gemini_call_seconds': ('histogram', 'Latency of single Gemini call attempts', LATENCY_BUCKETS),
+    'gemini_retries_total': ('counter', 'Gemini call attempts that were retried', None),
+    'gemini_hedges_total': ('counter', 'Gemini attempts hedged with a second call, by which answered first', None),
+    'gemini_coalesced_total': ('counter', 'Gemini calls answered by an identical call in flight, by where it ran', None),
+    'admission_total': ('counter', 'Enhancement admission decisions by result', None),
+    'admission_wait_seconds': ('histogram', 'Time admitted enhancements waited for budget', LATENCY_BUCKETS),
+}
+
+
+def _label_key(labels: dict) -> str:
+    return json.dumps(sorted(labels.items()))
+
+
+class Metrics:
+    """
+    Counters and histograms exposed in the Prometheus text format
+
+    Each process keeps its own values. With a collector directory every
+    process also writes a snapshot file there (on flush), and render sums
+    the snapshots of all processes, so any gunicorn worker can serve
+    /metrics for the whole host. Snapshots of exited workers are kept so
+    counters never go backwards; clear the directory when the service
+    (not a single worker) restarts.
+    """
+
+    def __init__(self, directory: Optional[str] = None, namespace: str = 'verolabz'):
+        """
+        Initialize metrics
+
+        Args:
+            directory: Collector directory shared by the workers (None keeps
+                metrics per process)
+            namespace: Prefix of every metric name
+        """
+        self.directory = directory
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        # name -> label key -> value (counters) or [bucket counts, sum, count]
+        self._values: Dict[str, Dict[str, object]] = {name: {} for name in METRIC_DEFINITIONS}
+        # Snapshot files are per process and per instance; the pid is taken at
+        # flush time because gunicorn may fork workers after this is created
+        self._instance = uuid.uuid4().hex[:8]
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> 'Metrics':
+        """Build metrics from METRICS_DIR"""
+        return cls(directory=os.getenv('METRICS_DIR') or None)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add to a counter"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record one histogram observation"""
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values[name]
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, f"metrics_{os.getpid()}_{self._instance}.json")
+
+    def flush(self):
+        """Write this process's snapshot to the collector directory"""
+        if not self.directory:
+            return
+        with self._lock:
+            data = json.dumps(self._values)
+        path = self._snapshot_path()
+        # Write then rename so readers never see a partial snapshot
+        with open(path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def _merged(self) -> Dict[str, Dict[str, object]]:
+        """Values of this process plus every other process's snapshot"""
+        with self._lock:
+            snapshots = [json.loads(json.dumps(self._values))]
+
+        if self.directory:
+            own = self._snapshot_path()
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        merged = {name: {} for name in METRIC_DEFINITIONS}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                if name not in merged:
+                    continue
+                target = merged[name]
+                for key, value in series.items():
+                    if METRIC_DEFINITIONS[name][0] == 'counter':
+                        target[key] = target.get(key, 0) + value
+                    elif key not in target:
+                        target[key] = [list(value[0]), value[1], value[2]]
+                    else:
+                        entry = target[key]
+                        entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+                        entry[1] += value[1]
+                        entry[2] += value[2]
+        return merged
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ''
+        parts = []
+        for name, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{name}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        if value == math.inf:
+            return '+Inf'
+        return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, series in self._merged().items():
+            kind, help_text, buckets = METRIC_DEFINITIONS[name]
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+
+            for key in sorted(series):
+                labels = [tuple(pair) for pair in json.loads(key)]
+                value = series[key]
+                if kind == 'counter':
+                    lines.append(f"{full_name}{self._format_labels(labels)} {self._format_value(value)}")
+                    continue
+
+                counts, total, count = value
+                # observe counts a value in every bucket it fits, so the
+                # counts are already cumulative as the format requires
+                for bound, bucket_count in zip(buckets, counts):
+                    bucket_labels = labels + [('le', self._format_value(bound))]
+                    lines.append(f"{full_name}_bucket{self._format_labels(bucket_labels)} {bucket_count}")
+                lines.append(f"{full_name}_bucket{self._format_labels(labels + [('le', '+Inf')])} {count}")
+                lines.append(f"{full_name}_sum{self._format_labels(labels)} {self._format_value(total)}")
+                lines.append(f"{full_name}_count{self._format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def log_json(event: str, **fields):
+    """Print one structured log line when LOG_FORMAT=json"""
+    if os.getenv('LOG_FORMAT') == 'json':
+        print(json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, default=str))
+
+
+class RequestTrace:
+    """
+    Timings and counts of one enhancement as it moves through the pipeline
+
+    Spans are recorded into the stage histogram as they end; finish records
+    the per-request totals and writes the structured log line. A trace
+    without metrics only collects (used when a caller passes none).
+    """
+
+    def __init__(self, metrics: Optional[Metrics] = None, endpoint: str = ''):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.fields: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def record(self, stage: str, seconds: float):
+        """Add time measured elsewhere to a stage (repeated stages add up)"""
+        with self._lock:
+            self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        if self.metrics is not None:
+            self.metrics.observe('stage_seconds', seconds, stage=stage)
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def set(self, **fields):
+        """Record per-request values (bytes, tokens, cache flags)"""
+        with self._lock:
+            self.fields.update(fields)
+
+    def finish(self, outcome: str):
+        """Record the request totals once, at the end of the pipeline"""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+
+        fields = self.fields
+        if self.metrics is not None:
+            metrics = self.metrics
+            metrics.inc('enhancements_total', endpoint=self.endpoint, outcome=outcome)
+            for direction in ('in', 'out'):
+                if f'bytes_{direction}' in fields:
+                    metrics.observe('request_bytes', fields[f'bytes_{direction}'], direction=direction)
+            for kind in ('prompt', 'response'):
+                if fields.get(f'{kind}_tokens'):
+                    metrics.inc('tokens_total', fields[f'{kind}_tokens'], kind=kind)
+            for layer in ('document', 'enhanced'):
+                if f'{layer}_cache_hit' in fields:
+                    result = 'hit' if fields[f'{layer}_cache_hit'] else 'miss'
+                    metrics.inc('cache_lookups_total', layer=layer, result=result)
+            if fields.get('sections'):
+                metrics.inc('sections_total', fields['sections_reused'], result='reused')
+                metrics.inc('sections_total', fields['sections'] - fields['sections_reused'], result='enhanced')
+            metrics.flush()
+
+        log_json(
+            'enhancement',
+            endpoint=self.endpoint,
+            outcome=outcome,
+            seconds=round(time.perf_counter() - self.started, 4),
+            spans={stage: round(seconds, 4) for stage, seconds in self.spans.items()},
+            **fields
+        )
@@ -0,0 +1,177 @@
+import math
+import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+# Document types whose enhancement needs the stronger model whatever their size
+QUALITY_DOC_TYPES = ('academic', 'technical')
+
+
+@dataclass
+class Route:
+    """A model Gemini calls can be sent to, and the output it is allowed"""
+    name: str
+    model_name: str
+    max_output_tokens: int
+
+
+class LatencyTracker:
+    """
+    Recent latency of successful calls per route
+
+    Latency is kept per output token, so one window covers short and long
+    calls: the p95 of a call is predicted as the p95 of the recent seconds
+    per token times the tokens it is expected to produce. Outputs shorter
+    than MIN_TOKENS count as MIN_TOKENS, since a call has a fixed cost too.
+    """
+
+    WINDOW = 200
+    MIN_TOKENS = 256
+    # Samples a route needs before its latency is predicted
+    MIN_SAMPLES = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates: Dict[str, Deque[float]] = {}
+
+    def record(self, route: str, seconds: float, output_tokens: int):
+        """Record one successful call"""
+        with self._lock:
+            rates = self._rates.setdefault(route, deque(maxlen=self.WINDOW))
+            rates.append(seconds / max(output_tokens, self.MIN_TOKENS))
+
+    def predict(self, route: str, output_tokens: int, quantile: float = 0.95) -> Optional[float]:
+        """
+        Predicted latency of a call
+
+        Args:
+            route: Route name
+            output_tokens: Tokens the call is expected to produce
+            quantile: Quantile of the recent calls (0.95 for p95)
+
+        Returns:
+            Seconds, or None until the route has MIN_SAMPLES calls
+        """
+        with self._lock:
+            rates = sorted(self._rates.get(route, ()))
+        if len(rates) < self.MIN_SAMPLES:
+            return None
+        rate = rates[max(0, math.ceil(quantile * len(rates)) - 1)]
+        return rate * max(output_tokens, self.MIN_TOKENS)
+
+    def get_stats(self) -> dict:
+        """Calls and p50/p95 seconds per 1000 output tokens of each route"""
+        with self._lock:
+            windows = {route: sorted(rates) for route, rates in self._rates.items()}
+        return {
+            route: {
+                'calls': len(rates),
+                'p50_per_1k_tokens': round(rates[math.ceil(0.5 * len(rates)) - 1] * 1000, 3),
+                'p95_per_1k_tokens': round(rates[math.ceil(0.95 * len(rates)) - 1] * 1000, 3),
+            }
+            for route, rates in windows.items() if rates
+        }
+
+
+class ModelRouter:
+    """
+    Picks the model a document is enhanced with
+
+    There is always a 'quality' route (GEMINI_MODEL). With GEMINI_FAST_MODEL
+    set there is also a 'fast' route, preferred for short documents without
+    math that are not academic or technical. The preferred route is given up
+    for another when its predicted p95 latency is over the latency budget
+    and the other's is not (or is not known yet).
+
+    The router also decides when a call is hedged: once a route has enough
+    samples, an attempt still running at its predicted p95 gets a second
+    attempt, and the first to answer is used.
+    """
+
+    def __init__(
+        self,
+        routes: List[Route],
+        fast_max_input_tokens: int = 4000,
+        latency_budget: float = 60.0,
+        hedge: bool = True,
+        tracker: Optional[LatencyTracker] = None
+    ):
+        """
+        Initialize router
+
+        Args:
+            routes: Available routes, the default ('quality') first
+            fast_max_input_tokens: Largest document the fast route is preferred for
+            latency_budget: Predicted p95 seconds of a call above which a
+                route is given up for a faster one
+            hedge: Send a second attempt when the first passes its route's p95
+            tracker: Latency of each route (a new one by default)
+        """
+        self.routes = {route.name: route for route in routes}
+        self.default = routes[0]
+        self.fast_max_input_tokens = fast_max_input_tokens
+        self.latency_budget = latency_budget
+        self.hedge = hedge
+        self.tracker = tracker or LatencyTracker()
+
+    @classmethod
+    def from_env(cls, max_output_tokens: int = 8192) -> 'ModelRouter':
+        """Build a router from GEMINI_MODEL / GEMINI_FAST_* / GEMINI_LATENCY_BUDGET / GEMINI_HEDGE"""
+        routes = [Route('quality', os.getenv('GEMINI_MODEL', 'gemini-pro'), max_output_tokens)]
+        fast_model = os.getenv('GEMINI_FAST_MODEL')
+        if fast_model:
+            routes.append(Route(
+                'fast', fast_model, int(os.getenv('GEMINI_FAST_MAX_OUTPUT_TOKENS', max_output_tokens))
+            ))
+        return cls(
+            routes,
+            fast_max_input_tokens=int(os.getenv('GEMINI_FAST_MAX_INPUT_TOKENS', 4000)),
+            latency_budget=float(os.getenv('GEMINI_LATENCY_BUDGET', 60)),
+            hedge=os.getenv('GEMINI_HEDGE', '1') != '0'
+        )
+
+    def get(self, name: Optional[str]) -> Route:
+        """The route of a name (the default for None or an unknown name)"""
+        return self.routes.get(name, self.default) if name else self.default
+
+    def choose(self, input_tokens: int, output_tokens: int, doc_type: str = "auto", include_latex: bool = False) -> Route:
+        """
+        Route for enhancing a document
+
+        Args:
+            input_tokens: Tokens of the document
+            output_tokens: Output budget of one call
+            doc_type: Document type hint
+            include_latex: Whether the document has mathematical content
+
+        Returns:
+            The route its calls are sent to
+        """
+        fast = self.routes.get('fast')
+        if fast is None:
+            return self.default
+
+        demanding = include_latex or doc_type in QUALITY_DOC_TYPES or input_tokens > self.fast_max_input_tokens
+        preferred = self.default if demanding else fast
+        predicted = self.tracker.predict(preferred.name, output_tokens)
+        if predicted is None or predicted <= self.latency_budget:
+            return preferred
+
+        # Over budget: the fastest other route that fits, an unmeasured one
+        # counting as fitting until it has been measured
+        best, best_latency = preferred, predicted
+        for route in self.routes.values():
+            if route is preferred:
+                continue
+            latency = self.tracker.predict(route.name, output_tokens)
+            if latency is None or (latency <= self.latency_budget and latency < best_latency):
+                best, best_latency = route, latency if latency is not None else 0.0
+        return best
+
+    def hedge_delay(self, route: str, output_tokens: int) -> Optional[float]:
+        """Seconds after which an attempt on route is hedged (None: not hedged)"""
+        if not self.hedge:
+            return None
+        return self.tracker.predict(route, output_tokens)
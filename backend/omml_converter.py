@@ -0,0 +1,414 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Set, Tuple, Union
+from xml.sax.saxutils import escape, quoteattr
+
+from pdf_renderer import LATEX_IGNORED, LATEX_SYMBOLS
+
+# One token of LaTeX math: a control word, a control symbol or a character,
+# after any whitespace (which math mode ignores)
+TOKEN = re.compile(r'\s*(?:(\\[A-Za-z]+)|(\\.)|(.))', re.S)
+
+# Big operators: n-ary character, and whether limits go under/over it
+# (sums, products) or beside it (integrals)
+NARY = {
+    '\\sum': ('∑', True), '\\prod': ('∏', True), '\\coprod': ('∐', True),
+    '\\bigcup': ('⋃', True), '\\bigcap': ('⋂', True),
+    '\\int': ('∫', False), '\\iint': ('∬', False), '\\iiint': ('∭', False), '\\oint': ('∮', False),
+}
+
+# Operator names set upright
+FUNCTIONS = {
+    'sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'sinh', 'cosh', 'tanh', 'arcsin',
+    'arccos', 'arctan', 'log', 'ln', 'lg', 'exp', 'lim', 'max', 'min', 'sup', 'inf',
+    'det', 'arg', 'deg', 'dim', 'gcd', 'ker', 'Pr', 'mod',
+}
+# Operators whose subscript goes underneath
+LIMIT_FUNCTIONS = {'lim', 'max', 'min', 'sup', 'inf'}
+
+ACCENTS = {
+    '\\hat': '̂', '\\widehat': '̂', '\\bar': '̅', '\\overline': '̅',
+    '\\vec': '⃗', '\\dot': '̇', '\\ddot': '̈', '\\tilde': '̃',
+    '\\widetilde': '̃',
+}
+
+# Matrix environments: (opening, closing) delimiter; None for no delimiters
+MATRICES = {
+    'matrix': None, 'smallmatrix': None, 'array': None, 'aligned': None,
+    'align': None, 'align*': None, 'gathered': None, 'split': None,
+    'pmatrix': ('(', ')'), 'bmatrix': ('[', ']'), 'Bmatrix': ('{', '}'),
+    'vmatrix': ('|', '|'), 'Vmatrix': ('‖', '‖'), 'cases': ('{', ''),
+}
+
+# \left / \right delimiters written as commands
+DELIMITERS = {
+    '\\{': '{', '\\}': '}', '\\|': '‖', '\\langle': '⟨', '\\rangle': '⟩',
+    '\\lfloor': '⌊', '\\rfloor': '⌋', '\\lceil': '⌈', '\\rceil': '⌉', '.': '',
+}
+
+DOUBLE_STRUCK = {'R': 'ℝ', 'N': 'ℕ', 'Z': 'ℤ', 'Q': 'ℚ', 'C': 'ℂ', 'P': 'ℙ'}
+
+# Commands taking their argument as literal upright text
+TEXT_COMMANDS = {'\\text', '\\textrm', '\\textit', '\\mbox', '\\mathrm', '\\operatorname'}
+
+CHARACTERS = {'-': '−', "'": '′', '~': ' '}
+
+_MISSING = object()
+
+
+@dataclass
+class _Run:
+    """Math text not yet written out, merged with the runs next to it"""
+    text: str
+    style: str = ''
+
+
+# Parsed math: OMML strings and runs
+Nodes = List[Union[str, _Run]]
+
+
+def _run_xml(run: _Run) -> str:
+    properties = f'<m:rPr><m:sty m:val="{run.style}"/></m:rPr>' if run.style else ''
+    space = ' xml:space="preserve"' if run.text.strip() != run.text else ''
+    return f'<m:r>{properties}<m:t{space}>{escape(run.text)}</m:t></m:r>'
+
+
+def _xml(nodes: Nodes) -> str:
+    """OMML for parsed nodes, with neighbouring runs of one style as one <m:r>"""
+    parts = []
+    pending = None
+    for node in nodes:
+        if isinstance(node, _Run):
+            if pending is not None and pending.style == node.style:
+                pending = _Run(pending.text + node.text, node.style)
+                continue
+            if pending is not None:
+                parts.append(_run_xml(pending))
+            pending = node
+        else:
+            if pending is not None:
+                parts.append(_run_xml(pending))
+                pending = None
+            parts.append(node)
+    if pending is not None:
+        parts.append(_run_xml(pending))
+    return ''.join(parts)
+
+
+def _arg(tag: str, xml: str) -> str:
+    return f'<m:{tag}>{xml}</m:{tag}>' if xml else f'<m:{tag}/>'
+
+
+def _delimited(xml: str, opening: str, closing: str) -> str:
+    return (
+        f'<m:d><m:dPr><m:begChr m:val={quoteattr(opening)}/><m:endChr m:val={quoteattr(closing)}/></m:dPr>'
+        f'{_arg("e", xml)}</m:d>'
+    )
+
+
+class _Malformed(Exception):
+    """Source that can't be converted without losing part of it"""
+
+
+class _Parser:
+    """Recursive-descent parser of the common subset of LaTeX math into OMML"""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.pos = 0
+
+    def _token(self, consume: bool) -> Optional[str]:
+        match = TOKEN.match(self.source, self.pos)
+        if match is None:
+            return None
+        if consume:
+            self.pos = match.end()
+        return match.group(match.lastindex)
+
+    def peek(self) -> Optional[str]:
+        return self._token(False)
+
+    def next(self) -> Optional[str]:
+        return self._token(True)
+
+    def expect(self, token: str):
+        if self.next() != token:
+            raise _Malformed(f"Expected {token}")
+
+    def raw_group(self) -> str:
+        """The source of a {...} argument as written, for text and environment names"""
+        if self.peek() != '{':
+            token = self.next()
+            return token or ''
+        self.next()
+        depth = 1
+        start = self.pos
+        while self.pos < len(self.source):
+            char = self.source[self.pos]
+            self.pos += 1
+            if char == '\\':
+                self.pos += 1
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    return self.source[start:self.pos - 1]
+        raise _Malformed("Unbalanced braces")
+
+    def expression(self, stop: Set[str] = frozenset()) -> Nodes:
+        """Nodes up to (not including) a token in stop or the end"""
+        nodes = []
+        while True:
+            token = self.peek()
+            if token is None or token in stop:
+                return nodes
+            nodes.extend(self.scripted())
+
+    def argument_nodes(self) -> Nodes:
+        """A {...} group or a single token"""
+        token = self.next()
+        if token is None:
+            return []
+        if token == '{':
+            nodes = self.expression({'}'})
+            self.expect('}')
+            return nodes
+        return self.atom(token)
+
+    def argument(self) -> str:
+        return _xml(self.argument_nodes())
+
+    def scripts(self) -> Tuple[Optional[str], Optional[str]]:
+        """Subscript and superscript following an atom"""
+        sub = sup = None
+        while True:
+            token = self.peek()
+            if token == '_' and sub is None:
+                self.next()
+                sub = self.argument()
+            elif token == '^' and sup is None:
+                self.next()
+                sup = self.argument()
+            else:
+                return sub, sup
+
+    def scripted(self) -> Nodes:
+        """An atom with any sub/superscripts attached"""
+        token = self.next()
+
+        if token in NARY:
+            char, under = NARY[token]
+            sub, sup = self.scripts()
+            operand = '' if self.peek() in (None, '}', '&', '\\\\', '\\right', '\\end') else _xml(self.scripted())
+            properties = f'<m:chr m:val="{char}"/><m:limLoc m:val="{"undOvr" if under else "subSup"}"/>'
+            if sub is None:
+                properties += '<m:subHide m:val="1"/>'
+            if sup is None:
+                properties += '<m:supHide m:val="1"/>'
+            return [
+                f'<m:nary><m:naryPr>{properties}</m:naryPr>'
+                f'{_arg("sub", sub or "")}{_arg("sup", sup or "")}{_arg("e", operand)}</m:nary>'
+            ]
+
+        if token in ('^', '_'):
+            # Script with nothing before it
+            self.pos -= 1
+            base = []
+        else:
+            base = self.atom(token)
+
+        sub, sup = self.scripts()
+        if sub is None and sup is None:
+            return base
+        base_xml = _xml(base)
+        if token is not None and token[1:] in LIMIT_FUNCTIONS and sub is not None:
+            limited = f'<m:limLow>{_arg("e", base_xml)}{_arg("lim", sub)}</m:limLow>'
+            if sup is None:
+                return [limited]
+            return [f'<m:sSup>{_arg("e", limited)}{_arg("sup", sup)}</m:sSup>']
+        if sup is None:
+            return [f'<m:sSub>{_arg("e", base_xml)}{_arg("sub", sub)}</m:sSub>']
+        if sub is None:
+            return [f'<m:sSup>{_arg("e", base_xml)}{_arg("sup", sup)}</m:sSup>']
+        return [f'<m:sSubSup>{_arg("e", base_xml)}{_arg("sub", sub)}{_arg("sup", sup)}</m:sSubSup>']
+
+    def atom(self, token: str) -> Nodes:
+        """Nodes of one token and the arguments it takes"""
+        if token == '{':
+            nodes = self.expression({'}'})
+            self.expect('}')
+            return nodes
+        if token in ('}', '&', '\\\\', '\\right', '\\end'):
+            # Out of place: unbalanced braces, & or \\ outside a matrix, \right or \end without its opening
+            raise _Malformed(f"Unexpected {token}")
+        if not token.startswith('\\') or len(token) == 1:
+            return [_Run(CHARACTERS.get(token, token))]
+
+        if token in ('\\frac', '\\dfrac', '\\tfrac', '\\cfrac'):
+            numerator = self.argument()
+            return [f'<m:f>{_arg("num", numerator)}{_arg("den", self.argument())}</m:f>']
+        if token == '\\binom':
+            top = self.argument()
+            fraction = (
+                f'<m:f><m:fPr><m:type m:val="noBar"/></m:fPr>'
+                f'{_arg("num", top)}{_arg("den", self.argument())}</m:f>'
+            )
+            return [_delimited(fraction, '(', ')')]
+        if token == '\\sqrt':
+            degree = ''
+            if self.peek() == '[':
+                self.next()
+                degree = _xml(self.expression({']'}))
+                self.expect(']')
+            radicand = self.argument()
+            if not degree:
+                return [f'<m:rad><m:radPr><m:degHide m:val="1"/></m:radPr><m:deg/>{_arg("e", radicand)}</m:rad>']
+            return [f'<m:rad>{_arg("deg", degree)}{_arg("e", radicand)}</m:rad>']
+        if token in ACCENTS:
+            return [f'<m:acc><m:accPr><m:chr m:val="{ACCENTS[token]}"/></m:accPr>{_arg("e", self.argument())}</m:acc>']
+        if token in TEXT_COMMANDS:
+            return [_Run(self.raw_group(), 'p')]
+        if token in ('\\mathbf', '\\boldsymbol', '\\mathit', '\\mathbb'):
+            nodes = self.argument_nodes()
+            if token == '\\mathbb':
+                return [
+                    _Run(''.join(DOUBLE_STRUCK.get(c, c) for c in node.text), 'p') if isinstance(node, _Run) else node
+                    for node in nodes
+                ]
+            style = {'\\mathbf': 'b', '\\boldsymbol': 'bi', '\\mathit': 'i'}[token]
+            return [_Run(node.text, style) if isinstance(node, _Run) else node for node in nodes]
+        if token == '\\left':
+            opening = self._delimiter(self.next())
+            inner = _xml(self.expression({'\\right'}))
+            self.expect('\\right')
+            return [_delimited(inner, opening, self._delimiter(self.next()))]
+        if token == '\\begin':
+            return self.environment(self.raw_group())
+
+        name = token[1:]
+        if name in FUNCTIONS:
+            return [_Run(name, 'p')]
+        if name in LATEX_SYMBOLS:
+            return [_Run(LATEX_SYMBOLS[name])]
+        if token in DELIMITERS:
+            return [_Run(DELIMITERS[token])]
+        if name in LATEX_IGNORED:
+            return []
+        if len(name) == 1:
+            # Escaped character: \% \$ \# \_ \&
+            return [_Run(name)]
+        return [_Run(name, 'p')]
+
+    @staticmethod
+    def _delimiter(token: Optional[str]) -> str:
+        if token is None:
+            return ''
+        return DELIMITERS.get(token, token if len(token) == 1 else '')
+
+    def environment(self, name: str) -> Nodes:
+        """A matrix-like environment as an OMML matrix"""
+        if name == 'array' and self.peek() == '{':
+            # Column specification
+            self.raw_group()
+
+        rows = []
+        cells = []
+        while True:
+            cells.append(_xml(self.expression({'&', '\\\\', '\\end'})))
+            token = self.next()
+            if token == '&':
+                continue
+            rows.append(cells)
+            cells = []
+            if token == '\\end':
+                self.raw_group()
+                break
+            if token is None:
+                raise _Malformed(f"Unterminated {name} environment")
+        # A trailing \\ leaves an empty last row
+        if len(rows) > 1 and rows[-1] == ['']:
+            rows.pop()
+
+        columns = max(len(row) for row in rows)
+        matrix = '<m:m>' + ''.join(
+            '<m:mr>' + ''.join(_arg('e', cell) for cell in row + [''] * (columns - len(row))) + '</m:mr>'
+            for row in rows
+        ) + '</m:m>'
+        delimiters = MATRICES.get(name)
+        if delimiters is None:
+            return [matrix]
+        return [_delimited(matrix, *delimiters)]
+
+
+class OmmlConverter:
+    """
+    Converts LaTeX equations to Office Math (OMML), the equation objects Word edits natively
+
+    Covers the common subset: fractions, roots, sub/superscripts, big
+    operators with limits, Greek letters and symbols, accents, \\left...\\right
+    delimiters, matrices and cases. Unknown commands are written as upright
+    text rather than failing.
+
+    Documents repeat the same expressions (variable definitions, recurring
+    formulas), so compiled fragments are kept in an LRU cache keyed by the
+    whitespace-normalized source, shared by every document this process renders.
+    """
+
+    def __init__(self, cache_size: int = 2048):
+        """
+        Initialize converter
+
+        Args:
+            cache_size: Compiled equations kept (0 disables the cache)
+        """
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def from_env(cls) -> 'OmmlConverter':
+        """Build a converter from OMML_CACHE_SIZE"""
+        return cls(cache_size=int(os.getenv('OMML_CACHE_SIZE', 2048)))
+
+    @staticmethod
+    def normalize(latex: str) -> str:
+        """Cache key of an equation: its source with whitespace collapsed"""
+        return ' '.join(latex.split())
+
+    def convert(self, latex: str) -> Optional[str]:
+        """
+        Convert one equation
+
+        Args:
+            latex: Equation source without its $ delimiters
+
+        Returns:
+            <m:oMath> element, or None if the source could not be converted
+            (nesting too deep, or unbalanced braces, environments or
+            \\left...\\right, which would otherwise lose part of it)
+        """
+        key = self.normalize(latex)
+        with self._lock:
+            omml = self._cache.get(key, _MISSING)
+            if omml is not _MISSING:
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return omml
+            self.stats['misses'] += 1
+
+        try:
+            omml = f'<m:oMath>{_xml(_Parser(key).expression())}</m:oMath>'
+        except (RecursionError, _Malformed):
+            omml = None
+
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[key] = omml
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return omml
@@ -0,0 +1,368 @@
+import io
+import re
+import zlib
+from typing import BinaryIO, Iterable, List, Tuple
+
+from document_blocks import Block
+
+# Advance widths (1/1000 em) of Helvetica for characters 32-126, from the
+# standard Adobe font metrics. Helvetica-Oblique shares them.
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+
+# Symbol font codes for characters WinAnsiEncoding cannot represent
+SYMBOL_CODES = {
+    'α': 0x61, 'β': 0x62, 'γ': 0x67, 'δ': 0x64, 'ε': 0x65, 'ζ': 0x7A, 'η': 0x68,
+    'θ': 0x71, 'ι': 0x69, 'κ': 0x6B, 'λ': 0x6C, 'μ': 0x6D, 'ν': 0x6E, 'ξ': 0x78,
+    'π': 0x70, 'ρ': 0x72, 'σ': 0x73, 'τ': 0x74, 'υ': 0x75, 'φ': 0x66, 'χ': 0x63,
+    'ψ': 0x79, 'ω': 0x77, 'Γ': 0x47, 'Δ': 0x44, 'Θ': 0x51, 'Λ': 0x4C, 'Ξ': 0x58,
+    'Π': 0x50, 'Σ': 0x53, 'Φ': 0x46, 'Ψ': 0x59, 'Ω': 0x57,
+    '∫': 0xF2, '∑': 0xE5, '∏': 0xD5, '√': 0xD6, '∞': 0xA5, '≤': 0xA3, '≥': 0xB3,
+    '≠': 0xB9, '≈': 0xBB, '∈': 0xCE, '∉': 0xCF, '⊂': 0xCC, '⊃': 0xC9, '∪': 0xC8,
+    '∩': 0xC7, '∀': 0x22, '∃': 0x24, '∇': 0xD1, '∂': 0xB6, '→': 0xAE, '←': 0xAC,
+    '⇒': 0xDE, '⇔': 0xDB, '·': 0xD7, '−': 0x2D,
+}
+
+# LaTeX commands rendered as a single character
+LATEX_SYMBOLS = {
+    'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ', 'epsilon': 'ε',
+    'varepsilon': 'ε', 'zeta': 'ζ', 'eta': 'η', 'theta': 'θ', 'iota': 'ι',
+    'kappa': 'κ', 'lambda': 'λ', 'mu': 'μ', 'nu': 'ν', 'xi': 'ξ', 'pi': 'π',
+    'rho': 'ρ', 'sigma': 'σ', 'tau': 'τ', 'upsilon': 'υ', 'phi': 'φ',
+    'varphi': 'φ', 'chi': 'χ', 'psi': 'ψ', 'omega': 'ω', 'Gamma': 'Γ',
+    'Delta': 'Δ', 'Theta': 'Θ', 'Lambda': 'Λ', 'Xi': 'Ξ', 'Pi': 'Π',
+    'Sigma': 'Σ', 'Phi': 'Φ', 'Psi': 'Ψ', 'Omega': 'Ω',
+    'int': '∫', 'sum': '∑', 'prod': '∏', 'sqrt': '√', 'infty': '∞', 'leq': '≤',
+    'le': '≤', 'geq': '≥', 'ge': '≥', 'neq': '≠', 'ne': '≠', 'approx': '≈',
+    'in': '∈', 'notin': '∉', 'subset': '⊂', 'supset': '⊃', 'cup': '∪',
+    'cap': '∩', 'forall': '∀', 'exists': '∃', 'nabla': '∇', 'partial': '∂',
+    'to': '→', 'rightarrow': '→', 'leftarrow': '←', 'Rightarrow': '⇒',
+    'Leftrightarrow': '⇔', 'cdot': '·', 'times': '×', 'div': '÷', 'pm': '±',
+    'quad': '  ', 'qquad': '    ', ',': ' ', ';': ' ', '!': '', ' ': ' ',
+}
+
+# Commands that only affect spacing or sizing and print nothing
+LATEX_IGNORED = {'left', 'right', 'big', 'Big', 'bigg', 'Bigg', 'displaystyle', 'mathrm', 'mathbf', 'text'}
+
+LATEX_COMMAND = re.compile(r'\\([A-Za-z]+|.)')
+LATEX_FRAC = re.compile(r'\\frac\s*\{([^{}]*)\}\s*\{([^{}]*)\}')
+
+
+def latex_to_text(latex: str) -> str:
+    """Approximate a LaTeX expression as linear text for PDF output"""
+    previous = None
+    while previous != latex:
+        previous = latex
+        latex = LATEX_FRAC.sub(r'(\1)/(\2)', latex)
+
+    def command(match):
+        name = match.group(1)
+        if name in LATEX_SYMBOLS:
+            return LATEX_SYMBOLS[name]
+        if name in LATEX_IGNORED:
+            return ''
+        if name == '\\':
+            # Row break in matrices and aligned environments
+            return '  '
+        return name
+
+    latex = LATEX_COMMAND.sub(command, latex)
+    return latex.replace('{', '').replace('}', '')
+
+
+class PdfRenderer:
+    """
+    Renders a block model to PDF without external tools
+
+    Pages are laid out and written one at a time, so memory stays bounded by
+    a single page no matter how long the document is. The standard PDF fonts
+    (Helvetica family and Symbol) need no font files and are declared once
+    per document and shared by every page.
+    """
+
+    PAGE_WIDTH = 595.0   # A4
+    PAGE_HEIGHT = 842.0
+    MARGIN = 72.0
+
+    BODY_SIZE = 11.0
+    LEADING = 1.35
+    HEADING_SIZES = {0: 20.0, 1: 16.0, 2: 14.0, 3: 12.0}
+    LIST_INDENT = 18.0
+
+    # Font resource name -> base font
+    FONTS = [
+        ('F1', 'Helvetica'),
+        ('F2', 'Helvetica-Bold'),
+        ('F3', 'Helvetica-Oblique'),
+        ('F4', 'Symbol'),
+    ]
+
+    # Object numbers: 1 catalog, 2 page tree, then one per font
+    FIRST_FREE_OBJECT = 3 + len(FONTS)
+
+    def __init__(self):
+        self._out = None
+        self._offsets = {}
+        self._next_object = self.FIRST_FREE_OBJECT
+        self._page_ids = []
+        self._ops = []
+        self._y = 0.0
+
+    # -- text measurement -------------------------------------------------
+
+    def _runs(self, text: str, font: str) -> List[Tuple[str, bytes]]:
+        """Split text into (font, encoded bytes) runs, using Symbol where needed"""
+        runs = []
+        current_font, current = font, bytearray()
+        for char in text:
+            try:
+                encoded, char_font = char.encode('cp1252'), font
+            except UnicodeEncodeError:
+                if char in SYMBOL_CODES:
+                    encoded, char_font = bytes([SYMBOL_CODES[char]]), 'F4'
+                else:
+                    encoded, char_font = b'?', font
+            if char_font != current_font and current:
+                runs.append((current_font, bytes(current)))
+                current = bytearray()
+            current_font = char_font
+            current += encoded
+        if current:
+            runs.append((current_font, bytes(current)))
+        return runs
+
+    def _width(self, font: str, data: bytes, size: float) -> float:
+        """Width of encoded text in points"""
+        if font == 'F4':
+            units = 600 * len(data)
+        else:
+            units = sum(HELVETICA_WIDTHS[b - 32] if 32 <= b <= 126 else 556 for b in data)
+            if font == 'F2':
+                # Helvetica-Bold runs about 6% wider than regular
+                units *= 1.06
+        return units * size / 1000
+
+    # -- object output ----------------------------------------------------
+
+    def _write_object(self, number: int, body: bytes):
+        self._offsets[number] = self._out.tell()
+        self._out.write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+
+    def _allocate(self) -> int:
+        number = self._next_object
+        self._next_object += 1
+        return number
+
+    # -- page handling ----------------------------------------------------
+
+    def _start_page(self):
+        self._ops = []
+        self._y = self.PAGE_HEIGHT - self.MARGIN
+
+    def _finish_page(self):
+        """Write the current page's content stream and page object"""
+        content = zlib.compress(b'\n'.join(self._ops))
+        content_id, page_id = self._allocate(), self._allocate()
+        self._write_object(
+            content_id,
+            b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content)
+            + content + b'\nendstream'
+        )
+        self._write_object(
+            page_id,
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+            b'/Resources << /Font << %s >> >> /Contents %d 0 R >>' % (
+                self.PAGE_WIDTH, self.PAGE_HEIGHT,
+                b' '.join(b'/%s %d 0 R' % (name.encode(), 3 + i) for i, (name, _) in enumerate(self.FONTS)),
+                content_id
+            )
+        )
+        self._page_ids.append(page_id)
+        self._ops = []
+
+    def _ensure_space(self, height: float):
+        at_top = self._y >= self.PAGE_HEIGHT - self.MARGIN
+        if self._y - height < self.MARGIN and not at_top:
+            self._finish_page()
+            self._start_page()
+
+    # -- layout -----------------------------------------------------------
+
+    @staticmethod
+    def _escape(data: bytes) -> bytes:
+        return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+    def _line_ops(self, runs, size: float, x: float, y: float) -> bytes:
+        parts = [b'BT %.2f %.2f Td' % (x, y)]
+        current_font = None
+        for font, data in runs:
+            if font != current_font:
+                parts.append(b'/%s %.1f Tf' % (font.encode(), size))
+                current_font = font
+            parts.append(b'(%s) Tj' % self._escape(data))
+        parts.append(b'ET')
+        return b' '.join(parts)
+
+    def _wrap(self, runs, size: float, width: float):
+        """Greedy word wrap of (font, bytes) runs into lines of runs"""
+        words = []
+        for font, data in runs:
+            for piece in re.split(rb'( )', data):
+                if piece:
+                    words.append((font, piece))
+
+        lines, line, line_width = [], [], 0.0
+        for font, piece in words:
+            piece_width = self._width(font, piece, size)
+            if piece != b' ' and line and line_width + piece_width > width:
+                while line and line[-1][1] == b' ':
+                    line.pop()
+                lines.append(line)
+                line, line_width = [], 0.0
+            if piece == b' ' and not line:
+                continue
+            # A single word wider than the line is cut where it overflows
+            while piece_width > width and len(piece) > 1:
+                cut = len(piece) - 1
+                while cut > 1 and self._width(font, piece[:cut], size) > width - line_width:
+                    cut -= 1
+                line.append((font, piece[:cut]))
+                lines.append(line)
+                line, line_width = [], 0.0
+                piece = piece[cut:]
+                piece_width = self._width(font, piece, size)
+            line.append((font, piece))
+            line_width += piece_width
+        if line:
+            lines.append(line)
+        return lines
+
+    def _merge(self, line):
+        """Join adjacent pieces in the same font into one Tj"""
+        merged = []
+        for font, data in line:
+            if merged and merged[-1][0] == font:
+                merged[-1] = (font, merged[-1][1] + data)
+            else:
+                merged.append((font, data))
+        return merged
+
+    def _add_text(self, runs, size: float, indent: float = 0.0, centered: bool = False,
+                  space_before: float = 0.0, space_after: float = 0.0, label=None):
+        width = self.PAGE_WIDTH - 2 * self.MARGIN - indent
+        line_height = size * self.LEADING
+        lines = self._wrap(runs, size, width) or [[]]
+
+        self._y -= space_before
+        for i, line in enumerate(lines):
+            self._ensure_space(line_height)
+            self._y -= line_height
+            line = self._merge(line)
+            x = self.MARGIN + indent
+            if centered:
+                line_width = sum(self._width(font, data, size) for font, data in line)
+                x = (self.PAGE_WIDTH - line_width) / 2
+            if label and i == 0:
+                self._ops.append(self._line_ops(label, size, self.MARGIN + indent - self.LIST_INDENT, self._y))
+            if line:
+                self._ops.append(self._line_ops(line, size, x, self._y))
+        self._y -= space_after
+
+    def _render_block(self, block: Block, number: int):
+        size = self.BODY_SIZE
+        kind = block.kind
+
+        if kind == 'empty':
+            self._y -= size * 0.6
+        elif kind == 'heading':
+            heading_size = self.HEADING_SIZES.get(block.level, size)
+            self._ensure_space(heading_size * 3)
+            self._add_text(self._runs(block.text, 'F2'), heading_size,
+                           space_before=heading_size * 0.5, space_after=heading_size * 0.25)
+        elif kind == 'bullet':
+            self._add_text(self._runs(block.text, 'F1'), size, indent=self.LIST_INDENT,
+                           label=self._runs('•', 'F1'))
+        elif kind == 'number':
+            self._add_text(self._runs(block.text, 'F1'), size, indent=self.LIST_INDENT,
+                           label=self._runs(f'{number}.', 'F1'))
+        elif kind == 'display_math':
+            self._add_text(self._runs(latex_to_text(block.text), 'F3'), size + 1, centered=True,
+                           space_before=size * 0.5, space_after=size * 0.5)
+        elif kind == 'math_paragraph':
+            runs = []
+            for is_math, text in block.segments:
+                if is_math:
+                    runs.extend(self._runs(latex_to_text(text), 'F3'))
+                else:
+                    runs.extend(self._runs(text, 'F1'))
+            self._add_text(runs, size, space_after=size * 0.3)
+        else:
+            self._add_text(self._runs(block.text, 'F1'), size, space_after=size * 0.3)
+
+    def render_to(self, blocks: Iterable[Block], out: BinaryIO):
+        """
+        Render blocks as a PDF file into a binary stream
+
+        Args:
+            blocks: Blocks from parse_blocks (any iterable, consumed once)
+            out: Writable binary stream
+        """
+        self._out = out
+        self._offsets = {}
+        self._next_object = self.FIRST_FREE_OBJECT
+        self._page_ids = []
+
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+        # Fonts are written once and shared by every page
+        for i, (_, base_font) in enumerate(self.FONTS):
+            encoding = b'' if base_font == 'Symbol' else b' /Encoding /WinAnsiEncoding'
+            self._write_object(
+                3 + i,
+                b'<< /Type /Font /Subtype /Type1 /BaseFont /%s%s >>' % (base_font.encode(), encoding)
+            )
+
+        self._start_page()
+        number = 0
+        for block in blocks:
+            number = number + 1 if block.kind == 'number' else 0
+            self._render_block(block, number)
+        self._finish_page()
+
+        self._write_object(
+            2,
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                b' '.join(b'%d 0 R' % page_id for page_id in self._page_ids),
+                len(self._page_ids)
+            )
+        )
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref_offset = out.tell()
+        size = self._next_object
+        out.write(b'xref\n0 %d\n0000000000 65535 f \n' % size)
+        for number in range(1, size):
+            out.write(b'%010d 00000 n \n' % self._offsets[number])
+        out.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref_offset))
+
+    def render(self, blocks: Iterable[Block]) -> bytes:
+        """
+        Render blocks to a PDF file
+
+        Args:
+            blocks: Blocks from parse_blocks
+
+        Returns:
+            PDF file as bytes
+        """
+        output_buffer = io.BytesIO()
+        # Layout state lives on the instance; a fresh one keeps a shared
+        # renderer safe to use from several threads
+        PdfRenderer().render_to(blocks, output_buffer)
+        return output_buffer.getvalue()
@@ -0,0 +1,236 @@
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional, Tuple
+
+# Local estimator: Gemini's tokenizer averages about 4 characters per token
+# on English prose; short-word or symbol-dense text (LaTeX, tables) is closer
+# to 1.3 tokens per word, so the larger of the two is used
+CHARS_PER_TOKEN = 4.0
+TOKENS_PER_WORD = 1.3
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local estimate of the token count of a text"""
+    if not text:
+        return 0
+    return math.ceil(max(len(text) / CHARS_PER_TOKEN, len(text.split()) * TOKENS_PER_WORD))
+
+
+@dataclass
+class PromptPlan:
+    """
+    How a document will be sent to Gemini, decided before any network call
+
+    action is one of:
+    - 'single': one prompt with the whole document
+    - 'chunk': the document is enhanced in chunks of at most chunk_chars
+    - 'summarize': too long to enhance in full, chunks are condensed instead
+    - 'reject': too long to process at all (reason says why)
+    """
+    action: str
+    input_tokens: int
+    prompt_overhead_tokens: int
+    max_output_tokens: int
+    chunk_chars: int
+    chunks: int
+    estimated_total_tokens: int
+    estimator: str
+    reason: str = ""
+    # Model route the calls go to and its model ("" without a router)
+    route: str = ""
+    model_name: str = ""
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class PromptPlanner:
+    """
+    Sizes Gemini calls to the model's limits before anything is sent
+
+    The output budget is derived from the input (enhanced text is a little
+    longer than the original, more so with LaTeX), so small documents no
+    longer reserve the full max_output_tokens. Documents whose output would
+    not fit one call are chunked; ones that would need more than max_chunks
+    chunks are summarized; ones too long even for that are rejected.
+    """
+
+    # Enhanced text vs original, in tokens
+    OUTPUT_EXPANSION = 1.25
+    LATEX_OUTPUT_EXPANSION = 1.5
+    # Added to every output budget for headings, list markers and slack
+    OUTPUT_HEADROOM = 256
+    MIN_OUTPUT_TOKENS = 1024
+
+    def __init__(
+        self,
+        gemini_client,
+        latex_processor,
+        chunker,
+        result_cache=None,
+        context_tokens: int = 30720,
+        max_chunks: int = 64,
+        use_sdk_counter: bool = False,
+        router=None
+    ):
+        """
+        Initialize planner
+
+        Args:
+            gemini_client: Client whose generation_config caps the output
+            latex_processor: Processor that builds the prompts
+            chunker: Chunker used for long documents (its max_chunk_chars and
+                context_chars bound the planned chunks)
+            result_cache: Cache for SDK token counts (namespace 'tokens')
+            context_tokens: Input token limit of the model
+            max_chunks: Most chunks a document may be enhanced in
+            use_sdk_counter: Count document tokens with the SDK instead of the
+                local estimator (one extra call per new document)
+            router: ModelRouter choosing each document's model, whose output
+                cap also bounds the plan (optional)
+        """
+        self.gemini_client = gemini_client
+        self.latex_processor = latex_processor
+        self.chunker = chunker
+        self.result_cache = result_cache
+        self.context_tokens = context_tokens
+        self.max_chunks = max_chunks
+        self.use_sdk_counter = use_sdk_counter
+        self.router = router
+
+    @classmethod
+    def from_env(cls, gemini_client, latex_processor, chunker, result_cache=None, router=None) -> 'PromptPlanner':
+        """Build a planner from GEMINI_CONTEXT_TOKENS / ENHANCE_MAX_CHUNKS / GEMINI_TOKEN_COUNTER"""
+        return cls(
+            gemini_client,
+            latex_processor,
+            chunker,
+            result_cache=result_cache,
+            context_tokens=int(os.getenv('GEMINI_CONTEXT_TOKENS', 30720)),
+            max_chunks=int(os.getenv('ENHANCE_MAX_CHUNKS', 64)),
+            use_sdk_counter=os.getenv('GEMINI_TOKEN_COUNTER', 'local') == 'sdk',
+            router=router
+        )
+
+    def count_tokens(self, text: str) -> Tuple[int, str]:
+        """
+        Token count of a text and the estimator that produced it
+
+        SDK counts are cached by content, and fall back to the local
+        estimator if the SDK call fails.
+        """
+        if not self.use_sdk_counter or not text:
+            return estimate_tokens(text), 'local'
+
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.make_key(text, self.gemini_client.model_name)
+            cached = self.result_cache.get_text('tokens', key)
+            if cached is not None:
+                return int(cached), 'sdk'
+
+        try:
+            tokens = self.gemini_client.count_tokens(text)
+        except Exception as e:
+            print(f"Token counting failed, using local estimate: {str(e)}")
+            return estimate_tokens(text), 'local'
+
+        if key is not None:
+            self.result_cache.set_text('tokens', key, str(tokens))
+        return tokens, 'sdk'
+
+    def output_tokens_for(self, input_tokens: int, include_latex: bool, cap: Optional[int] = None) -> int:
+        """Output budget for enhancing input_tokens of document text (cap defaults to generation_config's)"""
+        expansion = self.LATEX_OUTPUT_EXPANSION if include_latex else self.OUTPUT_EXPANSION
+        budget = math.ceil(input_tokens * expansion) + self.OUTPUT_HEADROOM
+        cap = cap or self.gemini_client.generation_config['max_output_tokens']
+        return max(min(budget, cap), min(self.MIN_OUTPUT_TOKENS, cap))
+
+    def plan(
+        self,
+        content: str,
+        user_instructions: str = "",
+        doc_type: str = "auto",
+        include_latex: bool = False
+    ) -> PromptPlan:
+        """
+        Decide how to send a document to Gemini
+
+        Args:
+            content: Extracted document text
+            user_instructions: User's specific instructions
+            doc_type: Type of document
+            include_latex: Whether to include LaTeX formatting
+
+        Returns:
+            The prompt plan
+        """
+        input_tokens, estimator = self.count_tokens(content)
+        # Everything in a prompt except the document itself, including the
+        # chunk header and neighbouring context a chunk may get
+        overhead = estimate_tokens(self.latex_processor.build_enhancement_prompt(
+            content="",
+            user_instructions=user_instructions,
+            doc_type=doc_type,
+            include_latex=include_latex,
+            part=(1, 1)
+        )) + 2 * estimate_tokens('x' * self.chunker.context_chars)
+
+        cap = self.gemini_client.generation_config['max_output_tokens']
+        route = model_name = ""
+        if self.router is not None:
+            chosen = self.router.choose(
+                input_tokens, self.output_tokens_for(input_tokens, include_latex), doc_type, include_latex
+            )
+            route, model_name = chosen.name, chosen.model_name
+            cap = min(cap, chosen.max_output_tokens)
+        expansion = self.LATEX_OUTPUT_EXPANSION if include_latex else self.OUTPUT_EXPANSION
+        chars_per_token = len(content) / input_tokens if input_tokens else CHARS_PER_TOKEN
+
+        # Largest chunk whose enhanced output fits one call, and largest whose
+        # prompt fits the context window
+        output_bound = int((cap - self.OUTPUT_HEADROOM) / expansion * chars_per_token)
+        context_bound = int((self.context_tokens - overhead) * chars_per_token)
+        chunk_chars = max(1, min(self.chunker.max_chunk_chars, output_bound, context_bound))
+
+        def plan_for(action, chars, output_tokens, reason=""):
+            chunks = max(1, math.ceil(len(content) / chars))
+            return PromptPlan(
+                action=action,
+                input_tokens=input_tokens,
+                prompt_overhead_tokens=overhead,
+                max_output_tokens=output_tokens,
+                chunk_chars=chars,
+                chunks=chunks,
+                estimated_total_tokens=input_tokens + chunks * (overhead + output_tokens),
+                estimator=estimator,
+                reason=reason,
+                route=route,
+                model_name=model_name
+            )
+
+        if len(content) <= chunk_chars:
+            return plan_for('single', chunk_chars, self.output_tokens_for(input_tokens, include_latex, cap))
+
+        chunk_tokens = math.ceil(chunk_chars / chars_per_token)
+        plan = plan_for('chunk', chunk_chars, self.output_tokens_for(chunk_tokens, include_latex, cap))
+        if plan.chunks <= self.max_chunks:
+            return plan
+
+        # Too many chunks to enhance in full: fill the context window per
+        # chunk and have each condensed into one output budget
+        summary_chars = max(chunk_chars, context_bound)
+        plan = plan_for(
+            'summarize', summary_chars, cap,
+            reason=f"Enhancing in full would take {plan.chunks} chunks (limit {self.max_chunks})"
+        )
+        if plan.chunks <= self.max_chunks:
+            return plan
+
+        plan.action = 'reject'
+        plan.reason = (
+            f"Document is too long to process (about {input_tokens} tokens, "
+            f"{plan.chunks} chunks even when summarized; limit {self.max_chunks})"
+        )
+        return plan
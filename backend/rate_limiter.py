@@ -0,0 +1,176 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    Token buckets for Gemini requests and tokens per minute
+
+    Bucket state lives in a SQLite file, so every gunicorn worker on the host
+    draws from the same budget. Each acquire is one short IMMEDIATE
+    transaction: the write lock serializes workers, and a request only
+    proceeds once both buckets can cover it.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 60,
+        tokens_per_minute: float = 0,
+        db_path: Optional[str] = None
+    ):
+        """
+        Initialize limiter
+
+        Args:
+            requests_per_minute: Request budget (0 disables the request bucket)
+            tokens_per_minute: Estimated token budget (0 disables the token bucket)
+            db_path: SQLite file shared by the workers
+                (defaults to verolabz_rate.db in the temp directory)
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.db_path = db_path or os.path.join(tempfile.gettempdir(), 'verolabz_rate.db')
+
+        self._local = threading.local()
+
+        if self.enabled:
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " name TEXT PRIMARY KEY,"
+                " level REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+
+    @classmethod
+    def from_env(cls) -> 'RateLimiter':
+        """Build a limiter from GEMINI_RPM / GEMINI_TPM / GEMINI_RATE_DB"""
+        return cls(
+            requests_per_minute=float(os.getenv('GEMINI_RPM', 60)),
+            tokens_per_minute=float(os.getenv('GEMINI_TPM', 0)),
+            db_path=os.getenv('GEMINI_RATE_DB') or None
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests_per_minute > 0 or self.tokens_per_minute > 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """SQLite connections can't be shared between threads; keep one per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _buckets(self, tokens: int):
+        """(name, capacity per minute, amount needed) for every active bucket"""
+        buckets = []
+        if self.requests_per_minute > 0:
+            buckets.append(('requests', self.requests_per_minute, 1.0))
+        if self.tokens_per_minute > 0:
+            # A prompt larger than the whole budget still goes through once the
+            # bucket is full, instead of waiting forever
+            buckets.append(('tokens', self.tokens_per_minute, float(min(tokens, self.tokens_per_minute))))
+        return buckets
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """
+        Take one request and the estimated tokens if both are available
+
+        Args:
+            tokens: Estimated tokens of the call
+
+        Returns:
+            0 if the budget was taken, otherwise seconds until it will be there
+        """
+        if not self.enabled:
+            return 0.0
+
+        conn = self._connection()
+        now = time.time()
+        wait = 0.0
+        levels = {}
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name, capacity, needed in self._buckets(tokens):
+                row = conn.execute(
+                    "SELECT level, updated_at FROM buckets WHERE name = ?", (name,)
+                ).fetchone()
+                rate = capacity / 60.0
+                if row is None:
+                    level = capacity
+                else:
+                    level = min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                levels[name] = level - needed
+                if level < needed:
+                    wait = max(wait, (needed - level) / rate)
+
+            if wait == 0.0:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                    [(name, level, now) for name, level in levels.items()]
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def acquire(self, tokens: int = 0, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until one request and the estimated tokens are available
+
+        Args:
+            tokens: Estimated tokens of the call
+            timeout: Longest time to wait in seconds (None waits indefinitely)
+
+        Returns:
+            True once the budget was taken, False if it would take longer than timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int = 0, timeout: Optional[float] = None) -> bool:
+        """
+        acquire for coroutines: the transaction runs on the loop's default
+        executor and waiting for the budget does not block the event loop
+
+        Args:
+            tokens: Estimated tokens of the call
+            timeout: Longest time to wait in seconds (None waits indefinitely)
+
+        Returns:
+            True once the budget was taken, False if it would take longer than timeout
+        """
+        if not self.enabled:
+            return True
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = await loop.run_in_executor(None, self.try_acquire, tokens)
+            if wait == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def reset(self):
+        """Refill every bucket (tests and operator tooling)"""
+        if self.enabled:
+            self._connection().execute("DELETE FROM buckets")
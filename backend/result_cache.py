@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResultCache:
+    """
+    Content-addressed cache for enhancement results
+
+    Two tiers:
+    - an in-process LRU bounded by total value size in bytes
+    - an optional SQLite file shared by every gunicorn worker on the host
+
+    Entries expire after a TTL in both tiers. Values are stored as bytes under
+    a namespace ('enhanced' for Gemini output, 'section' for the output of
+    one section of it, 'document' for rendered files).
+    """
+
+    # Purge expired rows from the disk tier every N writes
+    PURGE_INTERVAL = 100
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: float = 24 * 3600,
+        db_path: Optional[str] = None
+    ):
+        """
+        Initialize cache
+
+        Args:
+            max_bytes: Size cap of the in-process tier (0 disables it)
+            ttl_seconds: Time to live of every entry
+            db_path: SQLite file for the shared on-disk tier (None disables it)
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._local = threading.local()
+        self._writes = 0
+
+        self.stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'evictions': 0,
+        }
+
+        if self.db_path:
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value BLOB NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    @classmethod
+    def from_env(cls) -> 'ResultCache':
+        """Build a cache from ENHANCE_CACHE_* environment variables"""
+        return cls(
+            max_bytes=int(os.getenv('ENHANCE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            ttl_seconds=float(os.getenv('ENHANCE_CACHE_TTL', 24 * 3600)),
+            db_path=os.getenv('ENHANCE_CACHE_DB') or None
+        )
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+        Hash arbitrary JSON-serializable parts into a cache key
+
+        Args:
+            parts: Values that together determine the cached result
+
+        Returns:
+            Hex SHA-256 digest
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                encoded = part.encode('utf-8')
+            else:
+                encoded = json.dumps(part, sort_keys=True, default=str).encode('utf-8')
+            # Length prefix keeps ('ab', 'c') and ('a', 'bc') apart
+            digest.update(len(encoded).to_bytes(8, 'big'))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        """SQLite connections can't be shared between threads; keep one per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _memory_get(self, entry_key) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[entry_key]
+                self._size -= len(value)
+                return None
+            self._entries.move_to_end(entry_key)
+            return value
+
+    def _memory_set(self, entry_key, value: bytes, expires_at: float):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(entry_key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[entry_key] = (value, expires_at)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        """
+        Look up a cached value
+
+        Args:
+            namespace: Result kind ('enhanced', 'document', ...)
+            key: Key from make_key
+
+        Returns:
+            Cached bytes, or None on a miss
+        """
+        entry_key = (namespace, key)
+        value = self._memory_get(entry_key)
+        if value is not None:
+            self._count('memory_hits')
+            return value
+
+        if self.db_path:
+            try:
+                row = self._connection().execute(
+                    "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                    (namespace, key)
+                ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Result cache read error: {str(e)}")
+                row = None
+            if row is not None and row[1] >= time.time():
+                value = bytes(row[0])
+                self._memory_set(entry_key, value, row[1])
+                self._count('disk_hits')
+                return value
+
+        self._count('misses')
+        return None
+
+    def set(self, namespace: str, key: str, value: bytes):
+        """
+        Store a value in every enabled tier
+
+        Args:
+            namespace: Result kind ('enhanced', 'document', ...)
+            key: Key from make_key
+            value: Bytes to cache
+        """
+        expires_at = time.time() + self.ttl_seconds
+        self._memory_set((namespace, key), value, expires_at)
+        self._count('sets')
+
+        if self.db_path:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (namespace, key, sqlite3.Binary(value), expires_at)
+                )
+                self._writes += 1
+                if self._writes % self.PURGE_INTERVAL == 0:
+                    conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+            except sqlite3.Error as e:
+                # The cache must never fail a request
+                print(f"Result cache write error: {str(e)}")
+
+    def get_text(self, namespace: str, key: str) -> Optional[str]:
+        """Look up a cached string"""
+        value = self.get(namespace, key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set_text(self, namespace: str, key: str, value: str):
+        """Store a string"""
+        self.set(namespace, key, value.encode('utf-8'))
+
+    def get_stats(self) -> dict:
+        """Hit/miss counters plus current in-process tier size"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self._entries)
+            stats['memory_bytes'] = self._size
+        return stats
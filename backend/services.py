@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+from metrics import Metrics
+
+
+class MissingConfiguration(RuntimeError):
+    """A service was needed whose required setting is not set"""
+    status_code = 503
+
+
+class Services:
+    """
+    The application's components, each built the first time it is used
+
+    Nothing heavy happens at import: the Gemini SDK (grpc, protobuf),
+    python-docx and PyPDF2 are only imported when a request needs them, so a
+    worker that only serves /health never loads them, and a missing
+    GEMINI_API_KEY only fails the endpoints that call Gemini.
+
+    warm_up does the imports ahead of time. Under gunicorn it runs once in
+    the master (see gunicorn.conf.py) so forked workers share those pages
+    copy-on-write instead of each importing them again.
+    """
+
+    def __init__(self):
+        # Reentrant: building the pipeline builds the services it uses
+        self._lock = threading.RLock()
+        self._instances: Dict[str, object] = {}
+
+    def _get(self, name: str, build: Callable[[], object]):
+        instance = self._instances.get(name)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(name)
+                if instance is None:
+                    instance = self._instances[name] = build()
+        return instance
+
+    def override(self, **instances):
+        """Use the given objects instead of building them (tests, benchmarks)"""
+        with self._lock:
+            self._instances.update(instances)
+
+    @property
+    def gemini_configured(self) -> bool:
+        """Whether the Gemini client exists or can be built"""
+        return 'gemini_client' in self._instances or bool(os.getenv('GEMINI_API_KEY'))
+
+    @property
+    def metrics(self):
+        return self._get('metrics', Metrics.from_env)
+
+    @property
+    def gemini_client(self):
+        def build():
+            if not os.getenv('GEMINI_API_KEY'):
+                raise MissingConfiguration("GEMINI_API_KEY is not set")
+            from gemini_client import GeminiClient
+            return GeminiClient(api_key=os.getenv('GEMINI_API_KEY'), metrics=self.metrics)
+        return self._get('gemini_client', build)
+
+    @property
+    def latex_processor(self):
+        def build():
+            from latex_processor import LaTeXProcessor
+            return LaTeXProcessor()
+        return self._get('latex_processor', build)
+
+    @property
+    def doc_converter(self):
+        def build():
+            from document_converter import DocumentConverter
+            return DocumentConverter()
+        return self._get('doc_converter', build)
+
+    @property
+    def chunked_enhancer(self):
+        def build():
+            from chunked_enhancer import ChunkedEnhancer
+            # Sections are cached with the results, so a re-upload with a few
+            # edits only sends the edited sections to Gemini
+            section_cache = self.result_cache if os.getenv('ENHANCE_SECTION_CACHE', '1') != '0' else None
+            return ChunkedEnhancer(self.gemini_client, self.latex_processor, section_cache=section_cache)
+        return self._get('chunked_enhancer', build)
+
+    @property
+    def result_cache(self):
+        def build():
+            from result_cache import ResultCache
+            return ResultCache.from_env()
+        return self._get('result_cache', build)
+
+    @property
+    def prompt_planner(self):
+        def build():
+            from prompt_planner import PromptPlanner
+            return PromptPlanner.from_env(
+                self.gemini_client, self.latex_processor, self.chunked_enhancer.chunker, self.result_cache,
+                router=self.gemini_client.router
+            )
+        return self._get('prompt_planner', build)
+
+    @property
+    def pipeline(self):
+        def build():
+            from enhancement_pipeline import EnhancementPipeline
+            return EnhancementPipeline(
+                self.gemini_client, self.latex_processor, self.doc_converter,
+                self.chunked_enhancer, self.result_cache, self.prompt_planner
+            )
+        return self._get('pipeline', build)
+
+    @property
+    def admission(self):
+        def build():
+            from admission import AdmissionController
+            return AdmissionController.from_env(metrics=self.metrics)
+        return self._get('admission', build)
+
+    @property
+    def job_runner(self):
+        def build():
+            from job_queue import JobRunner
+            return JobRunner.from_env()
+        return self._get('job_runner', build)
+
+    @property
+    def batch_signer(self):
+        def build():
+            from batch_signer import BatchSigner
+            return BatchSigner()
+        return self._get('batch_signer', build)
+
+    def warm_up(self) -> float:
+        """
+        Import the heavy modules and load read-only data, without building
+        any service
+
+        Safe to call before forking: it starts no threads, opens no database
+        connections and creates no gRPC channels (none of which survive a
+        fork), it only fills the module and template caches.
+
+        Returns:
+            Seconds taken
+        """
+        started = time.perf_counter()
+
+        import google.generativeai  # noqa: F401 (grpc and protobuf)
+        import PyPDF2  # noqa: F401
+        import batch_signer  # noqa: F401
+        import chunked_enhancer  # noqa: F401
+        import document_converter  # noqa: F401
+        import enhancement_pipeline  # noqa: F401
+        import gemini_client  # noqa: F401
+        import job_queue  # noqa: F401
+        import result_cache  # noqa: F401
+        from docx_renderer import DocxRenderer, default_template
+        from latex_processor import LaTeXProcessor
+
+        # The template bytes are cached; building a document from them also
+        # imports and registers every python-docx element class
+        default_template()
+        DocxRenderer().new_document()
+        LaTeXProcessor()
+
+        return time.perf_counter() - started
@@ -0,0 +1,423 @@
+import base64
+import hashlib
+import io
+import os
+import posixpath
+import re
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape, quoteattr
+
+from docx.image.image import Image
+from docx.shared import Inches
+
+from docx_renderer import DocxRenderer
+from upload_spool import UploadContent, open_stream
+from zip_parts import UnsupportedEntry, compressed_entry, read_local_data, write_raw
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+WP_NS = 'http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing'
+A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+PIC_NS = 'http://schemas.openxmlformats.org/drawingml/2006/picture'
+R_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+IMAGE_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+OFFICE_DOCUMENT_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+# Width of the stamped signature, as add_signature always used
+SIGNATURE_WIDTH = Inches(2.0)
+
+RELATIONSHIP = re.compile(r'<Relationship\b[^>]*>')
+XML_ATTRIBUTE = re.compile(r'([\w:]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+DOC_PR_ID = re.compile(r'<(?:\w+:)?docPr\b[^>]*?\bid\s*=\s*["\'](\d+)["\']')
+RELATIONSHIP_ID = re.compile(r'^rId(\d+)$')
+
+
+class StampingNotSupported(Exception):
+    """The package is not laid out the way the fast path expects"""
+
+
+@dataclass
+class SignatureImage:
+    """A decoded, validated signature image and its size on the page"""
+    digest: str
+    blob: bytes
+    ext: str
+    content_type: str
+    cx: int
+    cy: int
+
+    @property
+    def part_name(self) -> str:
+        return f"signature_{self.digest[:16]}.{self.ext}"
+
+
+@dataclass
+class _DocumentPrefix:
+    """
+    A main document part split where the signature goes
+
+    The part up to that point is compressed once; compressor holds the
+    deflate state after it, so each signature only compresses its own
+    paragraphs and the short tail of the body.
+    """
+    compressed_head: bytes
+    compressor: object
+    crc: int
+    size: int
+    tail: bytes
+    shape_id: int
+
+
+@dataclass
+class _PatchedParts:
+    """Compressed replacement entries for one template and signature"""
+    entries: Dict[str, Tuple[zipfile.ZipInfo, bytes]]
+    added: List[Tuple[zipfile.ZipInfo, bytes]]
+
+
+def _attributes(tag: str) -> Dict[str, str]:
+    return {name: a if a is not None else b for name, a, b in XML_ATTRIBUTE.findall(tag)}
+
+
+class SignatureStamper:
+    """
+    Adds a signature image to DOCX files by patching the zip package
+
+    Only the main document part, its relationships, [Content_Types].xml (when
+    the image type is new to it) and the image itself are written; every
+    other entry is copied across still compressed. Decoded signatures are
+    cached by content hash, and the patched parts of a template by the hash of
+    its compressed parts, so signing many copies of one template with one
+    signature costs little more than copying the file. For one template with
+    many signers, the deflate state of the document up to the signature is
+    kept, so only the new paragraphs are compressed per signer.
+
+    The markup matches what python-docx's add_paragraph / add_picture produce.
+    """
+
+    def __init__(self, image_cache_size: int = 32, template_cache_size: int = 64):
+        """
+        Initialize stamper
+
+        Args:
+            image_cache_size: Decoded signature images kept
+            template_cache_size: Patched template parts kept (0 disables it)
+        """
+        self.image_cache_size = image_cache_size
+        self.template_cache_size = template_cache_size
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        self._templates = OrderedDict()
+        self._documents = OrderedDict()
+        self._renderer = DocxRenderer()
+        self.stats = {
+            'image_hits': 0,
+            'image_misses': 0,
+            'template_hits': 0,
+            'template_misses': 0,
+            'document_hits': 0,
+            'document_misses': 0,
+        }
+
+    @classmethod
+    def from_env(cls) -> 'SignatureStamper':
+        """Build a stamper from SIGNATURE_IMAGE_CACHE_SIZE / SIGNATURE_TEMPLATE_CACHE_SIZE"""
+        return cls(
+            image_cache_size=int(os.getenv('SIGNATURE_IMAGE_CACHE_SIZE', 32)),
+            template_cache_size=int(os.getenv('SIGNATURE_TEMPLATE_CACHE_SIZE', 64))
+        )
+
+    def _cache_get(self, cache: OrderedDict, key, stat: str):
+        with self._lock:
+            value = cache.get(key)
+            if value is None:
+                self.stats[f'{stat}_misses'] += 1
+                return None
+            cache.move_to_end(key)
+            self.stats[f'{stat}_hits'] += 1
+            return value
+
+    def _cache_set(self, cache: OrderedDict, key, value, limit: int):
+        if limit <= 0:
+            return
+        with self._lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > limit:
+                cache.popitem(last=False)
+
+    def load_image(self, signature_data: str) -> SignatureImage:
+        """
+        Decode and validate a base64 signature (optionally a data: URL)
+
+        Raises:
+            ValueError: If the data is not a supported image
+        """
+        if ',' in signature_data:
+            signature_data = signature_data.split(',')[1]
+        blob = base64.b64decode(signature_data)
+        digest = hashlib.sha256(blob).hexdigest()
+
+        image = self._cache_get(self._images, digest, 'image')
+        if image is not None:
+            return image
+
+        try:
+            parsed = Image.from_blob(blob)
+        except Exception as e:
+            raise ValueError(f"Unsupported signature image: {str(e)}")
+        if not parsed.width or not parsed.height:
+            raise ValueError("Signature image has no size")
+
+        # Scale to the signature width keeping the aspect ratio, as add_picture does
+        image = SignatureImage(
+            digest=digest,
+            blob=blob,
+            ext=parsed.ext,
+            content_type=parsed.content_type,
+            cx=int(SIGNATURE_WIDTH),
+            cy=int(parsed.height * SIGNATURE_WIDTH / parsed.width)
+        )
+        self._cache_set(self._images, digest, image, self.image_cache_size)
+        return image
+
+    @staticmethod
+    def _alignment(position: str) -> str:
+        if 'right' in position:
+            return 'right'
+        if 'center' in position:
+            return 'center'
+        return 'left'
+
+    def signature_xml(self, image: SignatureImage, rel_id: str, shape_id: int, position: str, signer_name: Optional[str]) -> str:
+        """Paragraphs added to the end of the body"""
+        jc = f'<w:pPr><w:jc w:val="{self._alignment(position)}"/></w:pPr>'
+        name = escape(image.part_name)
+        drawing = (
+            f'<w:drawing><wp:inline xmlns:wp="{WP_NS}" distT="0" distB="0" distL="0" distR="0">'
+            f'<wp:extent cx="{image.cx}" cy="{image.cy}"/>'
+            f'<wp:docPr id="{shape_id}" name="Picture {shape_id}"/>'
+            f'<wp:cNvGraphicFramePr><a:graphicFrameLocks xmlns:a="{A_NS}" noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+            f'<a:graphic xmlns:a="{A_NS}"><a:graphicData uri="{PIC_NS}"><pic:pic xmlns:pic="{PIC_NS}">'
+            f'<pic:nvPicPr><pic:cNvPr id="0" name="{name}"/><pic:cNvPicPr/></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip xmlns:r="{R_NS}" r:embed="{rel_id}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{image.cx}" cy="{image.cy}"/></a:xfrm>'
+            f'<a:prstGeom prst="rect"/></pic:spPr>'
+            f'</pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing>'
+        )
+        parts = ['<w:p/>', '<w:p/>', f'<w:p>{jc}<w:r>{drawing}</w:r></w:p>']
+        if signer_name:
+            parts.append(f'<w:p>{jc}{self._renderer.run_xml(signer_name)}</w:p>')
+        return ''.join(parts)
+
+    @staticmethod
+    def _insertion_point(document_xml: str) -> int:
+        """Index of the body's sectPr, or of the end of the body"""
+        root = re.search(r'<w:document\b[^>]*>', document_xml)
+        if root is None or f'xmlns:w="{W_NS}"' not in root.group(0):
+            raise StampingNotSupported("Main document does not use the w: prefix")
+
+        body_end = document_xml.rfind('</w:body>')
+        if body_end < 0:
+            raise StampingNotSupported("Main document has no body")
+
+        index = body_end
+        sect_start = document_xml.rfind('<w:sectPr', 0, body_end)
+        if sect_start >= 0:
+            tail = document_xml[sect_start:body_end].rstrip()
+            # Only the body's own sectPr; one inside the last paragraph's pPr
+            # is followed by the paragraph's closing tags
+            if re.fullmatch(r'<w:sectPr\b[^>]*/>', tail) or (
+                tail.endswith('</w:sectPr>') and tail.count('<w:sectPr') == 1
+                and '</w:p>' not in tail
+            ):
+                index = sect_start
+        return index
+
+    def _document_prefix(self, archive: zipfile.ZipFile, document_name: str, key: str) -> _DocumentPrefix:
+        """The main document split at the insertion point, cached by its hash"""
+        prefix = self._cache_get(self._documents, key, 'document')
+        if prefix is not None:
+            return prefix
+
+        document_xml = archive.read(document_name).decode('utf-8')
+        index = self._insertion_point(document_xml)
+        head = document_xml[:index].encode('utf-8')
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        prefix = _DocumentPrefix(
+            compressed_head=compressor.compress(head),
+            compressor=compressor,
+            crc=zlib.crc32(head),
+            size=len(head),
+            tail=document_xml[index:].encode('utf-8'),
+            shape_id=max((int(i) for i in DOC_PR_ID.findall(document_xml)), default=0) + 1
+        )
+        self._cache_set(self._documents, key, prefix, self.template_cache_size)
+        return prefix
+
+    @staticmethod
+    def _main_document_name(archive: zipfile.ZipFile) -> str:
+        try:
+            package_rels = archive.read('_rels/.rels').decode('utf-8')
+        except KeyError:
+            raise StampingNotSupported("Package has no relationships")
+        for tag in RELATIONSHIP.findall(package_rels):
+            attributes = _attributes(tag)
+            if attributes.get('Type') == OFFICE_DOCUMENT_REL_TYPE:
+                return attributes['Target'].lstrip('/')
+        raise StampingNotSupported("Package has no main document")
+
+    def _patch(
+        self,
+        archive: zipfile.ZipFile,
+        document_name: str,
+        document_key: str,
+        image: SignatureImage,
+        position: str,
+        signer_name: Optional[str]
+    ) -> _PatchedParts:
+        """Build the replacement entries for the document, rels and content types"""
+        rels_name = posixpath.join(posixpath.dirname(document_name), '_rels', posixpath.basename(document_name) + '.rels')
+        media_target = 'media/' + image.part_name
+        media_name = posixpath.join(posixpath.dirname(document_name), media_target)
+        entries = {}
+        added = []
+
+        # Relationship to the image, reused if this signature is already there
+        try:
+            rels_xml = archive.read(rels_name).decode('utf-8')
+        except KeyError:
+            rels_xml = ('<?xml version=\'1.0\' encoding=\'UTF-8\' standalone=\'yes\'?>\n'
+                        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"></Relationships>')
+        rel_id = None
+        highest = 0
+        for tag in RELATIONSHIP.findall(rels_xml):
+            attributes = _attributes(tag)
+            match = RELATIONSHIP_ID.match(attributes.get('Id', ''))
+            if match:
+                highest = max(highest, int(match.group(1)))
+            if attributes.get('Type') == IMAGE_REL_TYPE and attributes.get('Target') == media_target:
+                rel_id = attributes['Id']
+        if rel_id is None:
+            rel_id = f'rId{highest + 1}'
+            relationship = f'<Relationship Id="{rel_id}" Type="{IMAGE_REL_TYPE}" Target={quoteattr(media_target)}/>'
+            end = rels_xml.rfind('</Relationships>')
+            if end < 0:
+                raise StampingNotSupported("Malformed document relationships")
+            rels_xml = rels_xml[:end] + relationship + rels_xml[end:]
+            entries[rels_name] = compressed_entry(rels_name, rels_xml.encode('utf-8'))
+
+        if media_name not in archive.NameToInfo:
+            info = zipfile.ZipInfo(media_name, date_time=(1980, 1, 1, 0, 0, 0))
+            # Images are already compressed; storing them costs nothing to read
+            info.compress_type = zipfile.ZIP_STORED
+            info.CRC = zlib.crc32(image.blob)
+            info.file_size = info.compress_size = len(image.blob)
+            added.append((info, image.blob))
+
+        content_types = archive.read('[Content_Types].xml').decode('utf-8')
+        extension = re.compile(r'<Default\b[^>]*\bExtension\s*=\s*["\']' + re.escape(image.ext) + r'["\']', re.I)
+        if not extension.search(content_types):
+            default = f'<Default Extension="{image.ext}" ContentType="{image.content_type}"/>'
+            end = content_types.rfind('</Types>')
+            if end < 0:
+                raise StampingNotSupported("Malformed content types")
+            content_types = content_types[:end] + default + content_types[end:]
+            entries['[Content_Types].xml'] = compressed_entry('[Content_Types].xml', content_types.encode('utf-8'))
+
+        prefix = self._document_prefix(archive, document_name, document_key)
+        fragment = self.signature_xml(image, rel_id, prefix.shape_id, position, signer_name).encode('utf-8')
+        rest = fragment + prefix.tail
+        with self._lock:
+            compressor = prefix.compressor.copy()
+        compressed = prefix.compressed_head + compressor.compress(rest) + compressor.flush()
+        info = zipfile.ZipInfo(document_name)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.CRC = zlib.crc32(rest, prefix.crc)
+        info.file_size = prefix.size + len(rest)
+        info.compress_size = len(compressed)
+        entries[document_name] = (info, compressed)
+
+        # Keep the original timestamps of replaced entries
+        for name, (info, data) in entries.items():
+            if name in archive.NameToInfo:
+                info.date_time = archive.NameToInfo[name].date_time
+        return _PatchedParts(entries=entries, added=added)
+
+    def stamp(
+        self,
+        file_content: UploadContent,
+        signature_data: str,
+        position: str = 'bottom-right',
+        signer_name: Optional[str] = None
+    ) -> bytes:
+        """
+        Add a signature to a DOCX file
+
+        Args:
+            file_content: DOCX content (bytes or a read-only mmap)
+            signature_data: Base64 encoded signature image
+            position: Position of signature (bottom-right, bottom-center, bottom-left)
+            signer_name: Optional name of signer
+
+        Returns:
+            Signed document bytes
+
+        Raises:
+            ValueError: If the signature is not a supported image
+            StampingNotSupported: If the package cannot be patched in place
+        """
+        image = self.load_image(signature_data)
+
+        try:
+            archive = zipfile.ZipFile(open_stream(file_content))
+        except zipfile.BadZipFile as e:
+            raise ValueError(f"Not a DOCX file: {str(e)}")
+
+        try:
+            with archive:
+                document_name = self._main_document_name(archive)
+                if document_name not in archive.NameToInfo or '[Content_Types].xml' not in archive.NameToInfo:
+                    raise StampingNotSupported("Package is missing required parts")
+
+                # The parts that get patched, hashed still compressed
+                rels_name = posixpath.join(posixpath.dirname(document_name), '_rels', posixpath.basename(document_name) + '.rels')
+                document_info = archive.NameToInfo[document_name]
+                document = hashlib.sha256(f"{document_name}:{document_info.compress_type}:".encode('utf-8'))
+                document.update(read_local_data(file_content, document_info))
+                document_key = document.hexdigest()
+                template = hashlib.sha256(document_key.encode('utf-8'))
+                for name in (rels_name, '[Content_Types].xml'):
+                    info = archive.NameToInfo.get(name)
+                    if info is not None:
+                        template.update(f"{name}:{info.compress_type}:".encode('utf-8'))
+                        template.update(read_local_data(file_content, info))
+                media_present = posixpath.join(posixpath.dirname(document_name), 'media', image.part_name) in archive.NameToInfo
+                key = (template.hexdigest(), image.digest, self._alignment(position), signer_name or '', media_present)
+
+                patched = self._cache_get(self._templates, key, 'template')
+                if patched is None:
+                    patched = self._patch(archive, document_name, document_key, image, position, signer_name)
+                    self._cache_set(self._templates, key, patched, self.template_cache_size)
+
+                output_buffer = io.BytesIO()
+                with zipfile.ZipFile(output_buffer, 'w') as output:
+                    for info in archive.infolist():
+                        replacement = patched.entries.get(info.filename)
+                        if replacement is not None:
+                            write_raw(output, *replacement)
+                        else:
+                            write_raw(output, info, read_local_data(file_content, info))
+                    for info, data in patched.added:
+                        write_raw(output, info, data)
+                    # Rels that did not exist before are new entries too
+                    for name, replacement in patched.entries.items():
+                        if name not in archive.NameToInfo:
+                            write_raw(output, *replacement)
+                return output_buffer.getvalue()
+        except UnsupportedEntry as e:
+            raise StampingNotSupported(str(e))
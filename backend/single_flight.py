@@ -0,0 +1,391 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+class FlightFailed(Exception):
+    """The call an identical request waited on in another process failed"""
+
+    def __init__(self, message: str, retryable: bool = False, status_code: int = 502):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
+
+
+class _Abandoned(Exception):
+    """The leader stopped without an outcome (cancelled); waiters try again"""
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time
+
+    The first caller of a key (the leader) makes the call; callers of the
+    same key that arrive while it runs wait for it and get its result, or its
+    exception. Within a process they wait on a Future. Across the gunicorn
+    workers of a host, a row in a SQLite file says which process leads a key:
+    one waiter per process polls it, and the rest of that process waits on
+    the poller. A leader whose process died, or that runs past the lease, is
+    taken over.
+
+    Finished rows are kept for a short grace period, only for the waiters to
+    read: a call made after the leader finished is made again.
+    """
+
+    # Purge finished rows every N finishes
+    PURGE_INTERVAL = 100
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        lease_seconds: float = 600,
+        poll_interval: float = 0.05,
+        grace_seconds: float = 30,
+        enabled: bool = True,
+        metrics=None
+    ):
+        """
+        Initialize single-flight
+
+        Args:
+            db_path: SQLite file shared by the workers (None coalesces within
+                this process only)
+            lease_seconds: Longest a leader in another process is waited for
+            poll_interval: Seconds between looks at another process's call
+            grace_seconds: How long a finished call's outcome stays readable
+            enabled: False runs every call
+            metrics: Metrics counting coalesced calls (optional)
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.grace_seconds = grace_seconds
+        self.enabled = enabled
+        self.metrics = metrics
+
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Future] = {}
+        self._local = threading.local()
+        self._finishes = 0
+        self.stats = {
+            'leaders': 0,
+            'process_waits': 0,
+            'host_waits': 0,
+            'takeovers': 0,
+        }
+
+        if self.enabled and self.db_path:
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS flights ("
+                " key TEXT PRIMARY KEY,"
+                " owner TEXT NOT NULL,"
+                " pid INTEGER NOT NULL,"
+                " started_at REAL NOT NULL,"
+                " state TEXT NOT NULL,"
+                " value TEXT,"
+                " error TEXT,"
+                " status_code INTEGER,"
+                " retryable INTEGER,"
+                " expires_at REAL)"
+            )
+
+    @classmethod
+    def from_env(cls, lease_seconds: float = 600, metrics=None) -> 'SingleFlight':
+        """Build single-flight from GEMINI_SINGLE_FLIGHT / GEMINI_FLIGHT_DB"""
+        return cls(
+            db_path=os.getenv('GEMINI_FLIGHT_DB') or os.path.join(tempfile.gettempdir(), 'verolabz_flight.db'),
+            lease_seconds=lease_seconds,
+            enabled=os.getenv('GEMINI_SINGLE_FLIGHT', '1') != '0',
+            metrics=metrics
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """SQLite connections can't be shared between threads; keep one per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+        if self.metrics is not None and name.endswith('_waits'):
+            self.metrics.inc('gemini_coalesced_total', leader=name[:-len('_waits')])
+
+    # -- within the process ------------------------------------------------
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        """The key's flight in this process, and whether the caller leads it"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Future()
+            # A running Future can't be cancelled by a waiter that gives up
+            flight.set_running_or_notify_cancel()
+            return flight, True
+
+    def _land(self, key: str, flight: Future, value=None, error: Optional[BaseException] = None):
+        """Hand the outcome to this process's waiters; later callers start a new flight"""
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is None:
+            flight.set_result(value)
+        else:
+            flight.set_exception(error)
+
+    # -- across processes --------------------------------------------------
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # Exists but belongs to someone else
+            return True
+        return True
+
+    def _claim(self, key: str, waited_owner: Optional[str] = None) -> Tuple[str, tuple]:
+        """
+        Lead the key on this host, or find out who does
+
+        Args:
+            key: Flight key
+            waited_owner: Owner of the flight the caller has been waiting on
+
+        Returns:
+            ('lead', (owner,)) when the caller now leads; ('wait', (owner,))
+            while another live process leads; ('done', (value,)) or
+            ('failed', (error, status_code, retryable)) once the waited-on
+            flight finished
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT owner, pid, started_at, state, value, error, status_code, retryable"
+                " FROM flights WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                owner, pid, started_at, state, value, error, status_code, retryable = row
+                if owner == waited_owner and state == 'done':
+                    conn.execute("COMMIT")
+                    return 'done', (value,)
+                if owner == waited_owner and state == 'failed':
+                    conn.execute("COMMIT")
+                    return 'failed', (error, status_code, bool(retryable))
+                if state == 'running' and now - started_at < self.lease_seconds and self._alive(pid):
+                    conn.execute("COMMIT")
+                    return 'wait', (owner,)
+                if state == 'running':
+                    self._count('takeovers')
+
+            owner = uuid.uuid4().hex
+            conn.execute(
+                "INSERT OR REPLACE INTO flights (key, owner, pid, started_at, state)"
+                " VALUES (?, ?, ?, ?, 'running')",
+                (key, owner, os.getpid(), now)
+            )
+            conn.execute("COMMIT")
+            return 'lead', (owner,)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _state(self, key: str) -> Optional[Tuple[str, str]]:
+        """(owner, state) of the key's row, without taking the write lock"""
+        return self._connection().execute(
+            "SELECT owner, state FROM flights WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _finish(self, key: str, owner: str, value: Optional[str] = None, error: Optional[BaseException] = None):
+        """Record the leader's outcome for the waiters of other processes"""
+        try:
+            self._write_outcome(key, owner, value, error)
+        except sqlite3.Error as e:
+            # Waiters find the row stale at the end of the lease and call themselves
+            print(f"Single-flight write error: {str(e)}")
+
+    def _write_outcome(self, key: str, owner: str, value: Optional[str], error: Optional[BaseException]):
+        conn = self._connection()
+        if error is None:
+            conn.execute(
+                "UPDATE flights SET state = 'done', value = ?, expires_at = ? WHERE key = ? AND owner = ?",
+                (value, time.time() + self.grace_seconds, key, owner)
+            )
+        else:
+            conn.execute(
+                "UPDATE flights SET state = 'failed', error = ?, status_code = ?, retryable = ?, expires_at = ?"
+                " WHERE key = ? AND owner = ?",
+                (str(error), getattr(error, 'status_code', 502), int(getattr(error, 'retryable', False)),
+                 time.time() + self.grace_seconds, key, owner)
+            )
+        self._finishes += 1
+        if self._finishes % self.PURGE_INTERVAL == 0:
+            conn.execute("DELETE FROM flights WHERE state != 'running' AND expires_at < ?", (time.time(),))
+
+    def _release(self, key: str, owner: str):
+        """Give up the key without an outcome, so a waiter takes over at once"""
+        try:
+            self._connection().execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, owner))
+        except sqlite3.Error as e:
+            print(f"Single-flight write error: {str(e)}")
+
+    def _host_step(self, key: str, waited_owner: Optional[str]) -> Tuple[str, tuple]:
+        """
+        One look at the host-wide flight: a cheap read unless something changed
+
+        A SQLite error makes the caller lead without a row: coalescing must
+        never fail a call.
+        """
+        try:
+            if waited_owner is not None:
+                row = self._state(key)
+                if row is not None and row == (waited_owner, 'running'):
+                    return 'wait', (waited_owner,)
+            return self._claim(key, waited_owner)
+        except sqlite3.Error as e:
+            print(f"Single-flight read error: {str(e)}")
+            return 'lead', (None,)
+
+    @staticmethod
+    def _outcome(state: str, details: tuple):
+        if state == 'done':
+            return details[0]
+        raise FlightFailed(*details)
+
+    # -- calls -------------------------------------------------------------
+
+    def do(self, key: str, fn: Callable[[], str]) -> str:
+        """
+        Call fn, or wait for an identical call already in flight
+
+        Args:
+            key: Identity of the call (e.g. a hash of the normalized prompt)
+            fn: The call; its result must be a string
+
+        Returns:
+            The result of fn, from whichever caller made the call
+
+        Raises:
+            The leader's exception (FlightFailed if it was in another process)
+        """
+        if not self.enabled:
+            return fn()
+
+        while True:
+            flight, leader = self._join(key)
+            if not leader:
+                self._count('process_waits')
+                try:
+                    return flight.result()
+                except _Abandoned:
+                    continue
+            return self._lead(key, flight, fn)
+
+    def _lead(self, key: str, flight: Future, fn: Callable[[], str]) -> str:
+        owner = None
+        try:
+            if self.db_path:
+                state, details = self._host_step(key, None)
+                while state == 'wait':
+                    time.sleep(self.poll_interval)
+                    state, details = self._host_step(key, details[0])
+                if state != 'lead':
+                    self._count('host_waits')
+                    value = self._outcome(state, details)
+                    self._land(key, flight, value)
+                    return value
+                owner = details[0]
+
+            self._count('leaders')
+            value = fn()
+        except Exception as e:
+            if owner is not None:
+                self._finish(key, owner, error=e)
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            if owner is not None:
+                self._release(key, owner)
+            self._land(key, flight, error=_Abandoned())
+            raise
+
+        if owner is not None:
+            self._finish(key, owner, value=value)
+        self._land(key, flight, value)
+        return value
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[str]]) -> str:
+        """
+        do for coroutines: waiting (on this process's leader or another
+        process's) happens on the event loop, and the SQLite work on the
+        loop's default executor
+
+        Args:
+            key: Identity of the call
+            fn: Returns an awaitable of the call's result (a string)
+
+        Returns:
+            The result of the call, from whichever caller made it
+        """
+        if not self.enabled:
+            return await fn()
+
+        while True:
+            flight, leader = self._join(key)
+            if not leader:
+                self._count('process_waits')
+                try:
+                    # Shielded: a waiter that is cancelled leaves the flight alone
+                    return await asyncio.shield(asyncio.wrap_future(flight))
+                except _Abandoned:
+                    continue
+            return await self._lead_async(key, flight, fn)
+
+    async def _lead_async(self, key: str, flight: Future, fn: Callable[[], Awaitable[str]]) -> str:
+        loop = asyncio.get_running_loop()
+        owner = None
+        try:
+            if self.db_path:
+                state, details = await loop.run_in_executor(None, self._host_step, key, None)
+                while state == 'wait':
+                    await asyncio.sleep(self.poll_interval)
+                    state, details = await loop.run_in_executor(None, self._host_step, key, details[0])
+                if state != 'lead':
+                    self._count('host_waits')
+                    value = self._outcome(state, details)
+                    self._land(key, flight, value)
+                    return value
+                owner = details[0]
+
+            self._count('leaders')
+            value = await fn()
+        except Exception as e:
+            if owner is not None:
+                await loop.run_in_executor(None, lambda: self._finish(key, owner, error=e))
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            if owner is not None:
+                # Not awaited: this coroutine is being cancelled
+                loop.run_in_executor(None, self._release, key, owner)
+            self._land(key, flight, error=_Abandoned())
+            raise
+
+        if owner is not None:
+            await loop.run_in_executor(None, lambda: self._finish(key, owner, value=value))
+        self._land(key, flight, value)
+        return value
@@ -56,6 +56,62 @@ def test_latex_detection():
         print(f"❌ LaTeX detection failed: {str(e)}")
         return False
 
+def test_latex_scan():
+    """Test single-pass LaTeX normalization, equation extraction and block spans"""
+    print("\nTesting LaTeX scanning...")
+    try:
+        import asyncio
+        from document_blocks import parse_blocks
+        from enhancement_pipeline import EnhancementPipeline, EnhancementRequest
+        from latex_processor import LaTeXProcessor
+        from result_cache import ResultCache
+        processor = LaTeXProcessor()
+
+        content = "Since$E=mc^2$holds, it costs \\$5.\nSee \\(a+b\\) and\n\\[\n  x = 1\n\\]\nafter$$y$$end"
+        latex = processor.normalize(content)
+        blocks = parse_blocks(latex.text, include_latex=True, spans=latex.spans)
+
+        # Streamed a character at a time, display equations spanning lines
+        # come out as they do from the whole text
+        class CharStream:
+            def enhance_stream(self, **kwargs):
+                return iter(self.text)
+
+            async def enhance_stream_async(self, **kwargs):
+                for char in self.text:
+                    yield char
+
+        streamer = CharStream()
+        pipeline = EnhancementPipeline(None, processor, None, streamer, ResultCache())
+        streamed = []
+        for i, text in enumerate(["Intro\n$$\na+b\n$$\nEnd\n", content, "Cost $5\n$$ open\nand $x$ on\n"]):
+            streamer.text = text
+            prepared = EnhancementRequest(text, '.txt', '', 'auto', True, f"stream-{i}", '.docx')
+            streamed.append(("".join(pipeline.stream(prepared)), processor.process_latex_content(text)))
+
+            async def collect():
+                return "".join([piece async for piece in pipeline.stream_async(prepared)])
+            prepared.cache_key += "-async"
+            streamed.append((asyncio.run(collect()), processor.process_latex_content(text)))
+
+        if (latex.text == "Since $E=mc^2$ holds, it costs \\$5.\nSee $a+b$ and\n$$x = 1$$\nafter\n$$y$$\nend"
+                and latex.equations == [("inline", "E=mc^2"), ("inline", "a+b"), ("display", "x = 1"), ("display", "y")]
+                and processor.process_latex_content(latex.text) == latex.text
+                and [block.kind for block in blocks] == ["math_paragraph", "math_paragraph", "display_math",
+                                                         "paragraph", "display_math", "paragraph"]
+                and blocks[0].segments[-1] == (False, " holds, it costs $5.")
+                and [block.kind for block in parse_blocks("Price: $5 only", include_latex=True)] == ["paragraph"]
+                and streamed[0][0] == "Intro\n$$a+b$$\nEnd\n"
+                and all(stream == whole for stream, whole in streamed)):
+            print("✅ LaTeX scanning working!")
+            return True
+        else:
+            print("❌ LaTeX scanning returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ LaTeX scanning failed: {str(e)}")
+        return False
+
 def test_gemini_client():
     """Test Gemini client initialization"""
     print("\nTesting Gemini client...")
@@ -74,6 +130,1087 @@ def test_gemini_client():
         print(f"❌ Gemini client failed: {str(e)}")
         return False
 
+def test_chunked_enhancement():
+    """Test that long documents are chunked and stitched back in order"""
+    print("\nTesting chunked enhancement...")
+    try:
+        from chunked_enhancer import ChunkedEnhancer, DocumentChunker
+        from latex_processor import LaTeXProcessor
+
+        class EchoClient:
+            """Stub client that returns the prompt's content section unchanged"""
+            def enhance_content(self, prompt):
+                return prompt.split("=" * 60)[1].strip("\n")
+
+            def stream_content(self, prompt):
+                text = self.enhance_content(prompt)
+                for i in range(0, len(text), 50):
+                    yield text[i:i + 50]
+
+        sections = [f"SECTION {i}\n\n" + f"Paragraph {i} text. " * 40 for i in range(12)]
+        document = "\n\n".join(sections)
+
+        chunker = DocumentChunker(max_chunk_chars=2000, context_chars=100)
+        chunks = chunker.chunk(document)
+        enhancer = ChunkedEnhancer(EchoClient(), LaTeXProcessor(), chunker=chunker, max_workers=3)
+        result = enhancer.enhance(document)
+        streamed = "".join(enhancer.enhance_stream(document))
+
+        if (len(chunks) > 1 and result == document and streamed == document
+                and chunks[1].context_before):
+            print(f"✅ Chunked enhancement working! ({len(chunks)} chunks)")
+            return True
+        else:
+            print("❌ Chunked output does not match the original order")
+            return False
+    except Exception as e:
+        print(f"❌ Chunked enhancement failed: {str(e)}")
+        return False
+
+def test_gemini_retries():
+    """Test retries, backoff and the shared rate limit against a stub model"""
+    print("\nTesting Gemini retries and rate limiting...")
+    try:
+        import tempfile
+        from types import SimpleNamespace
+        from google.api_core import exceptions as google_exceptions
+        from gemini_client import GeminiClient, GeminiError
+        from rate_limiter import RateLimiter
+
+        class FlakyModel:
+            def __init__(self, failures):
+                self.failures = list(failures)
+                self.calls = 0
+
+            def generate_content(self, prompt, generation_config=None, stream=False):
+                self.calls += 1
+                if self.failures:
+                    raise self.failures.pop(0)
+                return SimpleNamespace(text="ok: " + prompt)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "rate.db")
+            delays = []
+
+            flaky = FlakyModel([google_exceptions.ResourceExhausted("quota"),
+                                google_exceptions.ServiceUnavailable("busy")])
+            client = GeminiClient(model=flaky, rate_limiter=RateLimiter(db_path=db_path),
+                                  sleep=delays.append)
+            retried = client.enhance_content("hello")
+
+            broken = FlakyModel([ValueError("bad request")])
+            client = GeminiClient(model=broken, rate_limiter=RateLimiter(db_path=db_path),
+                                  sleep=delays.append)
+            try:
+                client.enhance_content("hello")
+                permanent = None
+            except GeminiError as e:
+                permanent = e
+
+            # Two workers drawing from one budget of 2 requests per minute
+            first = RateLimiter(requests_per_minute=2, db_path=db_path)
+            first.reset()
+            second = RateLimiter(requests_per_minute=2, db_path=db_path)
+            taken = [first.try_acquire(), second.try_acquire(), second.try_acquire()]
+
+        if (retried == "ok: hello" and flaky.calls == 3 and len(delays) == 2
+                and permanent is not None and not permanent.retryable and broken.calls == 1
+                and taken[:2] == [0.0, 0.0] and taken[2] > 0):
+            print("✅ Gemini retries and rate limiting working!")
+            return True
+        else:
+            print("❌ Gemini retries returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Gemini retries failed: {str(e)}")
+        return False
+
+def test_single_flight():
+    """Test that identical calls in flight at once are made once, across threads and processes"""
+    print("\nTesting single-flight coalescing...")
+    try:
+        import tempfile
+        import threading
+        import time
+        from types import SimpleNamespace
+        from gemini_client import GeminiClient, GeminiError
+        from rate_limiter import RateLimiter
+        from single_flight import SingleFlight
+
+        class SlowModel:
+            def __init__(self, error=None):
+                self.error = error
+                self.calls = 0
+
+            def generate_content(self, prompt, generation_config=None, stream=False):
+                self.calls += 1
+                time.sleep(0.2)
+                if self.error:
+                    raise self.error
+                return SimpleNamespace(text="ok: " + prompt.strip())
+
+        def burst(client, prompts):
+            results = []
+
+            def call(prompt):
+                try:
+                    results.append(client.enhance_content(prompt))
+                except GeminiError as e:
+                    results.append(e)
+
+            threads = [threading.Thread(target=call, args=(p,)) for p in prompts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "flight.db")
+
+            def client(model, flight):
+                return GeminiClient(model=model, rate_limiter=RateLimiter(requests_per_minute=0),
+                                    max_in_flight=16, single_flight=flight)
+
+            # Eight identical prompts (up to trailing whitespace) and one other
+            model = SlowModel()
+            flight = SingleFlight(db_path=db_path)
+            shared = burst(client(model, flight), ["hello"] * 4 + ["hello  \n"] * 4 + ["other"])
+
+            # The leader's failure reaches every waiter
+            broken = SlowModel(ValueError("bad request"))
+            failed = burst(client(broken, SingleFlight(db_path=db_path)), ["fail"] * 4)
+
+            # Two "workers" with their own SingleFlight on one file: one call
+            host_model = SlowModel()
+            workers = [client(host_model, SingleFlight(db_path=db_path)) for _ in range(2)]
+            results = []
+            threads = [threading.Thread(target=lambda c=c: results.append(c.enhance_content("host")))
+                       for c in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if (model.calls == 2 and shared.count("ok: hello") == 8 and "ok: other" in shared
+                and flight.stats['process_waits'] == 7
+                and broken.calls == 1 and all(isinstance(e, GeminiError) and not e.retryable for e in failed)
+                and host_model.calls == 1 and results == ["ok: host", "ok: host"]):
+            print("✅ Single-flight coalescing working!")
+            return True
+        else:
+            print("❌ Single-flight coalescing returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Single-flight coalescing failed: {str(e)}")
+        return False
+
+def test_model_routing():
+    """Test that documents are routed to a model within the latency budget and slow calls are hedged"""
+    print("\nTesting model routing and hedging...")
+    try:
+        import asyncio
+        import time
+        from types import SimpleNamespace
+        from chunked_enhancer import ChunkedEnhancer, DocumentChunker
+        from enhancement_pipeline import EnhancementPipeline
+        from gemini_client import GeminiClient
+        from latex_processor import LaTeXProcessor
+        from model_router import ModelRouter, Route
+        from prompt_planner import PromptPlanner
+        from rate_limiter import RateLimiter
+        from result_cache import ResultCache
+        from single_flight import SingleFlight
+
+        class StubModel:
+            """Answers after the next of delays (then after default), counting calls"""
+
+            def __init__(self, delays=(), default=0.01):
+                self.delays = list(delays)
+                self.default = default
+                self.calls = 0
+                self.cancelled = 0
+
+            def _delay(self):
+                self.calls += 1
+                return self.delays.pop(0) if self.delays else self.default
+
+            def generate_content(self, prompt, generation_config=None, stream=False):
+                time.sleep(self._delay())
+                text = f"{prompt} (call {self.calls})"
+                response = SimpleNamespace(text=text, parts=[text])
+                return [response] if stream else response
+
+            async def generate_content_async(self, prompt, generation_config=None, stream=False):
+                call = self.calls + 1
+                try:
+                    await asyncio.sleep(self._delay())
+                except asyncio.CancelledError:
+                    self.cancelled += 1
+                    raise
+                return SimpleNamespace(text=f"{prompt} (call {call})")
+
+        def router():
+            return ModelRouter([Route('quality', 'pro', 8192), Route('fast', 'flash', 4096)],
+                               fast_max_input_tokens=1000, latency_budget=1.0)
+
+        # Short plain documents go to the fast model; math, academic or long ones don't
+        routes = router()
+        choices = [routes.choose(200, 512).name, routes.choose(200, 512, include_latex=True).name,
+                   routes.choose(200, 512, doc_type='academic').name, routes.choose(5000, 4096).name]
+        # Once the quality model is measured over budget, the fast one takes its documents
+        for _ in range(10):
+            routes.tracker.record('quality', 5.0, 1000)
+        over_budget = routes.choose(200, 1000, include_latex=True).name
+
+        planner = PromptPlanner(SimpleNamespace(model_name="stub", generation_config={"max_output_tokens": 8192}),
+                                LaTeXProcessor(), DocumentChunker(), router=router())
+        plan = planner.plan("A short cover letter. " * 30)
+
+        def client(models):
+            return GeminiClient(models=models, router=router(), rate_limiter=RateLimiter(requests_per_minute=0),
+                                single_flight=SingleFlight(enabled=False), max_in_flight=4)
+
+        def measured(gemini):
+            # Calls of 0.05 s per 256 tokens: hedged after about 0.05 s
+            for _ in range(10):
+                gemini.router.tracker.record('fast', 0.05, 256)
+            return gemini
+
+        # The first attempt stalls; the hedge sent at its p95 answers first
+        stalled = StubModel([1.0])
+        sync_client = measured(client({'quality': StubModel(), 'fast': stalled}))
+        started = time.perf_counter()
+        hedged = sync_client.enhance_content("letter", max_output_tokens=256, route='fast')
+        hedged_seconds = time.perf_counter() - started
+
+        async_stalled = StubModel([1.0])
+        async_client = measured(client({'quality': StubModel(), 'fast': async_stalled}))
+        started = time.perf_counter()
+        async_hedged = asyncio.run(async_client.enhance_content_async("letter", max_output_tokens=256, route='fast'))
+        async_seconds = time.perf_counter() - started
+
+        # Routes without latency samples are never hedged
+        quality = StubModel([0.2])
+        unmeasured = client({'quality': quality, 'fast': StubModel()}).enhance_content("report")
+
+        # A result cached from the fast model isn't served to a request routed to the quality one
+        cache = ResultCache()
+        cached_quality, cached_fast = StubModel(), StubModel()
+        gemini = client({'quality': cached_quality, 'fast': cached_fast})
+        enhancer = ChunkedEnhancer(gemini, LaTeXProcessor(), section_cache=cache)
+        extractor = SimpleNamespace(extract=lambda content, ext: (content.decode(), None))
+        slow_fast = router()
+        for _ in range(10):
+            slow_fast.tracker.record('fast', 5.0, 1000)
+        routed = []
+        for planner_router in (router(), slow_fast, router()):
+            pipeline = EnhancementPipeline(gemini, LaTeXProcessor(), extractor, enhancer, cache,
+                                           PromptPlanner(gemini, LaTeXProcessor(), DocumentChunker(), router=planner_router))
+            prepared = pipeline.prepare(b"A short cover letter. " * 30, '.txt')
+            routed.append((prepared.plan.route, "".join(pipeline.stream(prepared))))
+
+        if (choices == ['fast', 'quality', 'quality', 'quality'] and over_budget == 'fast'
+                and plan.route == 'fast' and plan.max_output_tokens <= 4096
+                and hedged == "letter (call 2)" and stalled.calls == 2 and hedged_seconds < 0.5
+                and async_hedged == "letter (call 2)" and async_stalled.cancelled == 1 and async_seconds < 0.5
+                and unmeasured == "report (call 1)" and quality.calls == 1
+                and [route for route, _ in routed] == ['fast', 'quality', 'fast']
+                and routed[2][1] == routed[0][1]
+                and cached_fast.calls == 1 and cached_quality.calls == 1
+                and sync_client.router.tracker.get_stats()['fast']['calls'] == 11):
+            print("✅ Model routing and hedging working!")
+            return True
+        else:
+            print("❌ Model routing or hedging returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Model routing and hedging failed: {str(e)}")
+        return False
+
+def test_admission():
+    """Test that /enhance requests are admitted against a cost budget, fairly across clients"""
+    print("\nTesting admission control...")
+    try:
+        import io
+        import threading
+        import time
+        from admission import AdmissionController, AdmissionRejected
+        from app import create_app
+        from services import Services
+
+        def rejection(controller, client, cost):
+            try:
+                controller.admit(client, cost)
+            except AdmissionRejected as e:
+                return e.status_code, e.retry_after
+            return None
+
+        granted = []
+
+        def queue(controller, client, cost):
+            queued = controller.stats['queued']
+            thread = threading.Thread(target=lambda: granted.append((client, controller.admit(client, cost))))
+            thread.start()
+            while controller.stats['queued'] == queued:
+                time.sleep(0.01)
+            return thread
+
+        # Costs are estimated from the upload, then from the extracted text
+        estimates = (AdmissionController.estimate(4000, '.txt'),
+                     AdmissionController.estimate(text_chars=4000, has_math=True))
+
+        # Drains its 10000-token budget in 30 s until work has completed
+        controller = AdmissionController(budget=10000, max_wait=10)
+        first = controller.admit('a', 2000)
+        big = controller.admit('z', 7500)
+        threads = [queue(controller, 'a', 1500), queue(controller, 'a', 1000), queue(controller, 'b', 500)]
+        # Over its share of the budget, and the server as a whole too busy
+        over_share = rejection(controller, 'a', 1000)
+        too_busy = rejection(controller, 'c', 5000)
+
+        # Freed budget goes to the clients' queues in turn: b before a's second
+        first.release()
+        first.release()
+        time.sleep(0.1)
+        turns = sorted((client, ticket.cost) for client, ticket in granted)
+        big.release()
+        for thread in threads:
+            thread.join()
+        for _, ticket in granted:
+            ticket.release()
+        idle = controller.in_flight
+
+        # The endpoint turns requests away before reading the document
+        services = Services()
+        busy = AdmissionController(budget=2000, max_wait=0.5)
+        services.override(gemini_client=object(), admission=busy)
+        held = [busy.admit('other', 1000), busy.admit('x', 900)]
+        client = create_app(services).test_client()
+        shed = client.post('/enhance', data={'file': (io.BytesIO(b"some text"), 'doc.txt')})
+        unfair = client.post('/enhance', data={'file': (io.BytesIO(b"some text"), 'doc.txt')},
+                             headers={'X-Client-ID': 'other'})
+        for ticket in held:
+            ticket.release()
+
+        if (estimates == (3000, 4000)
+                and over_share[0] == 429 and too_busy == (503, 20)
+                and turns == [('a', 1500), ('b', 500)] and len(granted) == 3 and idle == 0
+                and shed.status_code == 503 and int(shed.headers['Retry-After']) == 14
+                and unfair.status_code == 429 and 'Retry-After' in unfair.headers
+                and 'pipeline' not in services._instances):
+            print("✅ Admission control working!")
+            return True
+        else:
+            print("❌ Admission control returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Admission control failed: {str(e)}")
+        return False
+
+def test_incremental_enhancement():
+    """Test that a re-upload only sends its changed sections to Gemini"""
+    print("\nTesting incremental re-enhancement...")
+    try:
+        from chunked_enhancer import ChunkedEnhancer, DocumentChunker
+        from latex_processor import LaTeXProcessor
+        from metrics import RequestTrace
+        from result_cache import ResultCache
+
+        class EchoClient:
+            """Stub client returning the prompt's content, optionally without markers"""
+            model_name = "stub"
+            generation_config = {}
+
+            def __init__(self, keep_markers=True):
+                self.keep_markers = keep_markers
+                self.prompts = []
+
+            def enhance_content(self, prompt):
+                self.prompts.append(prompt)
+                content = prompt.split("=" * 60)[1].strip("\n")
+                if not self.keep_markers:
+                    content = "\n".join(l for l in content.split("\n") if not l.startswith("[[§"))
+                return content
+
+        sections = [f"SECTION {i}\n\n" + f"Paragraph {i} text. " * 20 for i in range(8)]
+        document = "\n\n".join(sections)
+        sections[5] = sections[5].replace("Paragraph 5", "Revised paragraph 5")
+        revised = "\n\n".join(sections)
+
+        chunker = DocumentChunker(max_chunk_chars=2000, context_chars=100, section_chars=1000)
+        client = EchoClient()
+        enhancer = ChunkedEnhancer(client, LaTeXProcessor(), chunker=chunker, section_cache=ResultCache())
+        first = enhancer.enhance(document)
+        calls_first = len(client.prompts)
+        trace = RequestTrace()
+        second = enhancer.enhance(revised, trace=trace)
+        resent = client.prompts[calls_first:]
+
+        # Markers lost by the model: the output is still clean, nothing is stored
+        lossy = EchoClient(keep_markers=False)
+        fallback_enhancer = ChunkedEnhancer(lossy, LaTeXProcessor(), chunker=chunker, section_cache=ResultCache())
+        fallback = fallback_enhancer.enhance(document)
+        fallback_enhancer.enhance(document)
+
+        if (first == document and second == revised
+                and len(resent) == 1 and "Revised paragraph 5" in resent[0] and "[[§" not in resent[0]
+                and trace.fields['sections'] == 8 and trace.fields['sections_reused'] == 7
+                and "[[§" not in fallback and len(lossy.prompts) == 2 * calls_first):
+            print("✅ Incremental re-enhancement working!")
+            return True
+        else:
+            print("❌ Incremental re-enhancement returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Incremental re-enhancement failed: {str(e)}")
+        return False
+
+def test_prompt_planning():
+    """Test output sizing and the single/chunk/summarize/reject decision"""
+    print("\nTesting prompt planning...")
+    try:
+        from chunked_enhancer import DocumentChunker
+        from latex_processor import LaTeXProcessor
+        from prompt_planner import PromptPlanner
+        from result_cache import ResultCache
+
+        class CountingClient:
+            model_name = "stub"
+            generation_config = {"max_output_tokens": 8192}
+            counted = 0
+
+            def count_tokens(self, text):
+                self.counted += 1
+                return len(text) // 4
+
+        client = CountingClient()
+        chunker = DocumentChunker(max_chunk_chars=2000, context_chars=100)
+        planner = PromptPlanner(client, LaTeXProcessor(), chunker, result_cache=ResultCache(),
+                                max_chunks=4, use_sdk_counter=True)
+
+        short = planner.plan("A short note. " * 20)
+        planner.plan("A short note. " * 20)
+        chunked = planner.plan("Paragraph text here. " * 300)
+        summarized = planner.plan("Paragraph text here. " * 2000)
+        rejected = PromptPlanner(client, LaTeXProcessor(), chunker, context_tokens=1000,
+                                 max_chunks=2).plan("Paragraph text here. " * 2000)
+
+        if (short.action == "single" and short.max_output_tokens < 8192 and short.estimator == "sdk"
+                and client.counted == 3 and chunked.action == "chunk" and chunked.chunks > 1
+                and summarized.action == "summarize" and summarized.chunks <= 4
+                and rejected.action == "reject" and rejected.reason):
+            print("✅ Prompt planning working!")
+            return True
+        else:
+            print("❌ Prompt planning returned unexpected plans")
+            return False
+    except Exception as e:
+        print(f"❌ Prompt planning failed: {str(e)}")
+        return False
+
+def test_result_cache():
+    """Test in-process LRU and shared SQLite tiers of the result cache"""
+    print("\nTesting result cache...")
+    try:
+        import tempfile
+        from result_cache import ResultCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "cache.db")
+            key = ResultCache.make_key("text", "prompt", "auto", True, "gemini-pro", {"temperature": 0.7})
+
+            writer = ResultCache(max_bytes=10, db_path=db_path)
+            writer.set_text("enhanced", key, "cached result")
+            writer.set("document", "a", b"12345")
+            writer.set("document", "b", b"123456")
+
+            # A second worker sees the entry through the disk tier
+            reader = ResultCache(db_path=db_path)
+            shared = reader.get_text("enhanced", key)
+            stats = reader.get_stats()
+
+        if (shared == "cached result" and writer.get_stats()["evictions"] == 1
+                and stats["disk_hits"] == 1 and reader.get("enhanced", "missing") is None):
+            print("✅ Result cache working!")
+            return True
+        else:
+            print("❌ Result cache returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Result cache failed: {str(e)}")
+        return False
+
+def test_metrics():
+    """Test Prometheus output merged across worker snapshots"""
+    print("\nTesting metrics...")
+    try:
+        import tempfile
+        from metrics import Metrics, RequestTrace
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Two workers sharing one collector directory
+            worker_a = Metrics(directory=tmp)
+            worker_b = Metrics(directory=tmp)
+
+            trace = RequestTrace(worker_a, "/enhance")
+            with trace.span("extract_text"):
+                pass
+            trace.set(bytes_in=2048, bytes_out=4096, document_cache_hit=False)
+            trace.finish("ok")
+            trace.finish("ok")
+
+            worker_b.inc("http_requests_total", endpoint="/enhance", status="200")
+            worker_b.observe("stage_seconds", 3.0, stage="extract_text")
+            worker_b.flush()
+
+            text = worker_a.render()
+
+        expected = [
+            'verolabz_enhancements_total{endpoint="/enhance",outcome="ok"} 1',
+            'verolabz_http_requests_total{endpoint="/enhance",status="200"} 1',
+            'verolabz_stage_seconds_count{stage="extract_text"} 2',
+            'verolabz_stage_seconds_bucket{stage="extract_text",le="2.5"} 1',
+            'verolabz_request_bytes_bucket{direction="in",le="16384"} 1',
+            'verolabz_cache_lookups_total{layer="document",result="miss"} 1',
+        ]
+        if all(line in text.splitlines() for line in expected):
+            print("✅ Metrics working!")
+            return True
+        else:
+            print("❌ Metrics output is missing expected series")
+            return False
+    except Exception as e:
+        print(f"❌ Metrics failed: {str(e)}")
+        return False
+
+def test_job_queue():
+    """Test background job execution, stage reporting and failure status"""
+    print("\nTesting job queue...")
+    try:
+        import io
+        import tempfile
+        import threading
+        from types import SimpleNamespace
+        from app import create_app
+        from enhancement_pipeline import EnhancementError
+        from job_queue import JobRunner, JobStore, SQLiteJobStore
+        from services import Services
+
+        def work(report_stage):
+            for stage in ("extracting", "enhancing", "rendering"):
+                report_stage(stage)
+            return b"output", "enhanced_test.docx", "application/octet-stream"
+
+        def failing_work(report_stage):
+            raise EnhancementError("Could not extract text from document")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            runner = JobRunner(SQLiteJobStore(directory=tmp), max_workers=1)
+            done = runner.wait(runner.submit(work), timeout=10)
+            failed = runner.wait(runner.submit(failing_work), timeout=10)
+            with open(runner.store.result_path(done["id"]), "rb") as f:
+                output = f.read()
+
+            # /enhance stops waiting on a stuck job and hands it over to be polled
+            release = threading.Event()
+            stuck = JobRunner(SQLiteJobStore(directory=tmp), max_workers=1, wait_timeout=0.05)
+            services = Services()
+            services.override(gemini_client=object(), job_runner=stuck,
+                              pipeline=SimpleNamespace(run=lambda *args, **kwargs: (release.wait(10) and b"output", '.docx')))
+            client = create_app(services).test_client()
+            waited = client.post('/enhance', data={'file': (io.BytesIO(b"some text"), 'doc.txt')})
+            release.set()
+            stuck.wait(waited.get_json()["job_id"], timeout=10)
+
+        # A store missing part of the interface fails when it is created
+        class PartialStore(JobStore):
+            def get(self, job_id):
+                return None
+        try:
+            PartialStore()
+            partial_refused = False
+        except TypeError:
+            partial_refused = True
+
+        if (done["status"] == "done" and output == b"output"
+                and failed["status"] == "failed" and failed["status_code"] == 400
+                and waited.status_code == 202 and waited.get_json()["status"] == "running"
+                and partial_refused):
+            print("✅ Job queue working!")
+            return True
+        else:
+            print("❌ Job queue returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Job queue failed: {str(e)}")
+        return False
+
+def _make_pdf(pages):
+    """Build a minimal PDF with one line of Helvetica text per page"""
+    kids = []
+    n_pages = len(pages)
+    # 1 catalog, 2 pages, 3 font, then page/content pairs
+    body = {}
+    body[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    body[3] = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    for i, text in enumerate(pages):
+        pid, cid = 4 + 2 * i, 5 + 2 * i
+        kids.append(f"{pid} 0 R")
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        body[pid] = f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {cid} 0 R >>".encode()
+        body[cid] = b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+    body[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {n_pages} >>".encode()
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for num in sorted(body):
+        offsets[num] = len(out)
+        out += b"%d 0 obj\n" % num + body[num] + b"\nendobj\n"
+    xref = len(out)
+    size = max(body) + 1
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % size
+    for num in range(1, size):
+        out += b"%010d 00000 n \n" % offsets[num]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref)
+    return bytes(out)
+
+def test_pdf_extraction():
+    """Test page-parallel PDF extraction and page limits"""
+    print("\nTesting PDF extraction...")
+    try:
+        from document_converter import DocumentConverter, DocumentTooLargeError
+
+        pdf = _make_pdf([f"Page number {i}" for i in range(24)])
+        parallel = list(DocumentConverter(pdf_workers=2).iter_pdf_pages(pdf))
+        serial = list(DocumentConverter(pdf_workers=1).iter_pdf_pages(pdf))
+
+        try:
+            DocumentConverter(max_pdf_pages=10).extract_text(pdf, ".pdf")
+            rejected = False
+        except DocumentTooLargeError:
+            rejected = True
+
+        if parallel == serial and parallel[23] == "Page number 23" and rejected:
+            print("✅ PDF extraction working!")
+            return True
+        else:
+            print("❌ PDF extraction returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ PDF extraction failed: {str(e)}")
+        return False
+
+def test_docx_extraction():
+    """Test streaming DOCX extraction with headers and merged table cells"""
+    print("\nTesting DOCX extraction...")
+    try:
+        import io
+        from docx import Document
+        from document_converter import DocumentConverter
+
+        doc = Document()
+        doc.sections[0].header.paragraphs[0].text = "Running header"
+        doc.add_paragraph("Body paragraph")
+        table = doc.add_table(rows=3, cols=3)
+        for r in range(3):
+            for c in range(3):
+                table.cell(r, c).text = f"cell {r}{c}"
+        table.cell(0, 0).merge(table.cell(2, 0))
+        buffer = io.BytesIO()
+        doc.save(buffer)
+
+        text = DocumentConverter().extract_text(buffer.getvalue(), ".docx")
+
+        if (text.startswith("Running header") and text.count("cell 00") == 1
+                and text.index("Body paragraph") < text.index("cell 01")):
+            print("✅ DOCX extraction working!")
+            return True
+        else:
+            print("❌ DOCX extraction returned unexpected text")
+            return False
+    except Exception as e:
+        print(f"❌ DOCX extraction failed: {str(e)}")
+        return False
+
+def test_upload_spooling():
+    """Test that spooled uploads are memory-mapped and extracted in place"""
+    print("\nTesting upload spooling...")
+    try:
+        import io
+        import mmap
+        import tempfile
+        from docx import Document
+        from werkzeug.datastructures import FileStorage
+        from document_converter import DocumentConverter
+        from upload_spool import map_upload, release_upload
+
+        doc = Document()
+        doc.add_paragraph("Spooled upload paragraph")
+        buffer = io.BytesIO()
+        doc.save(buffer)
+
+        spool = tempfile.TemporaryFile('wb+')
+        spool.write(buffer.getvalue())
+        content = map_upload(FileStorage(stream=spool, filename="upload.docx"))
+        # The mapping outlives the request closing (and deleting) the spool file
+        spool.close()
+
+        text = DocumentConverter().extract_text(content, ".docx")
+        small = map_upload(FileStorage(stream=io.BytesIO(b"plain text"), filename="a.txt"))
+        mapped = isinstance(content, mmap.mmap)
+        release_upload(content)
+
+        if mapped and text == "Spooled upload paragraph" and small == b"plain text":
+            print("✅ Upload spooling working!")
+            return True
+        else:
+            print("❌ Upload spooling returned unexpected results")
+            return False
+    except Exception as e:
+        print(f"❌ Upload spooling failed: {str(e)}")
+        return False
+
+def test_docx_rendering():
+    """Test block parsing and bulk DOCX rendering"""
+    print("\nTesting DOCX rendering...")
+    try:
+        import io
+        from docx import Document
+        from document_blocks import parse_blocks
+        from document_converter import DocumentConverter
+        from omml_converter import OmmlConverter
+
+        content = "INTRODUCTION\nPlain text & more\n- bullet\n1. step\n$$\\frac{x^2}{2}$$\nSo $x^2$ holds"
+        kinds = [block.kind for block in parse_blocks(content, include_latex=True)]
+        converter = DocumentConverter()
+        doc = Document(io.BytesIO(converter._create_docx(content, include_latex=True)))
+        styles = [para.style.name for para in doc.paragraphs]
+        math = "{http://schemas.openxmlformats.org/officeDocument/2006/math}"
+        display = doc.paragraphs[4]._p.find(f"{math}oMathPara/{math}oMath/{math}f")
+        inline = doc.paragraphs[5]._p.find(f"{math}oMath/{math}sSup")
+        converter._create_docx(content, include_latex=True)
+        stats = dict(converter.docx_renderer.omml_converter.stats)
+
+        # Malformed equations fall back to their source rather than losing part of it
+        omml = OmmlConverter(cache_size=0)
+        malformed = ["a } b + c", "x = y } + z^2", "\\end{x} a", "a \\\\ b", "a<b & c>d", "}", "{a"]
+        fallback = Document(io.BytesIO(converter._create_docx("$$a } b + c$$", include_latex=True)))
+
+        if (kinds == ["heading", "paragraph", "bullet", "number", "display_math", "math_paragraph"]
+                and styles[:4] == ["Heading 1", "Normal", "List Bullet", "List Number"]
+                and doc.paragraphs[1].text == "Plain text & more"
+                and display is not None and inline is not None
+                and doc.paragraphs[5].runs[1].text == " holds"
+                and stats == {"hits": 2, "misses": 2}
+                and all(omml.convert(latex) is None for latex in malformed)
+                and omml.convert("\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}") is not None
+                and fallback.paragraphs[0].text == "a } b + c"):
+            print("✅ DOCX rendering working!")
+            return True
+        else:
+            print("❌ DOCX rendering produced unexpected structure")
+            return False
+    except Exception as e:
+        print(f"❌ DOCX rendering failed: {str(e)}")
+        return False
+
+def test_docx_patching():
+    """Test that enhanced text is written into the uploaded DOCX, keeping its formatting"""
+    print("\nTesting DOCX patching...")
+    try:
+        import io
+        import base64
+        import zipfile
+        from docx import Document
+        from docx.shared import Inches
+        from document_converter import DocumentConverter
+
+        png = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+        doc = Document()
+        doc.sections[0].header.paragraphs[0].text = "ACME Confidential"
+        doc.add_heading("Quarterly report", 1)
+        paragraph = doc.add_paragraph("The team ")
+        paragraph.add_run("quickly").bold = True
+        paragraph.add_run(" reviewed the numbers and they was good.")
+        doc.add_paragraph("This paragraph stays the same.")
+        doc.add_picture(io.BytesIO(png), width=Inches(1))
+        table = doc.add_table(rows=1, cols=2)
+        table.cell(0, 0).text = "Revenue"
+        table.cell(0, 1).text = "grew alot"
+        doc.add_paragraph("1. First item typed by hand")
+        doc.add_paragraph("Remove me please.")
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        upload = buffer.getvalue()
+
+        converter = DocumentConverter()
+        text, source = converter.extract(upload, '.docx')
+        enhanced = ("ACME Confidential\n# Quarterly Report\n"
+                    "The team quickly reviewed the numbers, and they were good.\n"
+                    "A new paragraph.\nThis paragraph stays the same.\n"
+                    "Revenue\ngrew a lot\n1. First item, typed by hand\n")
+        output = converter.create_document(enhanced, '.docx', '.docx', source=source, file_content=upload)
+
+        with zipfile.ZipFile(io.BytesIO(upload)) as before, zipfile.ZipFile(io.BytesIO(output)) as after:
+            untouched = all(before.read(name) == after.read(name)
+                            for name in before.namelist() if name != 'word/document.xml')
+        patched = Document(io.BytesIO(output))
+        paragraphs = [(p.style.name, [(r.text, r.bold) for r in p.runs]) for p in patched.paragraphs if p.text]
+
+        if (untouched and len(patched.inline_shapes) == 1
+                and paragraphs == [
+                    ("Heading 1", [("Quarterly Report", None)]),
+                    ("Normal", [("The team ", None), ("quickly", True),
+                                (" reviewed the numbers, and they were good.", None)]),
+                    ("Normal", [("A new paragraph.", None)]),
+                    ("Normal", [("This paragraph stays the same.", None)]),
+                    ("Normal", [("1. First item, typed by hand", None)]),
+                ]
+                and [c.text for c in patched.tables[0].rows[0].cells] == ["Revenue", "grew a lot"]
+                and converter.docx_patcher.stats == {'documents': 1, 'kept': 2, 'rewritten': 4,
+                                                     'inserted': 1, 'removed': 1}):
+            print("✅ DOCX patching working!")
+            return True
+        else:
+            print(f"❌ DOCX patching produced unexpected content: {paragraphs}")
+            return False
+    except Exception as e:
+        print(f"❌ DOCX patching failed: {str(e)}")
+        return False
+
+def test_pdf_rendering():
+    """Test native PDF output with page breaks and equations"""
+    print("\nTesting PDF rendering...")
+    try:
+        import io
+        import PyPDF2
+        from document_converter import DocumentConverter
+
+        content = "\n".join(["RESULTS", "Body text (with parentheses).", "$$\\alpha + \\beta$$"] * 150)
+        pdf = DocumentConverter().create_document(content, output_format=".pdf", include_latex=True)
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf))
+        first_page = reader.pages[0].extract_text()
+
+        if (pdf.startswith(b"%PDF") and len(reader.pages) > 1
+                and "Body text (with parentheses)." in first_page and "α + β" in first_page):
+            print(f"✅ PDF rendering working! ({len(reader.pages)} pages)")
+            return True
+        else:
+            print("❌ PDF rendering produced unexpected output")
+            return False
+    except Exception as e:
+        print(f"❌ PDF rendering failed: {str(e)}")
+        return False
+
+def test_signature_stamping():
+    """Test in-place signature stamping of DOCX packages"""
+    print("\nTesting signature stamping...")
+    try:
+        import io
+        import base64
+        import zipfile
+        from docx import Document
+        from document_converter import DocumentConverter
+        from zip_parts import read_local_data
+
+        doc = Document()
+        doc.add_paragraph("Agreement text")
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        original = buffer.getvalue()
+        # 1x1 PNG
+        signature = ("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk"
+                     "YPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+        converter = DocumentConverter()
+        signed = converter.add_signature(original, signature, "bottom-center", "A & B")
+        again = converter.add_signature(original, signature, "bottom-center", "A & B")
+        result = Document(io.BytesIO(signed))
+
+        with zipfile.ZipFile(io.BytesIO(original)) as before, zipfile.ZipFile(io.BytesIO(signed)) as after:
+            styles_kept = (read_local_data(original, before.getinfo("word/styles.xml"))
+                           == read_local_data(signed, after.getinfo("word/styles.xml")))
+
+        try:
+            converter.add_signature(original, base64.b64encode(b"not an image").decode())
+            rejected = False
+        except ValueError:
+            rejected = True
+
+        if (len(result.inline_shapes) == 1 and result.paragraphs[-1].text == "A & B"
+                and styles_kept and again == signed and rejected
+                and converter.signature_stamper.stats["template_hits"] == 1):
+            print("✅ Signature stamping working!")
+            return True
+        else:
+            print("❌ Signature stamping produced unexpected output")
+            return False
+    except Exception as e:
+        print(f"❌ Signature stamping failed: {str(e)}")
+        return False
+
+def test_batch_signing():
+    """Test the batch signing archive and its per-item failures"""
+    print("\nTesting batch signing...")
+    try:
+        import io
+        import os
+        import json
+        import zipfile
+        import tempfile
+        from docx import Document
+        from batch_signer import BatchItem, BatchSigner
+
+        workdir = tempfile.mkdtemp()
+        good = os.path.join(workdir, "good.docx")
+        Document().save(good)
+        bad = os.path.join(workdir, "bad.docx")
+        with open(bad, "wb") as f:
+            f.write(b"not a document")
+
+        # 1x1 PNG
+        signature = ("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk"
+                     "YPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+        items = [
+            BatchItem(0, good, "contract.docx", signature, signer_name="Ann"),
+            BatchItem(1, good, "contract.docx", signature, "bottom-left", signer_name="Bob"),
+            BatchItem(2, bad, "broken.docx", signature),
+        ]
+        signer = BatchSigner(workers=1)
+        signer.output_names(items, many_signers=True)
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(signer.stream_zip(items))))
+        manifest = json.loads(archive.read("manifest.json"))
+        signed = Document(io.BytesIO(archive.read("Signed_contract_Bob.docx")))
+
+        if (manifest["succeeded"] == 2 and manifest["failed"] == 1
+                and manifest["results"][2]["status"] == "failed"
+                and "Signed_contract_Ann.docx" in archive.namelist()
+                and signed.paragraphs[-1].text == "Bob"):
+            print("✅ Batch signing working!")
+            return True
+        else:
+            print("❌ Batch signing produced unexpected output")
+            return False
+    except Exception as e:
+        print(f"❌ Batch signing failed: {str(e)}")
+        return False
+
+def test_app_factory():
+    """Test that the app starts without an API key and builds services lazily"""
+    print("\nTesting app factory...")
+    api_key = os.environ.pop('GEMINI_API_KEY', None)
+    try:
+        import io
+        from app import create_app
+        from services import Services
+
+        services = Services()
+        client = create_app(services).test_client()
+        health = client.get('/health')
+        enhance = client.post('/enhance', data={'file': (io.BytesIO(b"text"), 'doc.txt')})
+        services.warm_up()
+
+        if (health.status_code == 200 and health.get_json()['gemini_configured'] is False
+                and enhance.status_code == 503
+                and 'pipeline' not in services._instances
+                and 'gemini_client' not in services._instances):
+            print("✅ App factory working!")
+            return True
+        else:
+            print("❌ App factory built services eagerly or failed without an API key")
+            return False
+    except Exception as e:
+        print(f"❌ App factory failed: {str(e)}")
+        return False
+    finally:
+        if api_key is not None:
+            os.environ['GEMINI_API_KEY'] = api_key
+
+def test_async_serving():
+    """Test that the ASGI app holds many /enhance requests on one event loop"""
+    print("\nTesting async serving...")
+    try:
+        import asyncio
+        import uuid
+        from types import SimpleNamespace
+        from app import create_app
+        from asgi_app import AsyncApp
+        from gemini_client import GeminiClient
+        from rate_limiter import RateLimiter
+        from services import Services
+
+        class SlowModel:
+            active = 0
+            peak = 0
+
+            async def generate_content_async(self, prompt, generation_config=None, stream=False):
+                SlowModel.active += 1
+                SlowModel.peak = max(SlowModel.peak, SlowModel.active)
+                await asyncio.sleep(0.2)
+                SlowModel.active -= 1
+                if not stream:
+                    return SimpleNamespace(text="Enhanced text.")
+
+                async def chunks():
+                    for piece in ("Enhanced ", "text."):
+                        yield SimpleNamespace(text=piece, parts=[piece])
+                return chunks()
+
+        services = Services()
+        services.override(gemini_client=GeminiClient(
+            model=SlowModel(), rate_limiter=RateLimiter(requests_per_minute=0)
+        ))
+        application = AsyncApp(create_app(services), threads=4)
+
+        async def request(method, path, data=None):
+            boundary = uuid.uuid4().hex
+            body = b''
+            headers = []
+            if data is not None:
+                body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="doc.txt"\r\n\r\n'
+                        .encode() + data + f'\r\n--{boundary}--\r\n'.encode())
+                headers = [(b'content-type', f'multipart/form-data; boundary={boundary}'.encode()),
+                           (b'content-length', str(len(body)).encode())]
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': headers}
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+            response = {'body': b''}
+
+            async def receive():
+                return messages.pop() if messages else await asyncio.Event().wait()
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    response['status'] = message['status']
+                    response['headers'] = dict(message['headers'])
+                else:
+                    response['body'] += message.get('body', b'')
+
+            await application(scope, receive, send)
+            return response
+
+        async def run():
+            documents = [f"Document {i} with enough text.".encode() for i in range(40)]
+            enhanced = await asyncio.gather(*(request('POST', '/enhance', d) for d in documents))
+            streamed = await request('POST', '/enhance/stream', b"Streamed document text.")
+            health = await request('GET', '/health')
+            return enhanced, streamed, health
+
+        enhanced, streamed, health = asyncio.run(run())
+
+        if (all(r['status'] == 200 and r['body'][:2] == b'PK' for r in enhanced)
+                and enhanced[0]['headers'][b'content-disposition'] == b'attachment; filename=enhanced_doc.docx'
+                and SlowModel.peak == 40
+                and b'event: done' in streamed['body']
+                and health['status'] == 200):
+            print("✅ Async serving working!")
+            return True
+        else:
+            print(f"❌ Async serving returned unexpected results (peak in flight {SlowModel.peak})")
+            return False
+    except Exception as e:
+        print(f"❌ Async serving failed: {str(e)}")
+        return False
+
 def main():
     print("=" * 50)
     print("Backend Test Suite")
@@ -81,9 +1218,30 @@ def main():
     
     results = {
         "Imports": test_imports(),
+        "App Factory": test_app_factory(),
         "API Key": test_api_key(),
         "LaTeX Detection": test_latex_detection(),
+        "LaTeX Scanning": test_latex_scan(),
         "Gemini Client": test_gemini_client(),
+        "Gemini Retries": test_gemini_retries(),
+        "Single Flight": test_single_flight(),
+        "Model Routing": test_model_routing(),
+        "Admission": test_admission(),
+        "Chunked Enhancement": test_chunked_enhancement(),
+        "Incremental Enhancement": test_incremental_enhancement(),
+        "Prompt Planning": test_prompt_planning(),
+        "Result Cache": test_result_cache(),
+        "Job Queue": test_job_queue(),
+        "Metrics": test_metrics(),
+        "PDF Extraction": test_pdf_extraction(),
+        "DOCX Extraction": test_docx_extraction(),
+        "Upload Spooling": test_upload_spooling(),
+        "DOCX Rendering": test_docx_rendering(),
+        "DOCX Patching": test_docx_patching(),
+        "PDF Rendering": test_pdf_rendering(),
+        "Signature Stamping": test_signature_stamping(),
+        "Batch Signing": test_batch_signing(),
+        "Async Serving": test_async_serving(),
     }
     
     print("\n" + "=" * 50)
@@ -0,0 +1,109 @@
+import io
+import mmap
+import os
+import tempfile
+from typing import Union
+
+from flask import Request
+
+# Uploads above this many bytes are written to a temp file while the request
+# is parsed, instead of being buffered in memory
+SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_BYTES', 1024 * 1024))
+
+UploadContent = Union[bytes, mmap.mmap]
+
+
+class SpooledRequest(Request):
+    """Request whose large file uploads go straight to an unnamed temp file"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > SPOOL_THRESHOLD:
+            return tempfile.TemporaryFile('wb+')
+        return io.BytesIO()
+
+
+class BufferStream(io.RawIOBase):
+    """
+    Read-only, seekable file object over bytes or an mmap
+
+    zipfile, python-docx and PyPDF2 want a file object; wrapping an mmap in
+    BytesIO would copy the whole upload. Reads here slice the buffer directly.
+    """
+
+    def __init__(self, buffer: UploadContent):
+        super().__init__()
+        self._buffer = buffer
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return offset
+
+    def read(self, size: int = -1) -> bytes:
+        start = self._position
+        end = len(self._buffer) if size is None or size < 0 else min(start + size, len(self._buffer))
+        if start >= end:
+            return b''
+        self._position = end
+        return self._buffer[start:end]
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, target) -> int:
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+
+def open_stream(content: UploadContent) -> io.RawIOBase:
+    """File object over upload content, without copying it"""
+    if isinstance(content, bytes):
+        # BytesIO shares an immutable bytes object until it is written to
+        return io.BytesIO(content)
+    return BufferStream(content)
+
+
+def map_upload(file_storage) -> UploadContent:
+    """
+    Upload content as bytes (small uploads) or a read-only mmap of its spool file
+
+    The mapping stays valid after the request closes and deletes the spool
+    file, so it can be handed to a background job. Call release_upload when
+    done with it.
+
+    Args:
+        file_storage: werkzeug FileStorage from request.files
+
+    Returns:
+        Bytes-like upload content
+    """
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        return stream.getvalue()
+
+    stream.flush()
+    if os.fstat(stream.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def release_upload(content: UploadContent):
+    """Unmap upload content returned by map_upload"""
+    if isinstance(content, mmap.mmap):
+        content.close()
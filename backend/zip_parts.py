@@ -0,0 +1,59 @@
+import copy
+import struct
+import zipfile
+import zlib
+from typing import Tuple
+
+from upload_spool import UploadContent
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+DATA_DESCRIPTOR_FLAG = 0x08
+ENCRYPTED_FLAG = 0x01
+
+
+class UnsupportedEntry(Exception):
+    """A zip entry that can't be copied without decompressing it"""
+
+
+def read_local_data(content: UploadContent, info: zipfile.ZipInfo) -> bytes:
+    """Compressed bytes of a zip entry, read straight from its local header"""
+    if info.flag_bits & ENCRYPTED_FLAG:
+        raise UnsupportedEntry(f"{info.filename} is encrypted")
+    offset = info.header_offset
+    header = LOCAL_HEADER.unpack(content[offset:offset + LOCAL_HEADER.size])
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise UnsupportedEntry(f"Bad local header for {info.filename}")
+    start = offset + LOCAL_HEADER.size + header[9] + header[10]
+    return content[start:start + info.compress_size]
+
+
+def compressed_entry(name: str, data: bytes, date_time=(1980, 1, 1, 0, 0, 0)) -> Tuple[zipfile.ZipInfo, bytes]:
+    """A deflated entry ready to be written raw"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    info = zipfile.ZipInfo(name, date_time=date_time)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC = zlib.crc32(data)
+    info.file_size = len(data)
+    info.compress_size = len(compressed)
+    return info, compressed
+
+
+def write_raw(output: zipfile.ZipFile, info: zipfile.ZipInfo, data: bytes):
+    """
+    Append an already-compressed entry to a zip being written
+
+    zipfile has no public way to copy an entry without decompressing it, so
+    the local header is written from the ZipInfo and the entry registered for
+    the central directory, which is what ZipFile.write does internally.
+    """
+    info = copy.copy(info)
+    # Sizes and CRC are known, so they go in the local header, not a descriptor
+    info.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+    info.header_offset = output.fp.tell()
+    output.fp.write(info.FileHeader())
+    output.fp.write(data)
+    output.start_dir = output.fp.tell()
+    output.filelist.append(info)
+    output.NameToInfo[info.filename] = info